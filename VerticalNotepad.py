@@ -1,8 +1,29 @@
 import tkinter as tk
 from tkinter import filedialog, font, ttk, simpledialog, messagebox
 import os
+import math
 import platform
 import re
+import json
+import hashlib
+import codecs
+import bisect
+import fnmatch
+import tempfile
+import shutil
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import uuid
+import argparse
+import gzip
+import time
+import tracemalloc
+from types import SimpleNamespace
+import zipfile
+from datetime import datetime, timezone
+from xml.sax.saxutils import escape, unescape
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.units import mm
@@ -10,6 +31,49 @@ import numpy as np
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.lib import colors
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+#ボタンの地の色。SystemButtonFaceはWindowsのTkにしかないので、ほかではTkの既定のボタンの色を使う
+BUTTON_FACE = "SystemButtonFace" if os.name == "nt" else "#d9d9d9"
+
+#テーマ(画面とPDF出力で共通)
+#grid / pdf_grid: 画面とPDFでの原稿用紙の罫線の色(罫線なしはNone)
+THEMES = {
+    "Light": {"background": "white", "status_background": BUTTON_FACE, "status_text": "black",
+              "text": "black", "caret": "black", "grid": None,
+              "pdf_background": "#ffffff", "pdf_text": "#000000", "pdf_grid": None},
+    "Dark": {"background": "gray12", "status_background": "gray20", "status_text": "white",
+             "text": "white", "caret": "white", "grid": None,
+             "pdf_background": "#1f1f1f", "pdf_text": "#ffffff", "pdf_grid": None},
+    "優しい": {"background": "ivory", "status_background": "ivory", "status_text": "ivory",
+            "text": "gray", "caret": "gray", "grid": None,
+            "pdf_background": "#fffff0", "pdf_text": "#808080", "pdf_grid": None},
+    "原稿用紙風": {"background": "#f8f8f8", "status_background": "#e0e0e0", "status_text": "black",
+              "text": "black", "caret": "black", "grid": "#a52a2a",
+              "pdf_background": "#f8f8f8", "pdf_text": "#000000", "pdf_grid": "#ff0000"},
+    "原稿用紙風-優しい": {"background": "ivory", "status_background": BUTTON_FACE, "status_text": "black",
+                  "text": "black", "caret": "black", "grid": "#a52a2a",
+                  "pdf_background": "#fffff0", "pdf_text": "#000000", "pdf_grid": "#ff0000"},
+    "Matrix": {"background": "black", "status_background": "#003300", "status_text": "#00FF00",
+               "text": "#00FF00", "caret": "#00FF00", "grid": None,
+               "pdf_background": "#000000", "pdf_text": "#00FF00", "pdf_grid": None},
+}
+
+#設定やキャッシュの置き場所
+APP_DATA_DIR = os.path.join(os.path.expanduser("~"), ".tatex")
+
+#正規表現として解釈が必要な記号
+REGEX_META = re.compile(r"[.^$*+?{}\[\]\\|()]")
+
+#章見出しとみなす行(既定値)
+HEADING_PATTERN = r"^[ 　]*第[0-9０-９一二三四五六七八九十百千]+[章話部節]"
+
+#ページ番号は画面ではなく20字×20行の原稿用紙で数える
+PAGE_COLUMNS = 20
+COLUMN_CHARS = 20
 
 # 高DPIスケーリングを有効化
 try:
@@ -18,8 +82,19 @@ try:
 except Exception:
     pass
 
+def view_attribute(name):
+    #アクティブなビューの属性をそのまま読み書きする
+    return property(lambda self: getattr(self.view, name), lambda self, value: setattr(self.view, name, value))
+
 class VerticalNotepad:
-    def __init__(self, root):
+    canvas = view_attribute("canvas")
+    caret_pos = view_attribute("caret_pos")
+    selected_text_start = view_attribute("selected_text_start")
+    selected_text_end = view_attribute("selected_text_end")
+    drag_start_pos = view_attribute("drag_start_pos")
+
+    def __init__(self, root, interactive=True):
+        #interactive=False: 再生用。自動保存の復元やフォントの走査はしない
         self.root = root
         self.root.title("TateX")
         self.root.geometry("600x800")
@@ -28,6 +103,36 @@ class VerticalNotepad:
         #自動改行
         self.indent_on_newline = tk.BooleanVar(value=False) 
         self.check_kakko_mismatch = tk.BooleanVar(value=False)
+        #ルビ・傍点などの青空文庫注記
+        self.show_ruby = tk.BooleanVar(value=True)
+        self.aozora_parser = AozoraParser()
+        self.ruby_font = None
+        #検索用のn-gramインデックス
+        self.use_search_index = tk.BooleanVar(value=True)
+        self.ngram_index = NgramIndex()
+        #見出しの索引(アウトライン・EPUBの章分け)
+        self.heading_index = HeadingIndex()
+        #原稿用紙でのページ番号
+        self.manuscript_pages = ManuscriptPages()
+        #別のファイルとの比較結果(比較中でなければNone)
+        self.revision_diff = None
+        #校正(変更された段落だけを裏で調べる)
+        self.proofread = tk.BooleanVar(value=False)
+        self.linter = ProofreadingLinter()
+        #クラッシュ時の復元用ジャーナル
+        self.autosave = tk.BooleanVar(value=True)
+        self.journal = EditJournal(os.path.join(APP_DATA_DIR, "autosave"))
+        #列の索引と、開き直しを速くするセッションキャッシュ
+        self.layout = LayoutIndex()
+        self.session_cache = SessionCache(os.path.join(APP_DATA_DIR, "sessions"))
+        self.file_hash = None
+        #フォント一覧と寸法のキャッシュ。なければ起動後に空いた時間で作る
+        self.font_catalog = FontCatalog(os.path.join(APP_DATA_DIR, "fonts.json"))
+        if interactive:
+            self.font_catalog.start(self.root)
+        #操作の記録(記録中でなければNone)
+        self.recorder = None
+        self.recording = tk.BooleanVar(value=False)
 
         #テーマ変更用
         self.theme = tk.StringVar(value="Light")
@@ -44,13 +149,18 @@ class VerticalNotepad:
         self.style.configure("Vertical.TScrollbar", gripcount=0, troughcolor="#f0f0f0", background="#e0e0e0")
         self.style.map("Vertical.TScrollbar", background=[("active", "#c0c0c0")])
 
-        self.canvas = tk.Canvas(self.root, bg="white")
-        self.canvas.pack(fill="both", expand=True)
+        #同じ文書を並べて表示するビュー。self.canvasやself.caret_posはアクティブなビューのもの
+        self.text = ""
+        self.panes = tk.PanedWindow(self.root, orient=tk.HORIZONTAL, sashwidth=4)
+        self.panes.pack(fill="both", expand=True)
+        self.view = TextView(self, self.panes)
+        self.views = [self.view]
+        self.panes.add(self.view.frame, stretch="always")
 
-        #横方向スクロール
-        self.scrollbar_x = ttk.Scrollbar(self.root, orient="horizontal", command=self.canvas.xview)
-        self.scrollbar_x.pack(side=tk.BOTTOM, fill=tk.X)
-        self.canvas.configure(xscrollcommand=self.scrollbar_x.set)
+        #文書全体の縮小表示
+        self.show_minimap = tk.BooleanVar(value=True)
+        self.minimap = Minimap(self.root, self)
+        self.minimap.canvas.pack(side=tk.BOTTOM, fill=tk.X)
 
         #縦方向スクロール?
         # self.scrollbar = ttk.Scrollbar(self.root, orient="vertical", command=self.canvas.yview)
@@ -58,16 +168,9 @@ class VerticalNotepad:
         # self.canvas.configure(yscrollcommand=self.scrollbar.set)
 
 
-        self.canvas.bind("<Configure>", self.redraw)
-        self.canvas.bind("<Key>", self.on_key_press)
-        self.canvas.bind("<Button-1>", self.on_mouse_click)
-        self.canvas.bind("<B1-Motion>", self.on_mouse_drag)  # ドラッグイベントを追加
-        self.canvas.bind("<ButtonRelease-1>", self.on_mouse_release)  # リリースイベントを追加
-        self.canvas.bind("<MouseWheel>", self.on_mousewheel) 
         self.canvas.focus_set()
 
-        self.text = ""
-        self.kakko_stack = []
+        self.file_path = None
         self.caret_pos = 0
 
         
@@ -79,10 +182,6 @@ class VerticalNotepad:
         self.search_index = 0
         self.highlighted_ranges = []
 
-        self.selected_text_start = None
-        self.selected_text_end = None
-        self.drag_start_pos = None  # ドラッグ開始位置を保持
-
         self.auto_indent = []
 
         self.search_term = ""
@@ -91,6 +190,86 @@ class VerticalNotepad:
         self.search_index = 0
         self.key_pressed = False
 
+        self.saved_text = self.text
+        self.root.protocol("WM_DELETE_WINDOW", self.quit_app)
+        if interactive:
+            self.root.after_idle(self.start_autosave)
+        else:
+            self.autosave.set(False)
+
+    def start_autosave(self):
+        #前回のジャーナルが残っていれば復元を確認してから、新しいジャーナルを始める
+        recovered = self.journal.recover(lambda file_path: self.read_text_file(file_path)[0])
+        if recovered and messagebox.askyesno("復元", "前回終了時に保存されていない編集内容があります。復元しますか?"):
+            self.text, self.auto_indent, self.file_path = recovered
+            self.caret_pos = 0
+            self.redraw()
+        else:
+            self.saved_text = self.text
+        self.journal.start(self.text, self.auto_indent, self.file_path, self.text is self.saved_text)
+        #確認したジャーナルは、新しいスナップショットを書いた後で消す
+        self.journal.discard_recovered()
+        self.root.after(EditJournal.FLUSH_MS, self.autosave_tick)
+
+    def autosave_tick(self):
+        #キー入力ごとではなく、一定間隔で前回からの差分をまとめて記録する
+        if self.autosave.get() and self.text is not self.saved_text:
+            self.journal.record(self.text, self.auto_indent, self.file_path)
+        self.root.after(EditJournal.FLUSH_MS, self.autosave_tick)
+
+    def mark_saved(self):
+        self.saved_text = self.text
+        if self.journal.worker is not None:
+            self.journal.reset(self.text, self.auto_indent, self.file_path, True)
+
+    def quit_app(self):
+        self.save_session()
+        self.stop_recording()
+        if self.journal.worker is not None:
+            clean = self.text is self.saved_text or self.text == self.saved_text
+            if not clean and self.autosave.get():
+                self.journal.record(self.text, self.auto_indent, self.file_path)
+            self.journal.close(clean)
+        self.root.quit()
+
+    def start_recording(self, path):
+        self.recorder = InputRecorder(self, path)
+        self.recording.set(True)
+        self.root.after(InputRecorder.FLUSH_MS, self.recording_tick)
+
+    def recording_tick(self):
+        #落ちても記録がそこまで読めるよう、一定間隔でファイルに書き出す
+        if self.recorder is None:
+            return
+        self.recorder.flush()
+        self.root.after(InputRecorder.FLUSH_MS, self.recording_tick)
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+        self.recording.set(False)
+
+    def on_recording_change(self):
+        #記録を止めたときに保存する。始めるときは保存先を先に決める
+        if not self.recording.get():
+            self.stop_recording()
+            return
+        path = filedialog.asksaveasfilename(defaultextension=".trace.gz", filetypes=[("操作の記録", "*.trace.gz"), ("すべてのファイル", "*.*")])
+        if path:
+            self.start_recording(path)
+        else:
+            self.recording.set(False)
+
+    def record_event(self, kind, *args):
+        if self.recorder is not None:
+            self.recorder.record(kind, *args)
+
+    def read_text_file(self, file_path):
+        #(テキスト, 内容のハッシュ)を返す。文字コードは先頭から推定し、改行はLFにそろえる
+        text, encoding, file_hash = read_text_stream(file_path)
+        return text, file_hash
+
     def on_kakko_mismatch_change(self): #コールバック関数の追加
         self.redraw()
 
@@ -104,7 +283,12 @@ class VerticalNotepad:
         file_menu.add_command(label="開く (Ctrl+O)", command=self.open_file, accelerator="Ctrl+O")  # 開くを追加
         file_menu.add_command(label="保存 (Ctrl+S)", command=self.save_file, accelerator="Ctrl+S")
         file_menu.add_command(label="PDF出力", command=self.export_to_pdf)
-        file_menu.add_command(label="終了 (Ctrl+Q)", command=self.root.quit, accelerator="Ctrl+Q")
+        file_menu.add_command(label="EPUB出力", command=self.export_to_epub)
+        file_menu.add_command(label="印刷プレビュー", command=self.open_print_preview)
+        file_menu.add_command(label="ファイルと比較", command=self.open_compare)
+        file_menu.add_checkbutton(label="自動保存(復元用)", variable=self.autosave)
+        file_menu.add_checkbutton(label="操作を記録", variable=self.recording, command=self.on_recording_change)
+        file_menu.add_command(label="終了 (Ctrl+Q)", command=self.quit_app, accelerator="Ctrl+Q")
 
         edit_menu = tk.Menu(menubar, tearoff=0)
         menubar.add_cascade(label="編集", menu=edit_menu)
@@ -112,19 +296,28 @@ class VerticalNotepad:
         edit_menu.add_command(label="貼り付け (Ctrl+V)", command=self.paste_text, accelerator="Ctrl+V")
         edit_menu.add_command(label="切り取り (Ctrl+X)", command=self.cut_text, accelerator="Ctrl+X")
         edit_menu.add_command(label="検索・置換 (Ctrl+F)", command=self.search_text, accelerator="Ctrl+F")
+        edit_menu.add_command(label="フォルダ内検索・置換", command=self.open_project_search)
+        edit_menu.add_command(label="見出し・ページ移動 (Ctrl+G)", command=self.open_outline, accelerator="Ctrl+G")
+        edit_menu.add_checkbutton(label="検索インデックスを使う", variable=self.use_search_index, command=self.on_search_index_change)
 
         format_menu = tk.Menu(menubar, tearoff=0)
         menubar.add_cascade(label="書式", menu=format_menu)
         format_menu.add_command(label="フォント変更", command=self.change_font)
         format_menu.add_checkbutton(label="自動字下げ", variable=self.indent_on_newline)
         format_menu.add_checkbutton(label="括弧不一致チェック", variable=self.check_kakko_mismatch, command=self.on_kakko_mismatch_change)
+        format_menu.add_checkbutton(label="ルビ・注記を表示", variable=self.show_ruby, command=self.redraw)
+        format_menu.add_checkbutton(label="校正チェック", variable=self.proofread, command=self.on_proofread_change)
         format_menu.add_command(label="テーマ変更", command=self.change_theme)
+        format_menu.add_checkbutton(label="ミニマップを表示", variable=self.show_minimap, command=self.on_minimap_change)
+        format_menu.add_command(label="画面を分割", command=self.split_view)
+        format_menu.add_command(label="分割を閉じる", command=self.close_view)
 
         self.root.bind("<Control-n>", lambda e: self.new_file())
         self.root.bind("<Control-o>", lambda e: self.open_file())  # Ctrl+Oのショートカットを追加
         self.root.bind("<Control-s>", lambda e: self.save_file())
-        self.root.bind("<Control-q>", lambda e: self.root.quit())
+        self.root.bind("<Control-q>", lambda e: self.quit_app())
         self.root.bind("<Control-f>", lambda e: self.search_text())
+        self.root.bind("<Control-g>", lambda e: self.open_outline())
         self.root.bind("<Control-h>", lambda e: self.replace_text())
         self.root.bind("<Control-c>", lambda e: self.copy_text())
         self.root.bind("<Control-v>", lambda e: self.paste_text())
@@ -139,33 +332,91 @@ class VerticalNotepad:
     #     x, y = self.get_caret_coords(self.caret_pos)
     #     self.status_bar.config(text=f"文字数: {char_count}, 行数: {line_count}")
 
+    def get_layout(self):
+        #列の索引を今のテキストとキャンバスの大きさに合わせてから返す
+        key = (self.canvas.winfo_height(), self.current_font.metrics("linespace"))
+        if self.layout.update(self.text, self.auto_indent, self.get_markup(), key) and self.show_minimap.get():
+            self.minimap.sync(self.layout)
+        return self.layout
+
+    def activate_view(self, view):
+        if view is self.view:
+            return
+        self.view = view
+        self.record_event("view", self.views.index(view))
+        view.canvas.focus_set()
+        if self.show_minimap.get():
+            self.minimap.show_view()
+
+    def split_view(self):
+        #同じ文書をもう1つのビューで横に並べる。キャレットは今のビューと同じ位置から始める
+        self.record_event("split")
+        view = TextView(self, self.panes)
+        view.caret_pos = self.caret_pos
+        self.views.append(view)
+        self.panes.add(view.frame, stretch="always")
+        self.activate_view(view)
+        self.apply_theme()
+
+    def close_view(self):
+        if len(self.views) < 2:
+            return
+        self.record_event("close_view")
+        view = self.view
+        self.views.remove(view)
+        self.panes.forget(view.frame)
+        self.activate_view(self.views[0])
+        view.frame.destroy()
+        self.redraw()
+
+    def on_minimap_change(self):
+        if self.show_minimap.get():
+            self.minimap.canvas.pack(side=tk.BOTTOM, fill=tk.X, before=self.status_bar)
+            self.minimap.schedule()
+        else:
+            self.minimap.canvas.pack_forget()
+
+    def get_markup(self):
+        #ルビ表示がOFFのときは注記を生のテキストとして扱う
+        if not self.show_ruby.get():
+            return EMPTY_MARKUP
+        return self.aozora_parser.parse(self.text)
+
+    def get_ruby_font(self):
+        actual = self.current_font.actual()
+        size = max(6, abs(actual["size"]) // 2)
+        if self.ruby_font is None or self.ruby_font.actual()["family"] != actual["family"] or self.ruby_font.cget("size") != size:
+            self.ruby_font = font.Font(family=actual["family"], size=size)
+        return self.ruby_font
+
+    def draw_ruby(self, canvas, x, top, bottom, ruby_text, char_width, col_tag):
+        #親文字の右側の行間にルビを均等に並べる
+        ruby_font = self.get_ruby_font()
+        ruby_height = ruby_font.metrics("linespace")
+        step = max(ruby_height, (bottom - top) / len(ruby_text))
+        y = top + ((bottom - top) - step * len(ruby_text)) / 2 + step / 2
+        for ruby_char in ruby_text:
+            canvas.create_text(x + char_width * 0.75, y, text=ruby_char, font=ruby_font, anchor="center", fill=self.text_color, tags=("text", "ruby", "column", col_tag))
+            y += step
+
     def count_characters(self):
         char_count = len(self.text)
         line_count = self.calculate_line_count()
-        self.status_bar.config(text=f"文字数: {char_count}, 行数: {line_count}")
+        status = f"文字数: {char_count}, 行数: {line_count}"
+        #キャレット位置の校正の指摘を出す
+        if self.proofread.get():
+            findings = self.linter.query(self.caret_pos, self.caret_pos + 1)
+            if findings:
+                status += f"  校正: {findings[0][2]}"
+        self.status_bar.config(text=status)
 
     def calculate_line_count(self):
-        width = self.canvas.winfo_width()
-        line_height = self.current_font.metrics("linespace")
-        char_width = self.current_font.measure("あ")
-        x = width - char_width
-        y = line_height
-        line_count = 1
-        for char in self.text:
-            if char == "\n":
-                line_count += 1
-                y = line_height
-                x -= char_width * 1.5
-            else:
-                y += line_height
-                if y > self.canvas.winfo_height() - line_height:
-                    line_count += 1
-                    y = line_height
-                    x -= char_width * 1.5
-        return line_count
+        return self.get_layout().column_count()
 
     def new_file(self):
         self.text = ""
+        self.file_path = None
+        self.mark_saved()
         self.caret_pos = 0
         self.redraw()
         self.highlighted_ranges = []
@@ -173,112 +424,175 @@ class VerticalNotepad:
         self.selected_text_end = None
 
     def get_current_line_number(self):
-        width = self.canvas.winfo_width()
-        line_height = self.current_font.metrics("linespace")
-        char_width = self.current_font.measure("あ")
-        x = width - char_width
-        y = line_height
-        line_number = 1
-        char_index = 0
-
-        for char in self.text:
-            if char_index == self.caret_pos:
-                return line_number
-            if char == "\n":
-                line_number += 1
-                y = line_height
-                x -= char_width * 1.5
-            else:
-                y += line_height
-                if y > self.canvas.winfo_height() - line_height:
-                    line_number += 1
-                    y = line_height
-                    x -= char_width * 1.5
-            char_index += 1
-
-        return line_number
+        return self.get_layout().column_of(self.caret_pos) + 1
 
     def save_file(self):
         file_path = filedialog.asksaveasfilename(defaultextension=".txt",
                                                filetypes=[("Text files", "*.txt"), ("All files", "*.*")])
         if file_path:
-            with open(file_path, "w", encoding="utf-8") as f:
-                f.write(self.text)
+            data = self.text.encode("utf-8")
+            with open(file_path, "wb") as f:
+                f.write(data)
+            self.file_path = file_path
+            self.file_hash = hashlib.sha1(data).hexdigest()
+            self.mark_saved()
+            self.save_session()
 
     def open_file(self):
         file_path = filedialog.askopenfilename(filetypes=[("Text files", "*.txt"), ("All files", "*.*")])
         if file_path:
-            try:
-                with open(file_path, "r", encoding="utf-8") as f:
-                    self.text = f.read()
-                self.caret_pos = 0
-                self.redraw()
-                self.highlighted_ranges = []
-                self.selected_text_start = None
-                self.selected_text_end = None
-            except Exception as e:
-                messagebox.showerror("エラー", f"ファイルを開く際にエラーが発生しました:\n{e}")
+            self.load_file(file_path)
+
+    def load_file(self, file_path):
+        try:
+            text, file_hash = self.read_text_file(file_path)
+        except Exception as e:
+            messagebox.showerror("エラー", f"ファイルを開く際にエラーが発生しました:\n{e}")
+            return False
+        self.save_session()
+        self.text = text
+        self.file_path = file_path
+        self.file_hash = file_hash
+        self.highlighted_ranges = []
+        self.selected_text_start = None
+        self.selected_text_end = None
+        self.restore_session()
+        self.mark_saved()
+        return True
+
+    def save_session(self):
+        #保存済みの内容と一致しているときだけ、字下げ・キャレット・スクロール位置・列の索引を残しておく
+        if self.file_hash is None or not (self.text is self.saved_text or self.text == self.saved_text):
+            return
+        layout = self.get_layout()
+        self.session_cache.save(self.file_hash, {
+            "auto_indent": np.array(self.auto_indent, dtype=bool),
+            "caret_pos": np.array(self.caret_pos),
+            "xview": np.array(self.canvas.xview()[0]),
+            "show_ruby": np.array(self.show_ruby.get()),
+            **layout.dump(),
+        })
+
+    def restore_session(self):
+        #ハッシュが一致すれば前回の状態をそのまま使い、なければ作り直す
+        newline_count = self.text.count("\n")
+        data = self.session_cache.load(self.file_hash)
+        if data is not None and len(data["auto_indent"]) == newline_count:
+            self.auto_indent = data["auto_indent"].tolist()
+            self.caret_pos = min(int(data["caret_pos"]), len(self.text))
+            key = (self.canvas.winfo_height(), self.current_font.metrics("linespace"))
+            if tuple(data["layout_key"].tolist()) == key and bool(data["show_ruby"]) == self.show_ruby.get():
+                self.layout.load(self.text, self.auto_indent, self.get_markup(), key, data)
+            self.redraw()
+            self.canvas.xview_moveto(float(data["xview"]))
+        else:
+            self.auto_indent = [False] * newline_count
+            self.caret_pos = 0
+            self.redraw()
+
+    def open_project_search(self):
+        ProjectSearchDialog(self.root, self)
+
+    def open_outline(self):
+        OutlineDialog(self.root, self)
+
+    def open_compare(self):
+        CompareDialog(self.root, self)
+
+    def on_proofread_change(self):
+        if self.proofread.get():
+            self.linter.start()
+            self.lint_tick()
+        else:
+            self.linter.stop()
+            self.redraw()
+
+    def lint_tick(self):
+        #一定間隔で編集を校正に渡し、届いた結果があれば描き直す
+        if not self.proofread.get():
+            return
+        self.linter.update(self.text)
+        if self.linter.poll():
+            self.redraw()
+        self.root.after(ProofreadingLinter.POLL_MS, self.lint_tick)
+
+    def get_diff_ranges(self):
+        #比較結果を今のテキストに合わせてから返す
+        if self.revision_diff is None:
+            return []
+        self.revision_diff.update(self.text)
+        return self.revision_diff.changes
+
+    def jump_to(self, pos):
+        #キャレットを移し、その列が見えるようにスクロールする
+        self.caret_pos = max(0, min(pos, len(self.text)))
+        self.selected_text_start = None
+        self.selected_text_end = None
+        self.redraw()
+        self.scroll_to_column(self.get_layout().column_of(self.caret_pos))
+
+    def get_manuscript_pages(self):
+        self.manuscript_pages.update(self.text, self.auto_indent, self.get_markup())
+        return self.manuscript_pages
+
+    def go_to_page(self, page):
+        #原稿用紙のpageページ目の先頭へ移る
+        pos = self.get_manuscript_pages().page_start(page)
+        if pos is None:
+            return False
+        self.jump_to(pos)
+        return True
+
+    def go_to_chapter(self, number):
+        self.heading_index.update(self.text)
+        if not 1 <= number <= len(self.heading_index.positions):
+            return False
+        self.jump_to(self.heading_index.positions[number - 1])
+        return True
+
+    def scroll_to_column(self, col):
+        #col列目が本文の中央に来るようにスクロールする
+        char_width = self.current_font.measure("あ")
+        width = self.canvas.winfo_width()
+        x = width - char_width - char_width * 1.5 * col
+        scrollregion = [float(value) for value in str(self.canvas.cget("scrollregion")).split()]
+        if len(scrollregion) != 4 or scrollregion[2] <= scrollregion[0]:
+            return
+        left, right = scrollregion[0], scrollregion[2]
+        self.canvas.xview_moveto(max(0.0, (x - width / 2 - left) / (right - left)))
 
     def change_font(self):
         def apply_new_font(new_font):
             self.current_font = new_font
             self.redraw()
 
-        FontDialog(self.root, self.current_font, apply_new_font)
+        FontDialog(self.root, self.current_font, apply_new_font, self.font_catalog)
     
     def change_theme(self):
-        themes = ["Light", "Dark","優しい", "原稿用紙風","原稿用紙風-優しい","Matrix"]
         def apply_new_theme(new_theme):
             self.theme.set(new_theme)
             self.apply_theme()
-            self.redraw()
 
-        ThemeDialog(self.root, self.theme.get(), apply_new_theme, themes)
+        ThemeDialog(self.root, self.theme.get(), apply_new_theme, list(THEMES))
 
     def apply_theme(self):
-        if self.theme.get() == "Dark":
-            self.root.config(bg="gray12")
-            self.canvas.config(bg="gray12")
-            self.status_bar.config(bg="gray20", fg="white")
-            self.text_color = "white"
-            self.caret_color="white"
-            self.canvas.update()
-        elif self.theme.get() == "優しい":
-            self.root.config(bg="ivory")
-            self.canvas.config(bg="ivory")
-            self.status_bar.config(bg="ivory", fg="ivory")
-            self.text_color = "gray"
-            self.caret_color="gray"
-            self.canvas.update()
-        elif self.theme.get() == "原稿用紙風":
-            self.root.config(bg="#f8f8f8")  # 薄いグレーの背景
-            self.canvas.config(bg="#f8f8f8")
-            self.status_bar.config(bg="#e0e0e0", fg="black")
-            self.text_color = "black"
-            self.caret_color = "black"
-            self.canvas.update()
-        elif self.theme.get() == "Matrix":
-            self.root.config(bg="black")
-            self.canvas.config(bg="black")
-            self.status_bar.config(bg="#003300", fg="#00FF00")
-            self.text_color = "#00FF00"  # マトリックス風の緑色
-            self.caret_color = "#00FF00"
-            self.canvas.update()
-        elif self.theme.get() == "原稿用紙風-優しい":
-            self.root.config(bg="ivory")  # 薄いグレーの背景
-            self.canvas.config(bg="ivory")
-            self.status_bar.config(bg="SystemButtonFace", fg="black")
-            self.text_color = "black"
-            self.caret_color = "black"
-            self.canvas.update()
-        else:
-            self.root.config(bg="white")
-            self.canvas.config(bg="white")
-            self.status_bar.config(bg="SystemButtonFace", fg="black")
-            self.canvas.itemconfig("text", fill="black")
-            self.text_color = "black"
-            self.caret_color="black"
-            self.canvas.update()
+        #レイアウトはそのままで、描画済みの項目の色だけをタグ単位で塗り替える
+        theme = THEMES.get(self.theme.get(), THEMES["Light"])
+        self.root.config(bg=theme["background"])
+        self.status_bar.config(bg=theme["status_background"], fg=theme["status_text"])
+        self.text_color = theme["text"]
+        self.caret_color = theme["caret"]
+        for view in self.views:
+            canvas = view.canvas
+            canvas.config(bg=theme["background"])
+            canvas.itemconfig("text", fill=self.text_color)
+            canvas.itemconfig("pagebreak", fill=self.text_color)
+            canvas.itemconfig("bouten", fill=self.text_color)
+            canvas.itemconfig("caret", fill=self.caret_color)
+            #原稿用紙風との切り替えでは罫線の層だけを出し入れする
+            canvas.delete("grid")
+            self.draw_grid_layer(canvas)
+        self.minimap.set_colors(theme["background"], theme["text"])
         
     def is_caret_at_last_line(self):
         current_line = self.get_current_line_number()
@@ -286,149 +600,154 @@ class VerticalNotepad:
         return current_line == total_lines
 
     def redraw(self, event=None):
-        self.canvas.delete("all")
-        width = self.canvas.winfo_width()
-        height = self.canvas.winfo_height()
+        #アクティブなビューは見えている列を描き直し、ほかのビューは編集で変わった列だけを描き直す
+        self.view.repaint()
+        for view in self.views:
+            if view is not self.view:
+                view.refresh()
+        self.count_characters()
+        #検索結果や括弧チェックの切り替えは列の索引を変えないので、印だけ描き直す
+        if self.show_minimap.get():
+            self.minimap.schedule()
+
+    def draw_columns(self, view, first, last):
+        #first〜last-1列目をviewのキャンバスに描く。列の先頭位置と段は列の索引から求める
+        canvas = view.canvas
+        layout = self.layout
+        width = canvas.winfo_width()
+        height = canvas.winfo_height()
 
         line_height = self.current_font.metrics("linespace")
         char_width = self.current_font.measure("あ")
-        x = width-char_width
-        y = line_height
-
 
         rotate_chars = "「『（【《」』）】》―ー"
 
-        last_char = ""
-        char_index = 0
-        count_return = 0
+        text = self.text
+        last = min(last, layout.column_count())
+        if first >= last:
+            return
+        #描く列にかかる段落の注記だけを取り出しておく
+        markup = layout.markup.window(int(layout.starts[first]), layout.column_end(last - 1))
+        hidden = markup.hidden
+        kakko_error_positions = set(layout.mismatch_positions(first, last)) if self.check_kakko_mismatch.get() else ()
+        selection_start = view.selected_text_start
+        selection_end = view.selected_text_end
+        if selection_start is None or selection_end is None:
+            selection_start = selection_end = -1
+        ranges = self.highlighted_ranges
+        range_ends = [end for start, end in ranges]
+        diff_ranges = self.get_diff_ranges()
+        diff_ends = [change[1] for change in diff_ranges]
+        proofread = self.proofread.get()
+        if proofread:
+            self.linter.update(text)
 
-        max_x = width
-        #原稿用紙風テーマに設定時のみ
-        if self.theme.get() == "原稿用紙風":
-            self.draw_genkou_yoshi_background(width, height, char_width, line_height , max_x, "#a52a2a")
+        for col in range(first, last):
+            col_tag = f"c{col}"
+            x = width - char_width - char_width * 1.5 * col
+            y = line_height * int(layout.first_rows[col])
+            start = int(layout.starts[col])
+            h = bisect.bisect_right(range_ends, start)
+            d = bisect.bisect_right(diff_ends, start)
+            findings = self.linter.query(start, layout.column_end(col)) if proofread else ()
+            for char_index in range(start, min(layout.column_end(col), len(text))):
+                char = text[char_index]
+                #注記の記号は描画しない
+                if char_index in hidden:
+                    if char_index in markup.page_breaks:
+                        canvas.create_line(x - char_width * 0.75, y - line_height/2, x - char_width * 0.75, height - line_height, fill=self.text_color, dash=(4, 4), tags=("pagebreak", "column", col_tag))
+                    continue
+                if char == "\n":
+                    continue
 
-        if self.theme.get() == "原稿用紙風-優しい":
-            self.draw_genkou_yoshi_background(width, height, char_width, line_height , max_x, "#a52a2a")
-        
-        self.kakko_stack.clear()
-        for char in self.text:
-            kakko_error_positions = []
-            if char == "「":
-                self.kakko_stack.append("」")
-            elif char == "『":
-                self.kakko_stack.append("』")
-            elif char == "（":
-                self.kakko_stack.append("）")
-            elif char == "【":
-                self.kakko_stack.append("】")
-            elif char == "《":
-                self.kakko_stack.append("》")
-            elif char == "[":
-                self.kakko_stack.append("]")
-            if char in "」』）】》]":
-                if len(self.kakko_stack) > 0 and self.kakko_stack[len(self.kakko_stack) - 1] == char:
-                    del self.kakko_stack[len(self.kakko_stack) - 1]
-                else:
-                    kakko_error_positions.append(char_index)
+                if char_index in kakko_error_positions:
+                    canvas.create_rectangle(
+                    x - char_width // 2, y, x + char_width // 2, y + line_height,
+                    fill="red",  # 赤色のマーカー
+                    outline="",
+                    tags=("kakko", "column", col_tag)
+                    )
 
-            if char_index in kakko_error_positions and self.check_kakko_mismatch.get():
-                self.canvas.create_rectangle(
-                x - char_width // 2, y, x + char_width // 2, y + line_height,
-                fill="red",  # 赤色のマーカー
-                outline=""
-                )
-            #原稿用紙風テーマ無限に線が引けるけど重くなる
-            # if self.theme.get() == "原稿用紙風":
-            #     self.draw_genkou_yoshi_background(width, height, char_width, line_height , max_x)
-            if char == "\n":
-                #if self.indent_on_newline.get() and last_char == ".":
-                #    self.text = self.text[:char_index + 1] + " " + self.text[char_index + 1:]
-                #y = line_height
-                #x -= char_width * 1.5
-                #char_index += 1
-                #continue
-                if char_index == self.caret_pos and char_index < len(self.text):
-                    caret_x = x
-                    caret_y = y
-                    self.canvas.create_line(caret_x - char_width // 2, caret_y -line_height/2 + 2, caret_x + char_width // 2, caret_y -line_height/2 + 2, fill=self.caret_color)
-                if self.auto_indent[count_return]: #機能がONかOFFか
-                    y = line_height*2
-                    x -= char_width * 1.5  
-                else:
-                    y = line_height
-                    x -= char_width * 1.5
-                char_index += 1
-                count_return += 1
-                continue
-            last_char = char
-            
+                offset_x = 0
+                offset_y = 0
+                angle = 0
 
-            offset_x = 0
-            offset_y = 0
-            angle = 0
+                if char in rotate_chars:
+                    angle = -90
+                    offset_x = char_width // 4
+                    offset_y = line_height // 4
+                elif char in "、。":
+                    offset_x = char_width // 2
+                    offset_y = -line_height // 4
 
-            if char in rotate_chars:
-                angle = -90
-                offset_x = char_width // 4
-                offset_y = line_height // 4
-            elif char in "、。":
-                offset_x = char_width // 2
-                offset_y = -line_height // 4
+                if char in "「『（［｛":
+                    offset_y = -line_height // 4
+                    offset_x = char_width // 4
+                elif char in "」』）］｝":
+                    offset_y = line_height // 4
+                    offset_x = -char_width // 4
 
-            if char in "「『（［｛":
-                offset_y = -line_height // 4
-                offset_x = char_width // 4
-            elif char in "」』）］｝":
-                offset_y = line_height // 4
-                offset_x = -char_width // 4
+                # 選択範囲のハイライト表示
+                if selection_start <= char_index < selection_end:
+                    canvas.create_rectangle(x - char_width // 2, y- line_height/2, x + char_width // 2, y + line_height/2, fill="lightblue", outline="", tags=("selection", "column", col_tag))
 
-            # 選択範囲のハイライト表示
-            if self.selected_text_start is not None and self.selected_text_end is not None:
-                if self.selected_text_start <= char_index < self.selected_text_end:
-                    self.canvas.create_rectangle(x - char_width // 2, y- line_height/2, x + char_width // 2, y + line_height/2, fill="lightblue", outline="")
+                #比較元との違い(重なりなし)
+                while d < len(diff_ranges) and diff_ranges[d][1] <= char_index:
+                    d += 1
+                if d < len(diff_ranges) and diff_ranges[d][0] <= char_index:
+                    canvas.create_rectangle(x - char_width // 2, y- line_height/2, x + char_width // 2, y + line_height/2, fill=RevisionDiff.COLORS[diff_ranges[d][2]], outline="", tags=("highlight", "column", col_tag))
 
-            for i, (start, end) in enumerate(self.highlighted_ranges):
-                if start <= char_index < end:
-                    if i == self.search_index and self.search_results:
-                        self.canvas.create_rectangle(x - char_width // 2, y- line_height/2, x + char_width // 2, y + line_height/2, fill="yellow", outline="")
-                    else:
-                        self.canvas.create_rectangle(x - char_width // 2, y- line_height/2, x + char_width // 2, y + line_height/2, fill="#ffee99", outline="")
-
-            self.canvas.create_text(
-                x + offset_x, y + offset_y,
-                text=char,
-                font=self.current_font,
-                anchor="center",
-                angle=angle,
-                fill=self.text_color, 
-            )
-
-            if char_index == self.caret_pos:
-                caret_x = x
-                caret_y = y
-                self.canvas.create_line(caret_x - char_width // 2, caret_y-line_height/2 + 2, caret_x + char_width // 2, caret_y - line_height / 2 + 2 , fill=self.caret_color)
+                #検索結果は位置順に並んでいるので、この文字に掛かるものだけを見る
+                while h < len(ranges) and ranges[h][1] <= char_index:
+                    h += 1
+                i = h
+                while i < len(ranges) and ranges[i][0] <= char_index:
+                    if char_index < ranges[i][1]:
+                        if i == self.search_index and self.search_results:
+                            canvas.create_rectangle(x - char_width // 2, y- line_height/2, x + char_width // 2, y + line_height/2, fill="yellow", outline="", tags=("highlight", "column", col_tag))
+                        else:
+                            canvas.create_rectangle(x - char_width // 2, y- line_height/2, x + char_width // 2, y + line_height/2, fill="#ffee99", outline="", tags=("highlight", "column", col_tag))
+                    i += 1
 
-            y += line_height
-            #if y > height - line_height:
-            #    self.text = self.text[:char_index] + "\n" + self.text[char_index:]
-            #    self.caret_pos += 1
-            #    return self.redraw()
-            if y > height - line_height:
-                y = line_height
-                x -= char_width * 1.5
-            max_x = min(max_x, x)
-            char_index += 1
+                canvas.create_text(
+                    x + offset_x, y + offset_y,
+                    text=char,
+                    font=self.current_font,
+                    anchor="center",
+                    angle=angle,
+                    fill=self.text_color,
+                    tags=("text", "column", col_tag),
+                )
 
-        if self.caret_pos == len(self.text):
-            caret_x = x
-            caret_y = y
-            self.canvas.create_line(caret_x - char_width // 2, caret_y -line_height/2 + 2, caret_x + char_width // 2, caret_y -line_height/2 + 2, fill=self.caret_color)
+                #校正の指摘は文字の左側に線を引く
+                for finding in findings:
+                    if finding[0] <= char_index < finding[1]:
+                        canvas.create_line(x - char_width * 0.6, y - line_height/2, x - char_width * 0.6, y + line_height/2, fill="red", tags=("lint", "column", col_tag))
+                        break
 
-        self.canvas.configure(scrollregion=(max_x - width*2, 0, width, self.canvas.bbox("all")[3]))
-        self.count_characters()
-    
+                #傍点
+                if char_index in markup.bouten:
+                    canvas.create_oval(x + char_width * 0.65 - 2, y - 2, x + char_width * 0.65 + 2, y + 2, fill=self.text_color, outline="", tags=("bouten", "column", col_tag))
+
+                #ルビは親文字の最初の文字の列に描く。親文字が次の列へ続くときは列の下端まで
+                if char_index in markup.ruby:
+                    ruby_end, ruby_text = markup.ruby[char_index]
+                    end_col, end_row = layout.row_of(ruby_end - 1)
+                    ruby_bottom = line_height * end_row + line_height / 2 if end_col == col else height - line_height / 2
+                    self.draw_ruby(canvas, x, y - line_height / 2, ruby_bottom, ruby_text, char_width, col_tag)
+
+                y += line_height
+
+
+    def draw_grid_layer(self, canvas):
+        #原稿用紙の罫線はテーマに罫線の色があるときだけ描き、文字より下に置く
+        grid_color = THEMES.get(self.theme.get(), THEMES["Light"])["grid"]
+        if grid_color:
+            width = canvas.winfo_width()
+            self.draw_genkou_yoshi_background(canvas, width, canvas.winfo_height(), self.current_font.measure("あ"), self.current_font.metrics("linespace"), width, grid_color)
+            canvas.tag_lower("grid")
 
-    def draw_genkou_yoshi_background(self, width, height, char_width, line_height , max_x,color):
+    def draw_genkou_yoshi_background(self, canvas_obj, width, height, char_width, line_height , max_x,color):
          # 罫線の間隔を計算
         char_width = self.current_font.measure("あ")
         vertical_line_spacing = self.current_font.measure("あ") * 1.5
@@ -443,14 +762,14 @@ class VerticalNotepad:
             left_limit = max_x * 10 - width*4
         while start_x > left_limit:
             # 1本目の縦線を描画
-            self.canvas.create_line(start_x - 1, 0, start_x - 1, height, fill=line_color)
+            canvas_obj.create_line(start_x - 1, 0, start_x - 1, height, fill=line_color, tags="grid")
             # 2本目の縦線を描画
-            self.canvas.create_line(start_x + 1, 0, start_x + 1, height, fill=line_color)
+            canvas_obj.create_line(start_x + 1, 0, start_x + 1, height, fill=line_color, tags="grid")
             start_x -= vertical_line_spacing
         # 横線を描画
         start_y = line_height/2
         while start_y < height :
-            self.canvas.create_line(left_limit, start_y, width, start_y, fill=line_color, dash=(2, 2))
+            canvas_obj.create_line(left_limit, start_y, width, start_y, fill=line_color, dash=(2, 2), tags="grid")
             start_y += line_height
 
 
@@ -458,7 +777,7 @@ class VerticalNotepad:
         # 罫線の間隔を計算
         vertical_line_spacing = char_width * 1.5
         # 罫線の色
-        line_color =  colors.HexColor("#a52a2a")
+        line_color = color
         ## 縦線を描画
         start_x = width
         if max_x >= 0:
@@ -492,6 +811,7 @@ class VerticalNotepad:
 
 
     def on_key_press(self, event):
+        self.record_event("key", event.keysym, event.char)
         if event.keysym in ("Left", "Right", "Up", "Down"):
             self.move_caret(event.keysym)
         elif event.keysym == "Return":
@@ -607,120 +927,70 @@ class VerticalNotepad:
     def get_caret_coords(self, pos):
         line_height = self.current_font.metrics("linespace")
         char_width = self.current_font.measure("あ")
-        x = self.canvas.winfo_width() - char_width
-        y = line_height
-        char_index = 0
-        count_return_get_char = 0
-        for char in self.text:
-            if char_index == pos:
-                return x, y
-            if char == "\n":
-                if self.auto_indent[count_return_get_char]:
-                    y = line_height * 2
-                    x -= char_width * 1.5
-                else:
-                    y = line_height
-                    x -= char_width * 1.5
-            else:
-                y += line_height
-                if y > self.canvas.winfo_height() - line_height:
-                    y = line_height
-                    x -= char_width * 1.5
-            char_index += 1
-        return x, y
+        col, row = self.get_layout().row_of(pos)
+        return self.canvas.winfo_width() - char_width - char_width * 1.5 * col, line_height * row
 
     def on_mouse_click(self, event):
+        self.record_event("click", event.x, event.y)
         self.key_pressed = True
-        self.drag_start_pos = self.mouse_get_char_index_from_coords(event.x, event.y)
+        #スクロールしていてもキャンバス上の座標で文字を探す
+        self.drag_start_pos = self.mouse_get_char_index_from_coords(self.canvas.canvasx(event.x), self.canvas.canvasy(event.y))
         self.caret_pos = self.drag_start_pos
         self.selected_text_start = self.caret_pos
         self.selected_text_end = self.caret_pos
         self.redraw()
 
     def on_mouse_drag(self, event):
+        self.record_event("drag", event.x, event.y)
         if self.drag_start_pos is not None:
-            current_pos = self.mouse_get_char_index_from_coords(event.x, event.y)
+            current_pos = self.mouse_get_char_index_from_coords(self.canvas.canvasx(event.x), self.canvas.canvasy(event.y))
             self.caret_pos = current_pos
             self.selected_text_start = min(self.drag_start_pos, current_pos)
             self.selected_text_end = max(self.drag_start_pos, current_pos)
             self.redraw()
 
     def on_mouse_release(self, event):
+        self.record_event("release")
         self.drag_start_pos = None
 
     def on_mousewheel(self, event):
+        self.record_event("wheel", event.delta)
         if event.delta:
-            self.canvas.xview_scroll(int(-1 * (event.delta / 120)), "units")
+            event.widget.xview_scroll(int(-1 * (event.delta / 120)), "units")
 
     def get_char_index_from_coords(self, x, y):
         line_height = self.current_font.metrics("linespace")
         char_width = self.current_font.measure("あ")
-        start_x = self.canvas.winfo_width() - char_width
-        start_y = line_height
-        char_index = 0
+        #座標が列・段にぴったり合うときだけ、その位置を返す
+        col = round((self.canvas.winfo_width() - char_width - x) / (char_width * 1.5))
+        row = round(y / line_height)
+        if abs(self.canvas.winfo_width() - char_width - char_width * 1.5 * col - x) > 1e-6 or abs(row * line_height - y) > 1e-6:
+            return len(self.text)
+        pos = self.get_layout().index_at(col, row)
+        return len(self.text) if pos is None else pos
 
-        count_return_get_char = 0
-
-        for char in self.text:
-            #if x >= start_x - char_width // 2 and x <= start_x + char_width // 2 and y >= start_y and y <= start_y + line_height:
-            if start_x == x and start_y == y:
-                return char_index
-            if char == "\n":
-                if self.auto_indent[count_return_get_char]:
-                    start_y = line_height * 2
-                    start_x -= char_width * 1.5
-                else:
-                    start_y = line_height
-                    start_x -= char_width * 1.5
-            else:
-                start_y += line_height
-                if start_y > self.canvas.winfo_height() - line_height:
-                    start_y = line_height
-                    start_x -= char_width * 1.5
-            char_index += 1
-        return len(self.text)
-    
     def mouse_get_char_index_from_coords(self, x, y):
+        #xから一番近い列、yから段を求め、列の索引で文字を引く(全文は走査しない)
         line_height = self.current_font.metrics("linespace")
         char_width = self.current_font.measure("あ")
-        height=self.canvas.winfo_height()
-        start_x = self.canvas.winfo_width() - char_width
-        start_y = line_height
-        char_index = 0
-
-        count_return_get_char = 0
-
-        for char in self.text:
-            if x >= start_x - char_width // 2 and x <= start_x + char_width // 2 and y >= start_y-line_height and y <= start_y :
-            # if start_x == x and start_y == y:
-                return char_index
-            # if x >= start_x - char_width // 2 and x <= start_x + char_width // 2 and y >= height-line_height and y <= height:
-            #     return char_index
-            if char == "\n":
-                if self.auto_indent[count_return_get_char]:
-                    start_y = line_height * 2
-                    start_x -= char_width * 1.5
-                else:
-                    start_y = line_height
-                    start_x -= char_width * 1.5
-            else:
-                start_y += line_height
-                if start_y > self.canvas.winfo_height() - line_height:
-                    start_y = line_height
-                    start_x -= char_width * 1.5
-            char_index += 1
-
-            # 最後の行をクリックした場合、次の行の先頭の文字のインデックスを返す
-            if x >= start_x+char_width*1.5 - char_width // 2 and x <= start_x +char_width*1.5+ char_width // 2 and y >= height - last_y and y <= height:
-                return char_index
-            last_y = start_y
-
-        return len(self.text)
+        layout = self.get_layout()
+        col = round((self.canvas.winfo_width() - char_width - x) / (char_width * 1.5))
+        col = max(0, min(col, layout.column_count() - 1))
+        #文字は段rowの下端(y = line_height * row)に置かれている
+        row = max(1, math.ceil(y / line_height))
+        pos = layout.index_at(col, row)
+        if pos is not None:
+            return pos
+        if row < int(layout.first_rows[col]):
+            return int(layout.starts[col])
+        #列の最後の文字より下なら、その列の終わり(段落の終わりなら改行の前)
+        return min(layout.column_end(col) - 1, len(self.text))
 
     def search_text(self):
         #search_term = simpledialog.askstring("検索", "検索文字列を入力してください (正規表現可):")
         def on_search_change(name, index, mode):
             self.search_term = search_var.get()
+            self.record_event("search", self.search_term)
             self.perform_search()
             update_search_status()
 
@@ -728,42 +998,22 @@ class VerticalNotepad:
             self.replace_term = replace_var.get()
 
         def on_search_window_destroy(event):
-            self.highlighted_ranges = []
-            self.redraw()
-            self.search_window_open = False
+            self.set_search_window_open(False)
         def next_search_result():
-            if self.search_results:
-                self.search_index = (self.search_index + 1) % len(self.search_results)
-                self.caret_pos = self.search_results[self.search_index]
-                self.redraw()
-                update_search_status()
+            self.step_search_result(1)
+            update_search_status()
 
         def prev_search_result():
-            if self.search_results:
-                self.search_index = (self.search_index - 1) % len(self.search_results)
-                self.caret_pos = self.search_results[self.search_index]
-                self.redraw()
-                update_search_status()
+            self.step_search_result(-1)
+            update_search_status()
         
         def replace_current():
-            if self.search_term and self.replace_term and self.search_results:
-                start = self.search_results[self.search_index]
-                end = start + len(re.search(self.search_term, self.text[start:]).group())
-                self.text = self.text[:start] + self.replace_term + self.text[end:]
-                self.caret_pos = start + len(self.replace_term)
-                self.redraw()
-                self.perform_search()
-                update_search_status()
+            self.replace_current_match()
+            update_search_status()
 
         def replace_all():
-            if self.search_term and self.replace_term:
-                try:
-                    self.text, replace_count = re.subn(self.search_term, self.replace_term, self.text)
-                    self.redraw()
-                    self.perform_search()
-                    update_search_status()
-                except re.error as e:
-                    messagebox.showerror("正規表現エラー", f"無効な正規表現です: {e}")
+            self.replace_all_matches()
+            update_search_status()
 
         def update_search_status():
             if self.search_results:
@@ -804,22 +1054,139 @@ class VerticalNotepad:
         replace_all_button = tk.Button(button_frame, text="全置換", command=replace_all)
         replace_all_button.pack(side=tk.LEFT)
 
-        self.search_window_open = True
+        self.set_search_window_open(True)
         search_window.bind("<Destroy>", on_search_window_destroy)
     
+    def set_search_window_open(self, is_open):
+        #検索窓が開いている間はキー入力ごとに検索し直すので、再生でも同じ状態にする
+        self.record_event("search_window", is_open)
+        if is_open:
+            self.search_window_open = True
+            #検索窓を開いている間に裏でインデックスを作っておく
+            if self.use_search_index.get() and not self.ngram_index.building:
+                if self.ngram_index.ready:
+                    self.ngram_index.update(self.text)
+                else:
+                    self.ngram_index.build_async(self.text)
+        else:
+            self.highlighted_ranges = []
+            self.redraw()
+            self.search_window_open = False
+
+    def step_search_result(self, step):
+        if self.search_results:
+            self.record_event("search_step", step)
+            self.search_index = (self.search_index + step) % len(self.search_results)
+            self.caret_pos = self.search_results[self.search_index]
+            self.redraw()
+
+    def replace_current_match(self):
+        if self.search_term and self.replace_term and self.search_results:
+            self.record_event("replace", self.replace_term)
+            start, end = self.highlighted_ranges[self.search_index]
+            self.apply_edits([(start, end, self.replace_term)], start + len(self.replace_term))
+
+    def replace_all_matches(self):
+        if self.search_term and self.replace_term:
+            self.record_event("replace_all", self.replace_term)
+            try:
+                #re.subnと同じ置換結果を、一致ごとの置き換えとしてまとめて適用する
+                edits = [(m.start(), m.end(), m.expand(self.replace_term)) for m in re.finditer(self.search_term, self.text)]
+            except re.error as e:
+                messagebox.showerror("正規表現エラー", f"無効な正規表現です: {e}")
+                return
+            self.apply_edits(edits)
+
+    def apply_edits(self, edits, caret_pos=None):
+        #重ならない置き換え[(開始, 終了, 文字列), ...](開始位置の順)をまとめて1回の編集として適用する
+        #本文・改行ごとの字下げ・各ビューのキャレットと選択範囲・検索結果を1度の走査で合わせ、描き直しは最後に1回だけ
+        if not edits:
+            return
+        text = self.text
+        old_indent = self.auto_indent
+        flag = self.indent_on_newline.get()
+        pieces = []
+        auto_indent = []
+        starts, ends, new_starts, deltas = [], [], [], []
+        pos = newline = delta = 0
+
+        def keep(count):
+            #変わらない範囲の改行は字下げをそのまま引き継ぐ(足りなければ字下げなしで補う)
+            flags = old_indent[newline:newline + count]
+            auto_indent.extend(flags)
+            auto_indent.extend([False] * (count - len(flags)))
+
+        for start, end, replacement in edits:
+            gap = text.count("\n", pos, start)
+            keep(gap)
+            #挿入した改行はEnterキーと同じ設定で字下げする
+            auto_indent.extend([flag] * replacement.count("\n"))
+            newline += gap + text.count("\n", start, end)
+            pieces.append(text[pos:start])
+            pieces.append(replacement)
+            starts.append(start)
+            ends.append(end)
+            new_starts.append(start + delta)
+            delta += len(replacement) - (end - start)
+            deltas.append(delta)
+            pos = end
+        keep(text.count("\n", pos))
+        pieces.append(text[pos:])
+        new_text = "".join(pieces)
+
+        def shift(p):
+            #置き換えた範囲の中の位置は置き換え後の文字列の直後に寄せる
+            if p is None:
+                return None
+            k = bisect.bisect_left(starts, p) - 1
+            if k < 0:
+                return p
+            if p < ends[k]:
+                return new_starts[k] + len(edits[k][2])
+            return p + deltas[k]
+
+        for view in self.views:
+            view.sync_text()
+            view.caret_pos = shift(view.caret_pos)
+            view.selected_text_start = shift(view.selected_text_start)
+            view.selected_text_end = shift(view.selected_text_end)
+            view.drag_start_pos = shift(view.drag_start_pos)
+            view.text = new_text
+        self.text = new_text
+        self.auto_indent = auto_indent
+        if caret_pos is not None:
+            self.caret_pos = caret_pos
+
+        if self.search_window_open and self.search_term:
+            try:
+                ranges = self.find_matches(self.search_term)
+            except re.error:
+                ranges = []
+        else:
+            #置き換えに触れなかったハイライトだけを残してずらす
+            ranges = []
+            for start, end in self.highlighted_ranges:
+                k = bisect.bisect_right(ends, start)
+                if k < len(starts) and starts[k] < end:
+                    continue
+                d = deltas[k - 1] if k else 0
+                ranges.append((start + d, end + d))
+        self.highlighted_ranges = ranges
+        self.search_results = [start for start, end in ranges]
+        self.search_index = bisect.bisect_left(self.search_results, self.caret_pos) % len(self.search_results) if self.search_results else 0
+        self.redraw()
+
     def perform_search(self):
         if self.search_term:
             try:
-                self.search_results = [m.start() for m in re.finditer(self.search_term, self.text)]
+                self.highlighted_ranges = self.find_matches(self.search_term)
+                self.search_results = [start for start, end in self.highlighted_ranges]
                 self.search_index = 0
-                self.highlighted_ranges = []
                 if self.search_results:
                     if not self.key_pressed:
                         self.caret_pos = self.search_results[0]
                     else:
                         self.key_pressed = False
-                    for start_pos in self.search_results:
-                        self.highlighted_ranges.append((start_pos, start_pos + len(re.search(self.search_term, self.text[start_pos:]).group())))
                     self.redraw()
                 else:
                     self.highlighted_ranges = []
@@ -831,6 +1198,28 @@ class VerticalNotepad:
             self.highlighted_ranges = []
             self.redraw()
 
+    def find_matches(self, pattern):
+        #正規表現の記号を含まない検索語はインデックスかstr.findで探し、それ以外は正規表現で全文を走査する
+        if REGEX_META.search(pattern):
+            return [(m.start(), m.end()) for m in re.finditer(pattern, self.text)]
+        starts = None
+        if self.use_search_index.get():
+            self.ngram_index.update(self.text)
+            starts = self.ngram_index.query(pattern)
+        if starts is None:
+            starts = []
+            pos = self.text.find(pattern)
+            while pos != -1:
+                starts.append(pos)
+                pos = self.text.find(pattern, pos + len(pattern))
+        return [(start, start + len(pattern)) for start in starts]
+
+    def on_search_index_change(self):
+        if self.use_search_index.get():
+            self.ngram_index.build_async(self.text)
+        else:
+            self.ngram_index = NgramIndex()
+
     def export_to_pdf(self):
                 # フォントを登録
         font_path = f"C:/TaTeX/LINESeedJP_A_TTF_Rg.ttf"
@@ -849,165 +1238,161 @@ class VerticalNotepad:
                                                filetypes=[("PDF files", "*.pdf"), ("All files", "*.*")])
         if file_path:
             c = canvas.Canvas(file_path, pagesize=A4)
-            width, height = A4
-            line_height = self.current_font.metrics("linespace")
-            char_width = self.current_font.measure("あ")
-            x = width-char_width 
-            y = height 
-            char_index = 0
-            count_return = 0
-            rotate_chars = "「『（【《」』）】》―ー"
-            page_char_count = 0
-
-            # def set_pdf_font(canvas_obj, font_family, font_size):
-            #         font_path = self.current_font.actual().get("file")
-            #         if font_path and os.path.exists(font_path):
-            #             try:
-            #                 pdfmetrics.registerFont(TTFont(font_family, font_path))
-            #                 canvas_obj.setFont(font_family, font_size)
-            #                 return
-            #             except Exception as e:
-            #                 print(f"Error registering font: {e}")
-            #         canvas_obj.setFont("Helvetica", font_size)
-            #         print(f"Using default font (Helvetica) for {font_family}")
-            # set_pdf_font(c, self.current_font.actual()["family"], self.current_font.actual()["size"])
-
-            # 背景色と文字の色を設定
-            background_color = colors.white  # デフォルトの背景色
-            text_color = colors.black  # デフォルトの文字色
-            c.setFont('BIZ', self.current_font.actual()["size"] )
-
-            if self.theme.get() == "Dark":
-                background_color = colors.gray12
-                text_color = colors.white
-            elif self.theme.get() == "優しい":
-                background_color = colors.ivory
-                text_color = colors.gray
-            elif self.theme.get() == "原稿用紙風":
-                background_color = colors.HexColor("#f8f8f8")
-                text_color = colors.black
-            elif self.theme.get() == "原稿用紙風-優しい":
-                background_color = colors.ivory
-                text_color = colors.black
-            elif self.theme.get() == "Matrix":
-                background_color = colors.black
-                text_color =  colors.HexColor("#00FF00")           
-
-
-            # 背景色を設定
-            c.setFillColor(background_color)
-            c.rect(0, 0, width, height, fill=1)
-            if self.theme.get() in ["原稿用紙風", "原稿用紙風-優しい"]:
-                self.pdf_draw_genkou_yoshi_background(c, width, height, char_width, line_height, width, colors.red)
-
-            count_return_pdf = 0
-            for char in self.text:
-                if char_index == 0:
-                    y = height - line_height
-                if char == "\n":
-                    if self.auto_indent[count_return_pdf]: #機能がONかOFFか
-                        y = height - line_height*2
-                        x -= char_width * 1.5
-                        char_index += 1    
-                    else:
-                        y = height - line_height
-                        x -= char_width * 1.5
-                        char_index += 1
-                    count_return_pdf += 1
-                    continue
-                #if char == "\n":
-                #    #y = height-line_height 
-                #    y = line_height
-                #    x -= char_width
-                #    char_index += 1   
-                #    continue
+            model = self.make_pdf_page_model()
+            background_color, text_color = self.get_pdf_theme_colors()
+            for page_number, page_ops in enumerate(model.iter_pages()):
+                if page_number > 0:
+                    c.showPage()  # 新しいページを作成
+                self.render_pdf_page(c, page_ops, model, background_color, text_color)
+            c.save()
+            messagebox.showinfo("PDF出力", "PDFファイルを出力しました。")
 
-                offset_x = 0
-                offset_y = 0
-                angle = 0
-                if char in rotate_chars:
-                    angle=-90
-                    offset_x = char_width//4
-                    offset_y = line_height//4 
-                elif char in "、。":
-                    offset_x = char_width // 2
-                    offset_y = -line_height // 4
-                elif char in "「『（［｛":
-                    offset_y = -line_height // 4
-                elif char in "」』）］｝":
-                    offset_y = line_height // 4
+    def make_pdf_page_model(self):
+        model = PdfPageModel(A4, self.current_font.measure("あ"), self.current_font.metrics("linespace"), self.current_font.actual()["size"])
+        model.update(self.text, self.auto_indent, self.get_markup())
+        return model
 
-                offset_x *= mm
-                offset_y *= mm
+    def get_pdf_theme_colors(self):
+        # 背景色と文字の色を設定
+        theme = THEMES.get(self.theme.get(), THEMES["Light"])
+        return colors.HexColor(theme["pdf_background"]), colors.HexColor(theme["pdf_text"])
 
-                y -= line_height 
-                if y < 0 :
-                    y = height-line_height * 2
-                    x -= char_width * 1.5 
-                x -= char_width
-                if x < 0:
-                    c.showPage()  # 新しいページを作成
-                    # set_pdf_font(c, self.current_font.actual()["family"], self.current_font.actual()["size"])
-                    c.setFillColor(background_color)
-                    c.setFillColor(background_color)
-                    c.rect(0, 0, width, height, fill=1)
-                    if self.theme.get() in ["原稿用紙風", "原稿用紙風-優しい"]:
-                        self.pdf_draw_genkou_yoshi_background(c, width, height, char_width, line_height, width, colors.red)
-                    x = width - char_width  # x座標を右端に戻す
-                    y = height - line_height * 2 #y座標を初期化
-                else:
-                    x += char_width
+    def render_pdf_page(self, c, page_ops, model, background_color, text_color):
+        #PdfPageModelの1ページ分をPDF(またはプレビュー用のキャンバス)に描く
+        width, height = model.width, model.height
+        # 背景色を設定
+        c.setFillColor(background_color)
+        c.rect(0, 0, width, height, fill=1)
+        grid_color = THEMES.get(self.theme.get(), THEMES["Light"])["pdf_grid"]
+        if grid_color:
+            self.pdf_draw_genkou_yoshi_background(c, width, height, model.char_width, model.line_height, width, colors.HexColor(grid_color))
+        c.setFont('BIZ', model.font_size)
+        for op in page_ops:
+            if op[0] == "char":
+                _, char, x, y, angle = op
                 c.saveState()
-                c.translate(x + offset_x, y + offset_y)
+                c.translate(x, y)
                 c.rotate(angle)
-                c.setFillColor(text_color) 
+                c.setFillColor(text_color)
                 c.drawString(0, 0, char)
                 c.restoreState()
+            elif op[0] == "dot":
+                #傍点
+                c.setFillColor(text_color)
+                c.circle(op[1], op[2], 1.2, stroke=0, fill=1)
+            elif op[0] == "ruby":
+                c.setFont('BIZ', model.ruby_size)
+                c.setFillColor(text_color)
+                c.drawString(op[1], op[2], op[3])
+                c.setFont('BIZ', model.font_size)
 
-                
-                char_index+=1
-                page_char_count += 1
+    def open_print_preview(self):
+        PrintPreview(self.root, self)
 
+    def export_to_epub(self):
+        file_path = filedialog.asksaveasfilename(defaultextension=".epub",
+                                               filetypes=[("EPUB files", "*.epub"), ("All files", "*.*")])
+        if file_path:
+            title = os.path.splitext(os.path.basename(file_path))[0]
+            try:
+                chapter_count = EpubWriter(file_path, title).write(self.iter_epub_paragraphs())
+            except Exception as e:
+                messagebox.showerror("エラー", f"EPUB出力中にエラーが発生しました:\n{e}")
+                return
+            messagebox.showinfo("EPUB出力", f"EPUBファイルを出力しました。({chapter_count}ファイル)")
 
-            c.save()
-            messagebox.showinfo("PDF出力", "PDFファイルを出力しました。")
+    def iter_epub_paragraphs(self):
+        #段落ごとにXHTMLの行を返す。章見出しと改ページ注記ではファイルを分ける
+        heading = self.heading_index.regex
+        markup = self.get_markup()
+        for paragraph_index, (offset, para) in enumerate(iter_paragraphs(self.text)):
+            #直前の改行の自動字下げをそのまま段落の字下げにする
+            indent = paragraph_index > 0 and paragraph_index - 1 < len(self.auto_indent) and self.auto_indent[paragraph_index - 1]
+            parsed = markup.paragraph(offset)
+            body = self.paragraph_to_xhtml(para, parsed)
+            if parsed[3]:
+                yield ("page", None)
+                if not body:
+                    continue
+            if heading.match(para):
+                yield ("chapter", unescape(re.sub(r"<[^>]+>", "", re.sub(r"<rt>.*?</rt>", "", body))).strip())
+                yield ("line", f"<h2>{body}</h2>")
+            elif not body:
+                yield ("line", "<p><br/></p>")
+            elif indent:
+                yield ("line", f'<p class="indent">{body}</p>')
+            else:
+                yield ("line", f"<p>{body}</p>")
+
+    def paragraph_to_xhtml(self, para, parsed):
+        hidden_ranges, ruby, bouten, page_breaks = parsed
+        if parsed is AozoraParser.EMPTY:
+            return escape(para)
+        hidden = set()
+        for start, end in hidden_ranges:
+            hidden.update(range(start, end))
+        ruby_starts = {start: (end, ruby_text) for start, end, ruby_text in ruby}
+        bouten_chars = set()
+        for start, end in bouten:
+            bouten_chars.update(range(start, end))
+        parts = []
+        ruby_end = None
+        for i, char in enumerate(para):
+            if i in hidden:
+                continue
+            if i in ruby_starts:
+                ruby_end, ruby_text = ruby_starts[i]
+                parts.append("<ruby>")
+            piece = escape(char)
+            if i in bouten_chars:
+                piece = f'<em class="sesame">{piece}</em>'
+            parts.append(piece)
+            if ruby_end is not None and i == ruby_end - 1:
+                parts.append(f"<rt>{escape(ruby_text)}</rt></ruby>")
+                ruby_end = None
+        return "".join(parts)
 
     def copy_text(self):
+        self.record_event("copy")
         if self.selected_text_start is not None and self.selected_text_end is not None:
             selected_text = self.text[self.selected_text_start:self.selected_text_end]
             self.root.clipboard_clear()
             self.root.clipboard_append(selected_text)
     
     def cut_text(self):
+        self.record_event("cut")
         if self.selected_text_start is not None and self.selected_text_end is not None:
-            selected_text = self.text[self.selected_text_start:self.selected_text_end]
+            start, end = self.selected_text_start, self.selected_text_end
             self.root.clipboard_clear()
-            self.root.clipboard_append(selected_text)
-            self.text = self.text[:self.selected_text_start] + self.text[self.selected_text_end:]
-            self.caret_pos = self.selected_text_start
+            self.root.clipboard_append(self.text[start:end])
             self.selected_text_start = None
             self.selected_text_end = None
-            self.redraw()
+            self.apply_edits([(start, end, "")], start)
 
     def paste_text(self):
         pasted_text = self.root.clipboard_get()
-        self.text = self.text[:self.caret_pos] + pasted_text + self.text[self.caret_pos:]
-        self.caret_pos += len(pasted_text)
-        self.redraw()
+        #再生するときにクリップボードの中身が違っても同じ結果になるよう、貼り付けた文字列ごと記録する
+        self.record_event("paste", pasted_text)
+        self.apply_edits([(self.caret_pos, self.caret_pos, pasted_text)], self.caret_pos + len(pasted_text))
 
 class FontDialog(tk.Toplevel):
-    def __init__(self, parent, current_font, apply_callback):
+    PREVIEW_WIDTH = 220
+    PREVIEW_HEIGHT = 260
+
+    def __init__(self, parent, current_font, apply_callback, catalog):
         super().__init__(parent)
         self.title("フォント選択")
         self.transient(parent)
         self.result = None
         self.apply_callback = apply_callback
+        self.catalog = catalog
+        self.preview_fonts = {}
 
         tk.Label(self, text="フォント:").grid(row=0, column=0, padx=5, pady=5)
         self.font_var = tk.StringVar(value=current_font.actual()["family"])
 
-        # フォントリストから"@"が付いているフォントを除外
-        font_names = [f for f in font.families() if not f.startswith("@")]
+        # フォントリストから"@"が付いているフォントを除外(一覧はFontCatalogのキャッシュを使う)
+        font_names = catalog.get_families()
         self.font_combo = ttk.Combobox(self, textvariable=self.font_var, values=font_names)
         self.font_combo.grid(row=0, column=1, padx=5, pady=5)
 
@@ -1016,12 +1401,51 @@ class FontDialog(tk.Toplevel):
         self.size_combo = ttk.Combobox(self, textvariable=self.size_var, values=[12, 14, 16, 18, 20, 24, 28, 32])
         self.size_combo.grid(row=1, column=1, padx=5, pady=5)
 
+        #縦書きの見本(本文には触らない)
+        self.preview = tk.Canvas(self, width=self.PREVIEW_WIDTH, height=self.PREVIEW_HEIGHT, bg="white")
+        self.preview.grid(row=0, column=2, rowspan=3, padx=5, pady=5)
+        self.font_var.trace_add("write", lambda *args: self.update_preview())
+        self.size_var.trace_add("write", lambda *args: self.update_preview())
+
         tk.Button(self, text="OK", command=self.on_ok).grid(row=2, column=0, pady=10)
         tk.Button(self, text="キャンセル", command=self.destroy).grid(row=2, column=1, pady=10)
+        tk.Button(self, text="フォント一覧を再読み込み", command=self.reload_fonts).grid(row=3, column=0, columnspan=2, pady=5)
 
+        self.update_preview()
         self.grab_set()
         self.geometry(f"+{parent.winfo_x() + 50}+{parent.winfo_y() + 50}")
 
+    def reload_fonts(self):
+        #起動後に追加・削除したフォントを一覧に反映する
+        self.catalog.refresh()
+        self.font_combo.config(values=self.catalog.families)
+
+    def update_preview(self):
+        try:
+            family = self.font_var.get()
+            size = int(self.size_var.get())
+        except (tk.TclError, ValueError):
+            return
+        if not family or size <= 0:
+            return
+        self.preview.delete("all")
+        #寸法はカタログに測ってあるものを使い、描くためのフォントだけ作る
+        line_height, char_width = self.catalog.scaled_metrics(family, size)
+        if (family, size) not in self.preview_fonts:
+            self.preview_fonts[(family, size)] = font.Font(family=family, size=size)
+        preview_font = self.preview_fonts[(family, size)]
+        x = self.PREVIEW_WIDTH - char_width
+        y = line_height
+        for char in FontCatalog.SAMPLE:
+            if char == "\n" or y > self.PREVIEW_HEIGHT - line_height:
+                x -= char_width * 1.5
+                y = line_height
+                if char == "\n":
+                    continue
+            angle = -90 if char in "「『（【《」』）】》―ー" else 0
+            self.preview.create_text(x, y, text=char, font=preview_font, anchor="center", angle=angle)
+            y += line_height
+
     def on_ok(self):
         selected_font = self.font_var.get()
         selected_size = self.size_var.get()
@@ -1055,7 +1479,3092 @@ class ThemeDialog(tk.Toplevel):
         self.apply_callback(selected_theme)
         self.destroy()
 
+def common_prefix_length(a, b):
+    #先頭から一致している長さ。スライスの比較を二分探索するので、比較自体はC側で済む
+    low, high = 0, min(len(a), len(b))
+    if a[:high] == b[:high]:
+        return high
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[low:mid] == b[low:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+def common_suffix_length(a, b, limit=None):
+    #末尾から一致している長さ(limitを超えない)
+    high = min(len(a), len(b))
+    if limit is not None:
+        high = min(high, limit)
+    end_a, end_b = len(a), len(b)
+    if a[end_a - high:] == b[end_b - high:]:
+        return high
+    low = 0
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[end_a - mid:end_a - low] == b[end_b - mid:end_b - low]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+def sniff_encoding(sample):
+    #先頭の一部から文字コードを推定する(BOM → ISO-2022-JP → UTF-8 → CP932/EUC-JPで不正なバイトが少ない方)
+    for bom, encoding in ((codecs.BOM_UTF8, "utf-8-sig"), (codecs.BOM_UTF16_LE, "utf-16"), (codecs.BOM_UTF16_BE, "utf-16")):
+        if sample.startswith(bom):
+            return encoding
+    #ISO-2022-JPは7ビットなのでUTF-8より先に見る
+    if b"\x1b$B" in sample or b"\x1b$@" in sample:
+        return "iso2022_jp"
+    try:
+        #サンプルの末尾で文字が切れていてもよいように、インクリメンタルに試す
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        pass
+    best = None
+    for encoding in ("cp932", "euc_jp"):
+        decoded = codecs.getincrementaldecoder(encoding)(errors="replace").decode(sample, final=False)
+        errors = decoded.count("\ufffd")
+        if best is None or errors < best[0]:
+            best = (errors, encoding)
+    return best[1]
+
+def read_text_stream(file_path, chunk_size=1024 * 1024, sample_size=64 * 1024):
+    #(テキスト, 文字コード, 内容のハッシュ)を返す。文字コードは先頭から推定し、
+    #途中で推定が外れてデコードできなくなったら、ほかの日本語の文字コードで最初から読み直す
+    with open(file_path, "rb") as f:
+        encoding = sniff_encoding(f.read(sample_size))
+    candidates = [encoding]
+    if encoding in ("utf-8", "cp932", "euc_jp"):
+        candidates += [fallback for fallback in ("cp932", "euc_jp") if fallback != encoding]
+    for encoding in candidates:
+        try:
+            text, file_hash = decode_text_stream(file_path, encoding, chunk_size)
+            return text, encoding, file_hash
+        except UnicodeDecodeError as e:
+            error = e
+    raise error
+
+def decode_text_stream(file_path, encoding, chunk_size):
+    #チャンクごとにハッシュ・デコード・改行の正規化(CRLF/CR→LF)を1回で済ませる
+    #ファイル全体のバイト列は持たないので、メモリに載るのはデコード後のテキストだけ
+    #デコードできないバイトは置き換えずにUnicodeDecodeErrorにする(壊れた文字を保存しないため)
+    hasher = hashlib.sha1()
+    pieces = []
+    pending_cr = False
+    decoder = codecs.getincrementaldecoder(encoding)()
+    with open(file_path, "rb") as f:
+        chunk = f.read(chunk_size)
+        while True:
+            final = not chunk
+            hasher.update(chunk)
+            piece = decoder.decode(chunk, final=final)
+            if pending_cr:
+                piece = "\r" + piece
+            #チャンクの境目でCRLFが分かれることがあるので、末尾のCRは次に回す
+            pending_cr = piece.endswith("\r") and not final
+            if pending_cr:
+                piece = piece[:-1]
+            if "\r" in piece:
+                piece = piece.replace("\r\n", "\n").replace("\r", "\n")
+            if piece:
+                pieces.append(piece)
+            if final:
+                break
+            chunk = f.read(chunk_size)
+    return "".join(pieces), hasher.hexdigest()
+
+def iter_paragraphs(text):
+    #段落(改行区切り)を先頭位置つきで順に返す。全体をsplitしないので大きな文書でもコピーが増えない
+    start = 0
+    while True:
+        end = text.find("\n", start)
+        if end == -1:
+            yield start, text[start:]
+            return
+        yield start, text[start:end]
+        start = end + 1
+
+class DiffCancelled(Exception):
+    pass
+
+#中央のスネークを探す手数の上限。超えたらその範囲は丸ごと"replace"にする(共通部分の少ない大きな入力で2乗の時間がかかるため)
+DIFF_MAX_COST = 1000
+
+def diff_sequences(a, b, should_stop=None, max_cost=DIFF_MAX_COST):
+    #線形空間のMyers法でaをbにする編集を求める。[(種類, i1, i2, j1, j2)] 種類は"delete"/"insert"/"replace"
+    edits = []
+    diff_range(a, 0, len(a), b, 0, len(b), edits, should_stop, max_cost)
+    merged = []
+    for i1, i2, j1, j2 in edits:
+        if merged and merged[-1][1] == i1 and merged[-1][3] == j1:
+            merged[-1] = (merged[-1][0], i2, merged[-1][2], j2)
+        else:
+            merged.append((i1, i2, j1, j2))
+    return [("insert" if i1 == i2 else "delete" if j1 == j2 else "replace", i1, i2, j1, j2) for i1, i2, j1, j2 in merged]
+
+def diff_range(a, a0, a1, b, b0, b1, edits, should_stop, max_cost):
+    #共通の先頭と末尾を除き、残りを中央のスネークで2つに分けて再帰する
+    while a0 < a1 and b0 < b1 and a[a0] == b[b0]:
+        a0 += 1
+        b0 += 1
+    while a0 < a1 and b0 < b1 and a[a1 - 1] == b[b1 - 1]:
+        a1 -= 1
+        b1 -= 1
+    if a0 == a1 or b0 == b1:
+        if a0 < a1 or b0 < b1:
+            edits.append((a0, a1, b0, b1))
+        return
+    split = middle_snake(a, a0, a1, b, b0, b1, should_stop, max_cost)
+    if split is None or split in ((a0, b0), (a1, b1)):
+        edits.append((a0, a1, b0, b1))
+        return
+    x, y = split
+    diff_range(a, a0, x, b, b0, y, edits, should_stop, max_cost)
+    diff_range(a, x, a1, b, y, b1, edits, should_stop, max_cost)
+
+def middle_snake(a, a0, a1, b, b0, b1, should_stop, max_cost):
+    #前からと後ろからの最長経路が重なる点 (aの位置, bの位置) を返す。共通部分がないか、max_cost手で見つからなければNone
+    n = a1 - a0
+    m = b1 - b0
+    max_d = (n + m + 1) // 2
+    offset = max_d
+    length = 2 * max_d + 2
+    forward = [-1] * length
+    backward = [-1] * length
+    forward[offset + 1] = 0
+    backward[offset + 1] = 0
+    delta = n - m
+    front = delta % 2 != 0
+    k1_start = k1_end = k2_start = k2_end = 0
+    for d in range(min(max_d, max_cost)):
+        if should_stop is not None and should_stop():
+            raise DiffCancelled()
+        for k1 in range(-d + k1_start, d + 1 - k1_end, 2):
+            i = offset + k1
+            if k1 == -d or (k1 != d and forward[i - 1] < forward[i + 1]):
+                x1 = forward[i + 1]
+            else:
+                x1 = forward[i - 1] + 1
+            y1 = x1 - k1
+            while x1 < n and y1 < m and a[a0 + x1] == b[b0 + y1]:
+                x1 += 1
+                y1 += 1
+            forward[i] = x1
+            if x1 > n:
+                k1_end += 2
+            elif y1 > m:
+                k1_start += 2
+            elif front:
+                j = offset + delta - k1
+                if 0 <= j < length and backward[j] != -1 and x1 >= n - backward[j]:
+                    return a0 + x1, b0 + y1
+        for k2 in range(-d + k2_start, d + 1 - k2_end, 2):
+            j = offset + k2
+            if k2 == -d or (k2 != d and backward[j - 1] < backward[j + 1]):
+                x2 = backward[j + 1]
+            else:
+                x2 = backward[j - 1] + 1
+            y2 = x2 - k2
+            while x2 < n and y2 < m and a[a1 - x2 - 1] == b[b1 - y2 - 1]:
+                x2 += 1
+                y2 += 1
+            backward[j] = x2
+            if x2 > n:
+                k2_end += 2
+            elif y2 > m:
+                k2_start += 2
+            elif not front:
+                i = offset + delta - k2
+                if 0 <= i < length and forward[i] != -1:
+                    x1 = forward[i]
+                    if x1 >= n - x2:
+                        return a0 + x1, b0 + x1 - (i - offset)
+    return None
+
+#校正の規則。段落の文字列を受け取り、[(開始, 終了, メッセージ, 表記ゆれのキー)] を返す
+DOUBLED_PARTICLE = re.compile(r"(を|が|に|は|で|へ)\1")
+HALF_WIDTH_KANA = re.compile(r"[ｦ-ﾟ]+")
+FULL_WIDTH_ALNUM = re.compile(r"[０-９Ａ-Ｚａ-ｚ]")
+HALF_WIDTH_ALNUM = re.compile(r"[0-9A-Za-z]+")
+SENTENCE = re.compile(r"[^。！？]+[。！？]*")
+MAX_SENTENCE_LENGTH = 100
+#表記ゆれ: 同じ組のうち2通り以上が文書中に出てきたら指摘する
+VARIANT_GROUPS = [("出来", "でき"), ("下さい", "ください"), ("頂く", "いただく"), ("宜しく", "よろしく"),
+                  ("分かる", "わかる"), ("全て", "すべて"), ("沢山", "たくさん"), ("何故", "なぜ")]
+VARIANT_FORMS = {form: (group, index) for group, forms in enumerate(VARIANT_GROUPS) for index, form in enumerate(forms)}
+VARIANT_PATTERN = re.compile("|".join(sorted(VARIANT_FORMS, key=len, reverse=True)))
+
+def lint_doubled_particles(para):
+    return [(m.start(), m.end(), f"助詞の重複「{m.group()}」", None) for m in DOUBLED_PARTICLE.finditer(para)]
+
+def lint_character_width(para):
+    found = [(m.start(), m.end(), "半角カナ", None) for m in HALF_WIDTH_KANA.finditer(para)]
+    if FULL_WIDTH_ALNUM.search(para):
+        found += [(m.start(), m.end(), "全角と半角の英数字が混在", None) for m in HALF_WIDTH_ALNUM.finditer(para)]
+    return found
+
+def lint_long_sentences(para):
+    return [(m.start(), m.end(), f"長い文({m.end() - m.start()}字)", None) for m in SENTENCE.finditer(para) if m.end() - m.start() > MAX_SENTENCE_LENGTH]
+
+def lint_variants(para):
+    return [(m.start(), m.end(), f"表記ゆれ「{'」「'.join(VARIANT_GROUPS[VARIANT_FORMS[m.group()][0]])}」", VARIANT_FORMS[m.group()]) for m in VARIANT_PATTERN.finditer(para)]
+
+LINT_RULES = [lint_doubled_particles, lint_character_width, lint_long_sentences, lint_variants]
+
+class ParagraphMarkup:
+    #1段落の注記(位置は段落の先頭からの文字インデックス)
+    def __init__(self, parsed):
+        hidden_ranges, ruby, bouten, page_breaks = parsed
+        self.parsed = parsed
+        self.hidden = sorted({pos for start, end in hidden_ranges for pos in range(start, end)})  #描画しない記号(｜《》［＃…］)
+        self.hidden_set = set(self.hidden)
+        self.ruby = {start: (end, ruby_text) for start, end, ruby_text in ruby}  #親文字の先頭 -> (親文字の終わり, ルビ)
+        self.bouten = {pos for start, end in bouten for pos in range(start, end)}  #傍点を打つ文字
+        self.page_breaks = page_breaks  #改ページ注記の先頭
+
+class MarkupWindow:
+    #start〜endにかかる段落の注記を、文書先頭からの位置に直したもの
+    def __init__(self, markup, start, end):
+        self.start = start
+        self.end = end
+        self.hidden = set()
+        self.ruby = {}
+        self.bouten = set()
+        self.page_breaks = set()
+        first = max(0, int(np.searchsorted(markup.starts, start, side="right")) - 1)
+        last = int(np.searchsorted(markup.starts, end, side="left"))
+        for offset, para in zip(markup.starts[first:last].tolist(), markup.paragraphs[first:last]):
+            self.hidden.update(offset + pos for pos in para.hidden)
+            for pos, (ruby_end, ruby_text) in para.ruby.items():
+                self.ruby[offset + pos] = (offset + ruby_end, ruby_text)
+            self.bouten.update(offset + pos for pos in para.bouten)
+            self.page_breaks.update(offset + pos for pos in para.page_breaks)
+
+class AozoraMarkup:
+    #文書全体の注記。注記のある段落だけを、段落の先頭位置の昇順に持つ
+    #編集されたら変わった段落だけ入れ替えた新しいものを作り、後ろの段落は先頭位置をずらして解析結果を使い回す
+    #描画スレッドが持っている古いものは書き換えないので、そのまま使い続けてよい
+    def __init__(self, starts=None, paragraphs=(), counts=None, spans=None, breaks=None):
+        empty = np.zeros(0, dtype=np.int64)
+        self.starts = empty if starts is None else starts            #段落の先頭
+        self.paragraphs = list(paragraphs)                            #ParagraphMarkup
+        self.counts = empty if counts is None else counts            #段落の描画しない記号の数
+        self.spans = empty if spans is None else spans               #段落の先頭から最後の描画しない記号まで(+1)
+        self.breaks = np.zeros(0, dtype=bool) if breaks is None else breaks  #改ページ注記を含むか
+        #その段落より前にある描画しない記号の数
+        self.totals = np.concatenate(([0], np.cumsum(self.counts))).astype(np.int64)
+
+    def replace(self, start, old_end, delta, starts, paragraphs):
+        #先頭がstart〜old_endの段落を入れ替え、後ろの段落をdeltaだけずらしたものを返す
+        lo = int(np.searchsorted(self.starts, start, side="left"))
+        hi = int(np.searchsorted(self.starts, old_end, side="right"))
+        def splice(old, new, shift=0):
+            return np.concatenate((old[:lo], np.array(new, dtype=old.dtype), old[hi:] + shift if shift else old[hi:]))
+        return AozoraMarkup(splice(self.starts, starts, delta), self.paragraphs[:lo] + paragraphs + self.paragraphs[hi:],
+                            splice(self.counts, [len(para.hidden) for para in paragraphs]),
+                            splice(self.spans, [para.hidden[-1] + 1 if para.hidden else 0 for para in paragraphs]),
+                            splice(self.breaks, [bool(para.page_breaks) for para in paragraphs]))
+
+    def paragraph(self, offset):
+        #offsetから始まる段落の解析結果。注記がなければAozoraParser.EMPTY
+        i = int(np.searchsorted(self.starts, offset, side="left"))
+        if i < len(self.starts) and self.starts[i] == offset:
+            return self.paragraphs[i].parsed
+        return AozoraParser.EMPTY
+
+    def window(self, start, end):
+        return MarkupWindow(self, start, end)
+
+    def hidden_before(self, positions):
+        #各位置より前にある描画しない記号の数(positionsは整数か配列)。段落の途中にある位置だけ段落内を二分探索する
+        scalar = np.ndim(positions) == 0
+        positions = np.atleast_1d(np.asarray(positions, dtype=np.int64))
+        indices = np.searchsorted(self.starts, positions, side="right") - 1
+        result = self.totals[indices + 1]
+        if len(self.starts):
+            clipped = np.maximum(indices, 0)
+            relative = positions - self.starts[clipped]
+            inside = (indices >= 0) & (relative < self.spans[clipped])
+            result = np.where(inside, self.totals[clipped], result)
+            for k in np.flatnonzero(inside & (relative > 0)).tolist():
+                result[k] += bisect.bisect_left(self.paragraphs[int(indices[k])].hidden, int(relative[k]))
+        return int(result[0]) if scalar else result
+
+    def hidden_count(self, start, end):
+        #start〜end-1にある描画しない記号の数
+        if not len(self.starts) or start >= end:
+            return 0
+        return self.hidden_before(end) - self.hidden_before(start)
+
+    def hidden_flags(self, positions):
+        #各位置が描画しない記号かどうか
+        if not len(self.starts) or not len(positions):
+            return [False] * len(positions)
+        indices = np.searchsorted(self.starts, positions, side="right") - 1
+        relative = (np.asarray(positions, dtype=np.int64) - self.starts[np.maximum(indices, 0)]).tolist()
+        paragraphs = self.paragraphs
+        return [i >= 0 and pos in paragraphs[i].hidden_set for i, pos in zip(indices.tolist(), relative)]
+
+EMPTY_MARKUP = AozoraMarkup()
+
+class AozoraParser:
+    #青空文庫形式の注記(ルビ・傍点・改ページ)を段落ごとに解析する。編集されたら前回のテキストと比べ、変わった段落だけ解析し直す
+    RUBY_EXPLICIT = re.compile(r"[｜|]([^｜|《》\n]+)《([^《》\n]+)》")
+    RUBY_IMPLICIT = re.compile(r"([々〆ヶ\u3400-\u4dbf\u4e00-\u9fff]+)《([^《》\n]+)》")
+    BOUTEN = re.compile(r"［＃「([^」］]+)」に[^］]*傍点］")
+    PAGE_BREAK = re.compile(r"［＃改(?:ページ|丁|頁)］")
+    ANNOTATION = re.compile(r"［＃[^］\n]*］")
+    EMPTY = ((), (), (), ())
+
+    def __init__(self):
+        self.last_text = None
+        self.result = AozoraMarkup()
+
+    def parse_paragraph(self, para):
+        if "《" not in para and "］" not in para:
+            return self.EMPTY
+        hidden = []
+        ruby = []
+        bouten = []
+        page_breaks = []
+        explicit_marks = set()
+        for m in self.RUBY_EXPLICIT.finditer(para):
+            hidden.append((m.start(), m.start() + 1))
+            hidden.append((m.end(1), m.end()))
+            ruby.append((m.start(1), m.end(1), m.group(2)))
+            explicit_marks.add(m.end(1))
+        for m in self.RUBY_IMPLICIT.finditer(para):
+            #｜で親文字を指定したルビと重なる場合は無視
+            if m.end(1) in explicit_marks:
+                continue
+            hidden.append((m.end(1), m.end()))
+            ruby.append((m.start(1), m.end(1), m.group(2)))
+        for m in self.ANNOTATION.finditer(para):
+            hidden.append((m.start(), m.end()))
+            bouten_match = self.BOUTEN.fullmatch(m.group())
+            if bouten_match:
+                target = bouten_match.group(1)
+                if para[max(0, m.start() - len(target)):m.start()] == target:
+                    bouten.append((m.start() - len(target), m.start()))
+            elif self.PAGE_BREAK.fullmatch(m.group()):
+                page_breaks.append(m.start())
+        return (tuple(hidden), tuple(ruby), tuple(bouten), tuple(page_breaks))
+
+    def parse(self, text):
+        #前回と同じテキストなら結果をそのまま返す
+        if text is self.last_text or text == self.last_text:
+            return self.result
+        old_text = self.last_text
+        self.last_text = text
+        if old_text is None:
+            old_text = ""
+            start, old_end, new_end = 0, 0, len(text)
+        else:
+            prefix = common_prefix_length(old_text, text)
+            suffix = common_suffix_length(old_text, text, min(len(old_text), len(text)) - prefix)
+            start = text.rfind("\n", 0, prefix) + 1
+            old_end = old_text.find("\n", len(old_text) - suffix)
+            if old_end == -1:
+                old_end = len(old_text)
+            new_end = old_end + len(text) - len(old_text)
+        starts, paragraphs = [], []
+        offset = start
+        for para in text[start:new_end].split("\n"):
+            parsed = self.parse_paragraph(para)
+            if parsed is not self.EMPTY and parsed[0]:
+                starts.append(offset)
+                paragraphs.append(ParagraphMarkup(parsed))
+            offset += len(para) + 1
+        self.result = self.result.replace(start, old_end, len(text) - len(old_text), starts, paragraphs)
+        return self.result
+
+class HeadingIndex:
+    #見出しの位置と見出し行を位置順に持つ。編集があれば変わった段落だけ正規表現で調べ直し、後ろの見出しはずらすだけにする
+    def __init__(self, pattern=HEADING_PATTERN):
+        self.set_pattern(pattern)
+
+    def set_pattern(self, pattern):
+        self.pattern = pattern
+        self.regex = re.compile(pattern, re.MULTILINE)
+        self.text = None
+        self.positions = []
+        self.titles = []
+
+    def scan(self, text, start, end):
+        #1行に見出しは1つまで
+        positions, titles = [], []
+        line_end = -1
+        for m in self.regex.finditer(text, start, end):
+            if m.start() <= line_end:
+                continue
+            line_start = text.rfind("\n", 0, m.start()) + 1
+            line_end = text.find("\n", m.start())
+            if line_end == -1:
+                line_end = len(text)
+            positions.append(line_start)
+            titles.append(text[line_start:line_end].strip(" 　"))
+        return positions, titles
+
+    def update(self, text):
+        #変更があればTrue
+        if text is self.text:
+            return False
+        old_text = self.text
+        self.text = text
+        if old_text is None:
+            self.positions, self.titles = self.scan(text, 0, len(text))
+            return True
+        prefix = common_prefix_length(old_text, text)
+        suffix = common_suffix_length(old_text, text, min(len(old_text), len(text)) - prefix)
+        start = text.rfind("\n", 0, prefix) + 1
+        old_end = old_text.find("\n", len(old_text) - suffix)
+        if old_end == -1:
+            old_end = len(old_text)
+        new_end = old_end + len(text) - len(old_text)
+        lo = bisect.bisect_left(self.positions, start)
+        hi = bisect.bisect_right(self.positions, old_end)
+        positions, titles = self.scan(text, start, new_end)
+        delta = len(text) - len(old_text)
+        changed = delta != 0 and hi < len(self.positions) or positions != self.positions[lo:hi] or titles != self.titles[lo:hi]
+        self.positions = self.positions[:lo] + positions + [pos + delta for pos in self.positions[hi:]]
+        self.titles = self.titles[:lo] + titles + self.titles[hi:]
+        return changed
+
+class ManuscriptPages:
+    #20字×20行の原稿用紙に書いたときの各段落の先頭の行(列)。窓の大きさやフォントには左右されない
+    #字下げは1字、注記の記号は数えず、改ページ注記の次の段落は新しいページから始める
+    #段落ごとの列数を持っておき、編集されたら変わった段落だけ数え直して先頭の列は累積和で求め直す
+    def __init__(self):
+        self.text = None
+        self.auto_indent = None
+        self.markup = EMPTY_MARKUP
+        self.para_starts = np.zeros(1, dtype=np.int64)
+        self.indents = np.zeros(1, dtype=np.int64)
+        self.columns = np.ones(1, dtype=np.int64)
+        self.breaks = np.zeros(1, dtype=bool)
+        self.first_cols = np.zeros(1, dtype=np.int64)
+        self.column_total = 1
+
+    def update(self, text, auto_indent, markup):
+        if text is self.text and markup is self.markup and auto_indent == self.auto_indent:
+            return
+        old_text, old_indent, old_markup = self.text, self.auto_indent, self.markup
+        self.text = text
+        self.auto_indent = list(auto_indent)
+        self.markup = markup
+        if old_text is None or text == old_text or (markup is EMPTY_MARKUP) != (old_markup is EMPTY_MARKUP) or not self.update_paragraphs(old_text, old_indent):
+            self.scan()
+        self.count_columns()
+
+    def scan(self):
+        #すべての段落の列数を数える
+        text, markup = self.text, self.markup
+        codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+        newlines = np.flatnonzero(codes == 10)
+        starts = np.concatenate(([0], newlines + 1)).astype(np.int64)
+        ends = np.append(newlines, len(text)).astype(np.int64)
+        flags = np.array(self.auto_indent[:len(newlines)], dtype=np.int64)
+        indents = np.zeros(len(starts), dtype=np.int64)
+        indents[1:1 + len(flags)] = flags
+        lengths = ends - starts + indents - (markup.hidden_before(ends) - markup.hidden_before(starts))
+        breaks = np.zeros(len(starts), dtype=bool)
+        breaks[np.searchsorted(starts, markup.starts[markup.breaks])] = True
+        self.para_starts = starts
+        self.indents = indents
+        self.columns = np.maximum(1, -(-lengths // COLUMN_CHARS))
+        self.breaks = breaks
+
+    def update_paragraphs(self, old_text, old_indent):
+        #編集された段落だけ数え直し、後ろの段落は先頭位置をずらす。字下げの変わり方が合わなければFalse
+        text, auto_indent, markup = self.text, self.auto_indent, self.markup
+        prefix = common_prefix_length(old_text, text)
+        suffix = common_suffix_length(old_text, text, min(len(old_text), len(text)) - prefix)
+        start = text.rfind("\n", 0, prefix) + 1
+        old_end = old_text.find("\n", len(old_text) - suffix)
+        if old_end == -1:
+            old_end = len(old_text)
+        delta = len(text) - len(old_text)
+        lo = int(np.searchsorted(self.para_starts, start, side="left"))
+        hi = int(np.searchsorted(self.para_starts, old_end, side="right"))
+        #前後の段落の字下げ(直前の改行の自動字下げ)が変わっていれば全体を数え直す
+        tail = len(self.para_starts) - hi
+        if old_indent[:max(0, lo - 1)] != auto_indent[:max(0, lo - 1)]:
+            return False
+        if tail and (tail > min(len(old_indent), len(auto_indent)) or old_indent[len(old_indent) - tail:] != auto_indent[len(auto_indent) - tail:]):
+            return False
+        starts, indents, columns, breaks = [], [], [], []
+        offset = start
+        for para in text[start:old_end + delta].split("\n"):
+            index = lo + len(starts)
+            indent = 1 if 0 < index <= len(auto_indent) and auto_indent[index - 1] else 0
+            length = len(para) + indent - markup.hidden_count(offset, offset + len(para))
+            starts.append(offset)
+            indents.append(indent)
+            columns.append(max(1, -(-length // COLUMN_CHARS)))
+            breaks.append(bool(markup.paragraph(offset)[3]))
+            offset += len(para) + 1
+        def splice(old, new, shift=0):
+            return np.concatenate((old[:lo], np.array(new, dtype=old.dtype), old[hi:] + shift if shift else old[hi:]))
+        self.para_starts = splice(self.para_starts, starts, delta)
+        self.indents = splice(self.indents, indents)
+        self.columns = splice(self.columns, columns)
+        self.breaks = splice(self.breaks, breaks)
+        return True
+
+    def count_columns(self):
+        #段落の先頭の列は列数の累積和。改ページ注記のある段落の後ろは、次のページの先頭まで送る
+        columns = self.columns
+        first_cols = np.cumsum(columns) - columns
+        padding = np.zeros(len(columns), dtype=np.int64)
+        shift = 0
+        for para in (np.flatnonzero(self.breaks[:-1]) + 1).tolist():
+            pad = -(int(first_cols[para]) + shift) % PAGE_COLUMNS
+            padding[para] = pad
+            shift += pad
+        if shift:
+            first_cols = first_cols + np.cumsum(padding)
+        self.first_cols = first_cols
+        self.column_total = int(first_cols[-1] + columns[-1])
+
+    def page_count(self):
+        return (self.column_total - 1) // PAGE_COLUMNS + 1
+
+    def pages_of(self, positions):
+        #各位置を含むページ(1始まり)
+        positions = np.asarray(positions, dtype=np.int64)
+        paras = np.searchsorted(self.para_starts, positions, side="right") - 1
+        starts = self.para_starts[paras]
+        visible = positions - starts - (self.markup.hidden_before(positions) - self.markup.hidden_before(starts)) + self.indents[paras]
+        return (self.first_cols[paras] + visible // COLUMN_CHARS) // PAGE_COLUMNS + 1
+
+    def page_start(self, page):
+        #pageページ目の最初の文字の位置。ページがなければNone
+        col = (page - 1) * PAGE_COLUMNS
+        if not 0 <= col < self.column_total:
+            return None
+        para = int(np.searchsorted(self.first_cols, col, side="right")) - 1
+        start = int(self.para_starts[para])
+        end = int(self.para_starts[para + 1]) - 1 if para + 1 < len(self.para_starts) else len(self.text)
+        visible = max(0, (col - int(self.first_cols[para])) * COLUMN_CHARS - int(self.indents[para]))
+        #注記の記号を飛ばした分だけ後ろへずらす
+        pos = start + visible
+        while True:
+            hidden = self.markup.hidden_count(start, pos)
+            if start + visible + hidden == pos:
+                break
+            pos = start + visible + hidden
+        return min(pos, end)
+
+class RevisionDiff:
+    #比較元のファイルから今のテキストへの変更。段落単位で比べ、書き換えられた段落だけを文字単位で比べ直す
+    #changes = [(開始, 終了, 種類, 比較元の文字列)] 位置は今のテキストでの文字インデックス。位置順で重ならない
+    CHAR_DIFF_LIMIT = 4000
+    COLORS = {"insert": "#c8f0c8", "change": "#ffd8a0", "delete": "#ffb0b0"}
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.text = None
+        self.changes = []
+        self.version = 0
+        self.cancelled = False
+
+    def should_stop(self):
+        return self.cancelled
+
+    def run(self, text, results):
+        #ワーカースレッドで呼ぶ。進み具合と結果をresultsに入れる
+        try:
+            old_text, encoding, file_hash = read_text_stream(self.file_path)
+            results.put(("progress", 0.0, "段落を比較中…"))
+            changes = self.compare(old_text, text, results)
+        except DiffCancelled:
+            return
+        except Exception as e:
+            results.put(("error", e))
+            return
+        results.put(("done", text, changes))
+
+    def compare(self, old_text, text, results):
+        old_paras = old_text.split("\n")
+        new_paras = text.split("\n")
+        #段落は番号に置き換えてから比べる
+        ids = {}
+        a = [ids.setdefault(para, len(ids)) for para in old_paras]
+        b = [ids.setdefault(para, len(ids)) for para in new_paras]
+        offsets = []
+        pos = 0
+        for para in new_paras:
+            offsets.append(pos)
+            pos += len(para) + 1
+        blocks = diff_sequences(a, b, self.should_stop)
+        changes = []
+        reported = 0.0
+        for n, (tag, i1, i2, j1, j2) in enumerate(blocks):
+            start = offsets[j1] if j1 < len(offsets) else len(text)
+            old_block = "\n".join(old_paras[i1:i2])
+            new_block = "\n".join(new_paras[j1:j2])
+            if tag == "replace" and len(old_block) + len(new_block) <= self.CHAR_DIFF_LIMIT:
+                for char_tag, c1, c2, d1, d2 in diff_sequences(old_block, new_block, self.should_stop):
+                    self.add_change(changes, text, char_tag, start + d1, start + d2, old_block[c1:c2])
+            else:
+                self.add_change(changes, text, tag, start, start + len(new_block), old_block)
+            if (n + 1) / len(blocks) - reported >= 0.01:
+                reported = (n + 1) / len(blocks)
+                results.put(("progress", reported, f"文字単位で比較中… {n + 1}/{len(blocks)}"))
+        return changes
+
+    def add_change(self, changes, text, tag, start, end, old):
+        if tag == "insert":
+            changes.append((start, end, "insert", ""))
+        elif tag == "replace":
+            changes.append((start, end, "change", old))
+        else:
+            #削除は直後(段落末なら直前)の1文字に印を付ける。印を付けられる文字がなければ幅0で残す
+            pos = start
+            if pos >= len(text) or text[pos] == "\n":
+                pos -= 1
+            if pos < 0 or text[pos] == "\n" or (changes and changes[-1][1] > pos):
+                changes.append((start, start, "delete", old))
+            else:
+                changes.append((pos, pos + 1, "delete", old))
+
+    def update(self, text):
+        #比較後の編集に合わせて位置をずらす。編集と重なった変更は、編集で入った文字の追加に置き換える
+        if text is self.text or self.text is None:
+            return
+        old_text = self.text
+        prefix = common_prefix_length(old_text, text)
+        suffix = common_suffix_length(old_text, text, min(len(old_text), len(text)) - prefix)
+        old_end = len(old_text) - suffix
+        new_end = len(text) - suffix
+        delta = len(text) - len(old_text)
+        starts = [start for start, end, kind, old in self.changes]
+        ends = [end for start, end, kind, old in self.changes]
+        lo = bisect.bisect_right(ends, prefix)
+        hi = max(lo, bisect.bisect_left(starts, old_end))
+        edited = [(prefix, new_end, "insert", "")] if new_end > prefix else []
+        self.changes = self.changes[:lo] + edited + [(start + delta, end + delta, kind, old) for start, end, kind, old in self.changes[hi:]]
+        self.text = text
+        self.version += 1
+
+class ProofreadingLinter:
+    #規則ベースの校正。編集された段落だけをワーカースレッドで調べ直し、指摘は開始位置順の索引に入れて描画時に範囲で引く
+    #規則はadd_ruleで足せる(LINT_RULESの関数と同じ形)
+    POLL_MS = 200
+    CACHE_LIMIT = 50000
+
+    def __init__(self, rules=LINT_RULES):
+        self.rules = list(rules)
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        self.worker = None
+        self.cache = {}
+        self.clear()
+
+    def clear(self):
+        self.text = None
+        self.findings = []  # (開始, 終了, メッセージ, 表記ゆれのキー)
+        self.starts = []
+        self.max_length = 0
+        self.variant_counts = {}
+        self.dirty = []  # 調べ直す段落の範囲 (開始, 終了)
+        self.busy = False
+        self.version = 0
+
+    def add_rule(self, rule):
+        #規則が変わったら全体を調べ直す
+        self.rules.append(rule)
+        self.jobs.put("reset")
+        self.clear()
+
+    def start(self):
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.work, daemon=True)
+            self.worker.start()
+
+    def stop(self):
+        if self.worker is not None:
+            self.jobs.put(None)
+            self.worker = None
+        self.clear()
+
+    def work(self):
+        #段落の文字列ごとに結果を覚えておき、同じ段落は調べ直さない
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            if job == "reset":
+                self.cache = {}
+                continue
+            text, ranges, rules = job
+            found = {}
+            for start, end in ranges:
+                for para in text[start:end].split("\n"):
+                    if para in found:
+                        continue
+                    result = self.cache.get(para)
+                    if result is None:
+                        result = []
+                        for rule in rules:
+                            result += rule(para)
+                        result.sort(key=lambda finding: finding[0])
+                        if len(self.cache) >= self.CACHE_LIMIT:
+                            self.cache = {}
+                        self.cache[para] = result
+                    found[para] = result
+            self.results.put(found)
+
+    def count_variant(self, key, amount):
+        if key is not None:
+            self.variant_counts[key] = self.variant_counts.get(key, 0) + amount
+
+    def update(self, text):
+        #編集された段落の指摘を捨てて調べ直す範囲に加え、後ろの指摘は文字数のずれだけずらす
+        if text is self.text:
+            return
+        old_text = self.text
+        self.text = text
+        if old_text is None:
+            self.findings = []
+            self.starts = []
+            self.variant_counts = {}
+            self.dirty = [(0, len(text))]
+            self.version += 1
+            return
+        prefix = common_prefix_length(old_text, text)
+        suffix = common_suffix_length(old_text, text, min(len(old_text), len(text)) - prefix)
+        para_start = old_text.rfind("\n", 0, prefix) + 1
+        old_end = old_text.find("\n", len(old_text) - suffix)
+        if old_end == -1:
+            old_end = len(old_text)
+        delta = len(text) - len(old_text)
+        lo = bisect.bisect_left(self.starts, para_start)
+        hi = bisect.bisect_right(self.starts, old_end)
+        if lo < hi:
+            for finding in self.findings[lo:hi]:
+                self.count_variant(finding[3], -1)
+            self.version += 1
+        self.findings = self.findings[:lo] + [(start + delta, end + delta, message, key) for start, end, message, key in self.findings[hi:]]
+        self.starts = [finding[0] for finding in self.findings]
+        dirty = [(start, end) for start, end in self.dirty if end < para_start]
+        merged_start, merged_end = para_start, old_end + delta
+        after = []
+        for start, end in self.dirty:
+            if start > old_end:
+                after.append((start + delta, end + delta))
+            elif end >= para_start:
+                merged_start = min(merged_start, start)
+                merged_end = max(merged_end, end + delta)
+        self.dirty = dirty + [(merged_start, merged_end)] + after
+
+    def dispatch(self):
+        #前の依頼が終わっていれば、残っている範囲を今のテキストで依頼する
+        if self.worker is None or self.busy or not self.dirty:
+            return
+        self.busy = True
+        self.jobs.put((self.text, list(self.dirty), list(self.rules)))
+
+    def poll(self):
+        #届いた結果を反映する。指摘が変わればTrue
+        changed = False
+        while True:
+            try:
+                found = self.results.get_nowait()
+            except queue.Empty:
+                break
+            self.busy = False
+            changed = self.apply(found) or changed
+        self.dispatch()
+        return changed
+
+    def apply(self, found):
+        #調べ直す範囲の段落のうち、結果が届いたものの指摘を入れる。途中で編集された段落は範囲に残る
+        text = self.text
+        added = []
+        dirty = []
+        for start, end in self.dirty:
+            pos = start
+            while True:
+                newline = text.find("\n", pos, end)
+                para_end = end if newline == -1 else newline
+                result = found.get(text[pos:para_end])
+                if result is None:
+                    if dirty and dirty[-1][1] + 1 >= pos:
+                        dirty[-1] = (dirty[-1][0], para_end)
+                    else:
+                        dirty.append((pos, para_end))
+                else:
+                    added += [(pos + a, pos + b, message, key) for a, b, message, key in result]
+                if newline == -1:
+                    break
+                pos = newline + 1
+        self.dirty = dirty
+        if not added:
+            return False
+        for finding in added:
+            self.count_variant(finding[3], 1)
+        self.findings = sorted(self.findings + added, key=lambda finding: finding[0])
+        self.starts = [finding[0] for finding in self.findings]
+        self.max_length = max(end - start for start, end, message, key in self.findings)
+        self.version += 1
+        return True
+
+    def is_mixed(self, group):
+        return sum(1 for index in range(len(VARIANT_GROUPS[group])) if self.variant_counts.get((group, index))) >= 2
+
+    def query(self, start, end):
+        #[start, end)に掛かる指摘。表記ゆれは文書中でほかの書き方も使われているものだけ
+        i = bisect.bisect_left(self.starts, start - self.max_length)
+        j = bisect.bisect_left(self.starts, end)
+        return [finding for finding in self.findings[i:j]
+                if finding[1] > start and (finding[3] is None or self.is_mixed(finding[3][0]))]
+
+class EpubWriter:
+    #縦書き(vertical-rl)のEPUB3を章ごとのXHTMLに分けて、ZIPへ少しずつ書き込む
+    STYLE = """html {
+  writing-mode: vertical-rl;
+  -webkit-writing-mode: vertical-rl;
+  -epub-writing-mode: vertical-rl;
+}
+body { margin: 0; }
+p { margin: 0; }
+p.indent { text-indent: 1em; }
+h2 { font-size: 1.2em; margin: 0 2em; }
+em.sesame {
+  font-style: normal;
+  text-emphasis-style: sesame;
+  -webkit-text-emphasis-style: sesame;
+  -epub-text-emphasis-style: sesame;
+}
+"""
+    CONTAINER = """<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+"""
+    #これだけ溜まったら圧縮ストリームへ書き出す
+    FLUSH_SIZE = 64 * 1024
+
+    def __init__(self, file_path, title):
+        self.file_path = file_path
+        self.title = title
+        self.chapters = []
+
+    def xhtml_header(self, title):
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n<!DOCTYPE html>\n'
+                '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" xml:lang="ja" lang="ja">\n'
+                f'<head><meta charset="UTF-8"/><title>{escape(title)}</title>'
+                '<link rel="stylesheet" type="text/css" href="style.css"/></head>\n<body>\n')
+
+    def write(self, events):
+        with zipfile.ZipFile(self.file_path, "w", zipfile.ZIP_DEFLATED) as zf:
+            #mimetypeは無圧縮で先頭に置く
+            zf.writestr(zipfile.ZipInfo("mimetype"), "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+            zf.writestr("META-INF/container.xml", self.CONTAINER)
+            zf.writestr("OEBPS/style.css", self.STYLE)
+
+            stream = None
+            buffer = []
+            buffer_size = 0
+            for kind, value in events:
+                if kind in ("chapter", "page") or stream is None:
+                    #中身のあるファイルが開いていれば閉じて、次のファイルへ
+                    if stream is not None and (buffer_size or self.chapters[-1][2]):
+                        self.close_chapter(stream, buffer)
+                        stream = None
+                    if stream is None:
+                        stream = self.open_chapter(zf, value if kind == "chapter" else None)
+                        buffer = []
+                        buffer_size = 0
+                    elif kind == "chapter":
+                        self.chapters[-1][1] = value
+                if kind == "line":
+                    buffer.append(value + "\n")
+                    buffer_size += len(value)
+                    if buffer_size >= self.FLUSH_SIZE:
+                        stream.write("".join(buffer).encode("utf-8"))
+                        self.chapters[-1][2] = True
+                        buffer = []
+                        buffer_size = 0
+            if stream is None:
+                stream = self.open_chapter(zf, None)
+            self.close_chapter(stream, buffer)
+
+            zf.writestr("OEBPS/nav.xhtml", self.build_nav())
+            zf.writestr("OEBPS/content.opf", self.build_opf())
+        return len(self.chapters)
+
+    def open_chapter(self, zf, title):
+        name = f"chapter{len(self.chapters) + 1:04d}.xhtml"
+        #[ファイル名, 見出し, 書き出し済みか]
+        self.chapters.append([name, title, False])
+        stream = zf.open("OEBPS/" + name, "w")
+        stream.write(self.xhtml_header(title or self.title).encode("utf-8"))
+        return stream
+
+    def close_chapter(self, stream, buffer):
+        buffer.append("</body>\n</html>\n")
+        stream.write("".join(buffer).encode("utf-8"))
+        stream.close()
+
+    def build_nav(self):
+        items = []
+        for name, title, _ in self.chapters:
+            if title:
+                items.append(f'<li><a href="{name}">{escape(title)}</a></li>')
+        if not items:
+            items.append(f'<li><a href="{self.chapters[0][0]}">{escape(self.title)}</a></li>')
+        return (self.xhtml_header(self.title)
+                + '<nav epub:type="toc" id="toc"><h1>目次</h1><ol>\n' + "\n".join(items) + "\n</ol></nav>\n</body>\n</html>\n")
+
+    def build_opf(self):
+        modified = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        manifest = ['<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>',
+                    '<item id="style" href="style.css" media-type="text/css"/>']
+        spine = []
+        for i, (name, title, _) in enumerate(self.chapters):
+            manifest.append(f'<item id="c{i}" href="{name}" media-type="application/xhtml+xml"/>')
+            spine.append(f'<itemref idref="c{i}"/>')
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="bookid" xml:lang="ja">\n'
+                '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">\n'
+                f'<dc:identifier id="bookid">urn:uuid:{uuid.uuid4()}</dc:identifier>\n'
+                f'<dc:title>{escape(self.title)}</dc:title>\n'
+                '<dc:language>ja</dc:language>\n'
+                f'<meta property="dcterms:modified">{modified}</meta>\n'
+                '</metadata>\n<manifest>\n' + "\n".join(manifest) + "\n</manifest>\n"
+                '<spine page-progression-direction="rtl">\n' + "\n".join(spine) + "\n</spine>\n</package>\n")
+
+class NgramIndex:
+    #段落ごとのbigramから候補の段落を絞り込む転置インデックス(リテラル検索用)
+    #段落はテキストそのものをキーにするので、同じ内容の段落は1つにまとまる
+    N = 2
+
+    def __init__(self):
+        self.text = ""
+        self.paragraphs = [""]
+        self.refs = {}
+        self.postings = {}
+        self.ready = False
+        self.building = False
+        self.lock = threading.Lock()
+
+    def grams(self, para):
+        return {para[i:i + self.N] for i in range(len(para) - self.N + 1)}
+
+    def add_paragraph(self, para, refs, postings):
+        if para in refs:
+            refs[para] += 1
+            return
+        refs[para] = 1
+        for gram in self.grams(para):
+            postings.setdefault(gram, set()).add(para)
+
+    def remove_paragraph(self, para):
+        self.refs[para] -= 1
+        if self.refs[para]:
+            return
+        del self.refs[para]
+        for gram in self.grams(para):
+            paras = self.postings[gram]
+            paras.discard(para)
+            if not paras:
+                del self.postings[gram]
+
+    def build_async(self, text):
+        #全体の構築はワーカースレッドで行い、終わるまでの検索は全文走査にまかせる
+        if self.building:
+            return
+        self.building = True
+        threading.Thread(target=self.build, args=(text,), daemon=True).start()
+
+    def build(self, text):
+        paragraphs = text.split("\n")
+        refs = {}
+        postings = {}
+        for para in paragraphs:
+            self.add_paragraph(para, refs, postings)
+        with self.lock:
+            self.text = text
+            self.paragraphs = paragraphs
+            self.refs = refs
+            self.postings = postings
+            self.ready = True
+            self.building = False
+
+    def update(self, text):
+        #前回のテキストとの差分にかかる段落だけを入れ替える
+        with self.lock:
+            if not self.ready or text is self.text:
+                return
+            old = self.text
+            prefix = common_prefix_length(old, text)
+            suffix = common_suffix_length(old, text, min(len(old), len(text)) - prefix)
+            if prefix == len(old) == len(text):
+                self.text = text
+                return
+            first = old.count("\n", 0, prefix)
+            old_last = first + old.count("\n", prefix, len(old) - suffix)
+            start = text.rfind("\n", 0, prefix) + 1
+            end = text.find("\n", len(text) - suffix)
+            if end == -1:
+                end = len(text)
+            new_paragraphs = text[start:end].split("\n")
+            for para in self.paragraphs[first:old_last + 1]:
+                self.remove_paragraph(para)
+            for para in new_paragraphs:
+                self.add_paragraph(para, self.refs, self.postings)
+            self.paragraphs[first:old_last + 1] = new_paragraphs
+            self.text = text
+
+    def query(self, term):
+        #見つかった位置のリストを返す。インデックスで答えられないときはNone
+        if "\n" in term or len(term) < self.N:
+            return None
+        with self.lock:
+            if not self.ready:
+                return None
+            posting_sets = []
+            for gram in self.grams(term):
+                paras = self.postings.get(gram)
+                if not paras:
+                    return []
+                posting_sets.append(paras)
+            posting_sets.sort(key=len)
+            candidates = {para for para in posting_sets[0] if all(para in paras for paras in posting_sets[1:])}
+            results = []
+            if not candidates:
+                return results
+            offset = 0
+            for para in self.paragraphs:
+                if para in candidates:
+                    pos = para.find(term)
+                    while pos != -1:
+                        results.append(offset + pos)
+                        pos = para.find(term, pos + len(term))
+                offset += len(para) + 1
+            return results
+
+def search_file(file_path, pattern, use_regex, replacement=None, apply=False, preview_limit=200):
+    #1ファイルを1行ずつ読みながら検索する(プロセスプールのワーカーで実行される)
+    #apply=Trueなら置換結果を同じフォルダの一時ファイルに書き、最後にos.replaceで差し替える
+    regex = re.compile(pattern if use_regex else re.escape(pattern))
+    with open(file_path, "rb") as f:
+        encoding = sniff_encoding(f.read(64 * 1024))
+    count = 0
+    previews = []
+    temp_path = None
+    try:
+        out = None
+        if apply and replacement is not None:
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(file_path) or ".", prefix=".tatex-", suffix=".tmp")
+            out = open(fd, "w", encoding=encoding, newline="")
+        with open(file_path, "r", encoding=encoding, newline="") as f:
+            for line_number, line in enumerate(f, 1):
+                matches = list(regex.finditer(line))
+                if not matches:
+                    if out is not None:
+                        out.write(line)
+                    continue
+                count += len(matches)
+                new_line = regex.sub(replacement, line) if replacement is not None else None
+                if out is not None:
+                    out.write(new_line)
+                if len(previews) < preview_limit:
+                    first = matches[0]
+                    snippet = line[max(0, first.start() - 10):first.end() + 10].rstrip("\r\n")
+                    if new_line is not None:
+                        snippet += "  →  " + new_line.rstrip("\r\n")[max(0, first.start() - 10):first.start() + 30]
+                    previews.append((line_number, first.start(), snippet))
+        if out is not None:
+            out.flush()
+            os.fsync(out.fileno())
+            out.close()
+            if count:
+                #mkstempのファイルは0600なので、元のファイルの権限に合わせてから差し替える
+                shutil.copymode(file_path, temp_path)
+                os.replace(temp_path, file_path)
+            else:
+                os.remove(temp_path)
+            temp_path = None
+        return file_path, count, previews, None
+    except Exception as e:
+        return file_path, count, previews, str(e)
+    finally:
+        if temp_path is not None and os.path.exists(temp_path):
+            try:
+                out.close()
+            except Exception:
+                pass
+            os.remove(temp_path)
+
+class EditJournal:
+    #追記専用の編集ジャーナル。前回記録したテキストとの差分を1レコードにまとめて追記し、
+    #書き込みとfsyncはワーカースレッドでまとめて行う。大きくなったらスナップショットへ畳み込む
+    FLUSH_MS = 2000
+    COMPACT_BYTES = 1024 * 1024
+    COMPACT_RECORDS = 300
+
+    LOCK_NAME = "owner.lock"
+
+    def __init__(self, root_directory):
+        #起動中のインスタンスごとに別のディレクトリを使い、ロックファイルを開いている間はほかから触らせない
+        self.root_directory = root_directory
+        self.directory = os.path.join(root_directory, f"{os.getpid()}-{uuid.uuid4().hex[:8]}")
+        self.journal_path = os.path.join(self.directory, "journal.log")
+        self.snapshot_path = os.path.join(self.directory, "snapshot.json")
+        self.lock = None
+        #復元を確認した(または空だった)前回のジャーナルと、そのロック
+        self.recovered = []
+        self.text = ""
+        self.auto_indent = []
+        self.seq = 0
+        self.journal_bytes = 0
+        self.journal_records = 0
+        self.queue = queue.Queue()
+        self.worker = None
+
+    @staticmethod
+    def acquire_lock(directory):
+        #ロックファイルに排他ロックをかけて開いたままにする。持ち主が動いていればNone
+        try:
+            f = open(os.path.join(directory, EditJournal.LOCK_NAME), "a+")
+        except OSError:
+            return None
+        try:
+            if os.name == "nt":
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return None
+        return f
+
+    def flags_to_str(self, flags):
+        return "".join("1" if flag else "0" for flag in flags)
+
+    def start(self, text, auto_indent, file_path, saved):
+        os.makedirs(self.directory, exist_ok=True)
+        if self.lock is None:
+            self.lock = self.acquire_lock(self.directory)
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.work, daemon=True)
+            self.worker.start()
+        self.reset(text, auto_indent, file_path, saved)
+
+    def reset(self, text, auto_indent, file_path, saved):
+        #今の状態をスナップショットにしてジャーナルを空にする
+        #保存済みのファイルならテキストは書かず、ファイルそのものを基準にする
+        self.text = text
+        self.auto_indent = list(auto_indent)
+        self.journal_bytes = 0
+        self.journal_records = 0
+        snapshot = {"seq": self.seq, "file_path": file_path, "saved": saved, "auto_indent": self.flags_to_str(auto_indent)}
+        if saved and file_path and os.path.exists(file_path):
+            stat = os.stat(file_path)
+            snapshot["file_size"] = stat.st_size
+            snapshot["file_mtime"] = stat.st_mtime
+        else:
+            snapshot["text"] = text
+        self.queue.put(("snapshot", snapshot))
+
+    def record(self, text, auto_indent, file_path):
+        #前回記録したテキストとの差分を [seq, 位置, 削除文字数, 挿入文字列, 挿入した改行の字下げ] の1行にする
+        old, old_flags = self.text, self.auto_indent
+        if text is old and auto_indent == old_flags:
+            return
+        prefix = common_prefix_length(old, text)
+        suffix = common_suffix_length(old, text, min(len(old), len(text)) - prefix)
+        #字下げが変わった改行は差分の範囲に含め、範囲の外の字下げは前回と同じにする
+        flag_prefix = common_prefix_length(old_flags, auto_indent)
+        flag_suffix = common_suffix_length(old_flags, auto_indent, min(len(old_flags), len(auto_indent)) - flag_prefix)
+        for _ in range(text.count("\n", 0, prefix) - flag_prefix):
+            prefix = text.rfind("\n", 0, prefix)
+        for _ in range(text.count("\n", len(text) - suffix) - flag_suffix):
+            suffix = len(text) - text.find("\n", len(text) - suffix) - 1
+        self.text = text
+        self.auto_indent = list(auto_indent)
+        if prefix == len(old) == len(text):
+            return
+        inserted = text[prefix:len(text) - suffix]
+        first_newline = text.count("\n", 0, prefix)
+        flags = auto_indent[first_newline:first_newline + inserted.count("\n")]
+        self.seq += 1
+        line = json.dumps([self.seq, prefix, len(old) - suffix - prefix, inserted, self.flags_to_str(flags)], ensure_ascii=False) + "\n"
+        self.journal_bytes += len(line)
+        self.journal_records += 1
+        if self.journal_bytes > self.COMPACT_BYTES or self.journal_records > self.COMPACT_RECORDS:
+            self.reset(text, auto_indent, file_path, False)
+        else:
+            self.queue.put(("record", line))
+
+    def work(self):
+        while True:
+            items = [self.queue.get()]
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            for item in items:
+                if item is None:
+                    self.append(lines)
+                    return
+                kind, value = item
+                if kind == "record":
+                    lines.append(value)
+                elif kind == "snapshot":
+                    #スナップショットより前のレコードは書く必要がない
+                    lines = []
+                    self.write_snapshot(value)
+                elif kind == "discard":
+                    lines = []
+                    for path in (self.snapshot_path, self.journal_path):
+                        if os.path.exists(path):
+                            os.remove(path)
+                elif kind == "remove":
+                    #ほかのインスタンスが残したジャーナルを、ロックを外してから消す
+                    for directory, lock in value:
+                        lock.close()
+                        shutil.rmtree(directory, ignore_errors=True)
+            self.append(lines)
+
+    def append(self, lines):
+        if not lines:
+            return
+        with open(self.journal_path, "a", encoding="utf-8") as f:
+            f.write("".join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def write_snapshot(self, snapshot):
+        temp_path = self.snapshot_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.snapshot_path)
+        #スナップショットに含まれたレコードはseqで読み飛ばすので、ここで落ちても壊れない
+        with open(self.journal_path, "w", encoding="utf-8") as f:
+            f.flush()
+            os.fsync(f.fileno())
+
+    def recover(self, read_file):
+        #持ち主が終了しているジャーナルを新しい順に調べ、最初に見つかった復元内容を
+        #(テキスト, 自動字下げ, ファイル) で返す。復元するものがなければNone
+        #起動中のほかのインスタンスのジャーナルはロックが取れないので触らない
+        if not os.path.isdir(self.root_directory):
+            return None
+        candidates = []
+        for name in os.listdir(self.root_directory):
+            directory = os.path.join(self.root_directory, name)
+            if directory == self.directory or not os.path.isdir(directory):
+                continue
+            lock = self.acquire_lock(directory)
+            if lock is not None:
+                mtime = max(os.path.getmtime(os.path.join(directory, entry)) for entry in os.listdir(directory))
+                candidates.append((mtime, directory, lock))
+        candidates.sort(reverse=True)
+        result = None
+        for mtime, directory, lock in candidates:
+            if result is None:
+                result = self.replay(directory, read_file)
+                self.recovered.append((directory, lock))
+            else:
+                #残りは次に起動したときに確認する
+                lock.close()
+        return result
+
+    def discard_recovered(self):
+        if self.recovered:
+            self.queue.put(("remove", self.recovered))
+            self.recovered = []
+
+    def replay(self, directory, read_file):
+        #スナップショットにジャーナルを再生する
+        snapshot_path = os.path.join(directory, "snapshot.json")
+        journal_path = os.path.join(directory, "journal.log")
+        if not os.path.exists(snapshot_path) and not os.path.exists(journal_path):
+            return None
+        try:
+            with open(snapshot_path, "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+            if "text" in snapshot:
+                text = snapshot["text"]
+            else:
+                stat = os.stat(snapshot["file_path"])
+                if stat.st_size != snapshot["file_size"] or stat.st_mtime != snapshot["file_mtime"]:
+                    return None
+                text = read_file(snapshot["file_path"])
+        except Exception:
+            snapshot = {"seq": 0, "file_path": None, "saved": True, "auto_indent": ""}
+            text = ""
+        auto_indent = [flag == "1" for flag in snapshot["auto_indent"]]
+        applied = 0
+        if os.path.exists(journal_path):
+            with open(journal_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        seq, pos, deleted, inserted, flags = json.loads(line)
+                    except ValueError:
+                        #書きかけの最後の行
+                        break
+                    if seq <= snapshot["seq"]:
+                        continue
+                    first_newline = text.count("\n", 0, pos)
+                    removed_newlines = text.count("\n", pos, pos + deleted)
+                    new_flags = [flag == "1" for flag in flags]
+                    new_flags += [False] * (inserted.count("\n") - len(new_flags))
+                    auto_indent[first_newline:first_newline + removed_newlines] = new_flags
+                    text = text[:pos] + inserted + text[pos + deleted:]
+                    self.seq = max(self.seq, seq)
+                    applied += 1
+        if not applied and snapshot["saved"]:
+            return None
+        return text, auto_indent, snapshot["file_path"]
+
+    def close(self, clean):
+        #保存済みの状態で終わるときはジャーナルを消す
+        if clean:
+            self.queue.put(("discard", None))
+        self.queue.put(None)
+        self.worker.join(timeout=5)
+        self.worker = None
+        if self.lock is not None:
+            self.lock.close()
+            self.lock = None
+            if clean:
+                shutil.rmtree(self.directory, ignore_errors=True)
+
+class LayoutIndex:
+    #画面の列(縦書きの1行)ごとに、先頭の文字位置・それまでの改行数・先頭の段(行の高さ単位)・括弧チェックの途中状態を持つ索引
+    #列kのx座標は 右端 - 文字幅*1.5*k なので、列の先頭さえ分かれば座標は二分探索で求まる
+    OPENERS = {"「": "」", "『": "』", "（": "）", "【": "】", "《": "》", "[": "]"}
+    BRACKETS = re.compile(r"[「『（【《\[」』）】》\]]")
+
+    def __init__(self):
+        self.key = None
+        self.rows = 1
+        self.text = ""
+        self.auto_indent = []
+        self.markup = EMPTY_MARKUP
+        self.starts = np.zeros(1, dtype=np.int64)
+        self.newlines = np.zeros(1, dtype=np.int64)
+        self.first_rows = np.ones(1, dtype=np.int8)
+        self.stacks = [""]
+        #更新のたびに増える番号と、直前の更新で変わった範囲
+        #changed = (流し直した最初の列, 流し直した最後の列+1, 使い回した古い列の先頭かNone, 括弧の状態を数え直した最初の列かNone)
+        self.version = 0
+        self.changed = (0, 1, None, None)
+
+    def set_key(self, key):
+        #key = (キャンバスの高さ, 行の高さ)。1列に入る段数が決まる
+        height, line_height = key
+        self.key = key
+        self.rows = max(0, (height - line_height) // line_height)
+
+    def push_bracket(self, stack, char):
+        if char in self.OPENERS:
+            stack.append(self.OPENERS[char])
+        elif stack and stack[-1] == char:
+            stack.pop()
+
+    def scan(self, i, nl, row, stack, end):
+        #iからendまでを流し込み、新しく始まる列を返す。注記を含まない段落は折り返し位置を計算で求める
+        text = self.text
+        auto_indent = self.auto_indent
+        rows = self.rows
+        starts, newlines, first_rows, stacks = [], [], [], []
+        #注記のある段落を先頭から順に突き合わせる
+        markup = self.markup
+        first = max(0, int(np.searchsorted(markup.starts, i, side="right")) - 1)
+        marked_starts = markup.starts[first:int(np.searchsorted(markup.starts, end, side="left"))].tolist()
+        marked = markup.paragraphs[first:first + len(marked_starts)]
+        k = 0
+        para_start = text.rfind("\n", 0, i) + 1
+        while i < end:
+            newline = text.find("\n", i, end)
+            para_end = end if newline == -1 else newline
+            while k < len(marked_starts) and marked_starts[k] < para_start:
+                k += 1
+            para = marked[k] if k < len(marked_starts) and marked_starts[k] == para_start else None
+            if para is not None and para.hidden[-1] >= i - para_start:
+                hidden = para.hidden_set
+                for pos in range(i, para_end):
+                    if pos - para_start in hidden:
+                        continue
+                    char = text[pos]
+                    if char in "「『（【《[」』）】》]":
+                        self.push_bracket(stack, char)
+                    row += 1
+                    if row > rows:
+                        row = 1
+                        starts.append(pos + 1)
+                        newlines.append(nl)
+                        first_rows.append(1)
+                        stacks.append("".join(stack))
+            else:
+                brackets = [(m.start(), m.group()) for m in self.BRACKETS.finditer(text, i, para_end)]
+                b = 0
+                pos = i
+                while True:
+                    wrap = pos + max(1, rows - row + 1)
+                    if wrap > para_end:
+                        break
+                    while b < len(brackets) and brackets[b][0] < wrap:
+                        self.push_bracket(stack, brackets[b][1])
+                        b += 1
+                    row = 1
+                    pos = wrap
+                    starts.append(wrap)
+                    newlines.append(nl)
+                    first_rows.append(1)
+                    stacks.append("".join(stack))
+                row += para_end - pos
+                for _, char in brackets[b:]:
+                    self.push_bracket(stack, char)
+            if newline == -1:
+                i = end
+                break
+            row = 2 if nl < len(auto_indent) and auto_indent[nl] else 1
+            nl += 1
+            i = para_start = newline + 1
+            starts.append(i)
+            newlines.append(nl)
+            first_rows.append(row)
+            stacks.append("".join(stack))
+        return starts, newlines, first_rows, stacks
+
+    def rebuild(self):
+        new = self.scan(0, 0, 1, [], len(self.text))
+        self.starts = np.array([0] + new[0], dtype=np.int64)
+        self.newlines = np.array([0] + new[1], dtype=np.int64)
+        self.first_rows = np.array([1] + new[2], dtype=np.int8)
+        self.stacks = [""] + new[3]
+        self.version += 1
+        self.changed = (0, len(self.starts), None, None)
+
+    def rebuild_stacks(self, col):
+        #col列目以降の括弧の途中状態だけを数え直す
+        stack = list(self.stacks[col])
+        stacks = self.stacks[:col + 1]
+        starts = self.starts
+        next_col = col + 1
+        brackets = [(m.start(), m.group()) for m in self.BRACKETS.finditer(self.text, int(starts[col]))]
+        hidden = self.markup.hidden_flags([pos for pos, _ in brackets])
+        for (pos, char), is_hidden in zip(brackets, hidden):
+            while next_col < len(starts) and starts[next_col] <= pos:
+                stacks.append("".join(stack))
+                next_col += 1
+            if not is_hidden:
+                self.push_bracket(stack, char)
+        while next_col < len(starts):
+            stacks.append("".join(stack))
+            next_col += 1
+        self.stacks = stacks
+
+    def update(self, text, auto_indent, markup, key):
+        #編集された段落だけ流し直し、後ろの列は文字数のずれだけ平行移動する。変更があればTrue
+        if key == self.key and text is self.text and markup is self.markup and auto_indent == self.auto_indent:
+            return False
+        old_text, old_indent = self.text, self.auto_indent
+        old_markup = self.markup
+        full = key != self.key or (markup is EMPTY_MARKUP) != (old_markup is EMPTY_MARKUP) or text == old_text
+        self.text = text
+        self.auto_indent = list(auto_indent)
+        self.markup = markup
+        if full:
+            self.set_key(key)
+            self.rebuild()
+            return True
+
+        prefix = common_prefix_length(old_text, text)
+        suffix = common_suffix_length(old_text, text, min(len(old_text), len(text)) - prefix)
+        para_start = text.rfind("\n", 0, prefix) + 1
+        keep = int(np.searchsorted(self.starts, para_start, side="right"))
+        if common_prefix_length(old_indent, self.auto_indent) < self.newlines[keep - 1]:
+            self.rebuild()
+            return True
+        #編集範囲の後ろの最初の段落から先は、並びが変わらないので使い回す
+        tail = None
+        old_tail_newline = old_text.find("\n", len(old_text) - suffix)
+        if old_tail_newline != -1:
+            old_tail = old_tail_newline + 1
+            tail_newlines = old_text.count("\n", old_tail_newline)
+            j = int(np.searchsorted(self.starts, old_tail, side="left"))
+            if (j < len(self.starts) and self.starts[j] == old_tail and tail_newlines <= min(len(old_indent), len(self.auto_indent))
+                    and old_indent[len(old_indent) - tail_newlines:] == self.auto_indent[len(self.auto_indent) - tail_newlines:]):
+                tail = (j, old_tail + len(text) - len(old_text))
+            else:
+                self.rebuild()
+                return True
+
+        start_col = keep - 1
+        end = len(text) if tail is None else tail[1]
+        new = self.scan(int(self.starts[start_col]), int(self.newlines[start_col]), int(self.first_rows[start_col]),
+                        list(self.stacks[start_col]), end)
+        starts = [self.starts[:keep], np.array(new[0], dtype=np.int64)]
+        newlines = [self.newlines[:keep], np.array(new[1], dtype=np.int64)]
+        first_rows = [self.first_rows[:keep], np.array(new[2], dtype=np.int8)]
+        stacks = self.stacks[:keep] + new[3]
+        restack = None
+        if tail is not None:
+            j, new_tail = tail
+            #流し直した最後の列(=後ろの最初の段落の先頭)を、平行移動した古い列に置き換える
+            nl_delta = new[1][-1] - int(self.newlines[j])
+            fresh_stack = stacks.pop()
+            starts[1] = starts[1][:-1]
+            newlines[1] = newlines[1][:-1]
+            first_rows[1] = first_rows[1][:-1]
+            starts.append(self.starts[j:] + (new_tail - int(self.starts[j])))
+            newlines.append(self.newlines[j:] + nl_delta)
+            first_rows.append(self.first_rows[j:])
+            if fresh_stack != self.stacks[j]:
+                restack = len(stacks)
+            stacks += self.stacks[j:]
+            if restack is not None:
+                stacks[restack] = fresh_stack
+        self.version += 1
+        self.changed = (start_col, keep + len(starts[1]), None if tail is None else tail[0], restack)
+        self.starts = np.concatenate(starts)
+        self.newlines = np.concatenate(newlines)
+        self.first_rows = np.concatenate(first_rows)
+        self.stacks = stacks
+        if restack is not None:
+            self.rebuild_stacks(restack)
+        return True
+
+    def column_count(self):
+        return len(self.starts)
+
+    def column_of(self, pos):
+        return int(np.searchsorted(self.starts, pos, side="right")) - 1
+
+    def column_end(self, col):
+        #列に含まれる最後の位置(+1)
+        return int(self.starts[col + 1]) if col + 1 < len(self.starts) else len(self.text) + 1
+
+    def row_of(self, pos):
+        #posの文字が置かれる (列, 段)
+        pos = max(0, min(pos, len(self.text)))
+        col = self.column_of(pos)
+        start = int(self.starts[col])
+        row = int(self.first_rows[col]) + pos - start - self.markup.hidden_count(start, pos)
+        return col, row
+
+    def index_at(self, col, row):
+        #列colの段rowにある最初の位置。なければNone
+        if not 0 <= col < len(self.starts):
+            return None
+        start = int(self.starts[col])
+        end = min(self.column_end(col), len(self.text) + 1)
+        current = int(self.first_rows[col])
+        hidden = self.markup.window(start, end).hidden
+        for pos in range(start, end):
+            if current == row:
+                return pos
+            if pos not in hidden:
+                if current > row:
+                    return None
+                current += 1
+        return None
+
+    def mismatch_columns(self, first, last):
+        #first〜last-1列目のうち、対応しない閉じ括弧を含む列の番号
+        return np.searchsorted(self.starts, self.mismatch_positions(first, last), side="right") - 1
+
+    def mismatch_positions(self, first, last):
+        #first〜last-1列目にある、対応しない閉じ括弧の位置
+        if first >= last:
+            return []
+        stack = list(self.stacks[first])
+        brackets = [(m.start(), m.group()) for m in self.BRACKETS.finditer(self.text, int(self.starts[first]), min(self.column_end(last - 1), len(self.text)))]
+        hidden = self.markup.hidden_flags([pos for pos, _ in brackets])
+        positions = []
+        for (pos, char), is_hidden in zip(brackets, hidden):
+            if is_hidden:
+                continue
+            if char in self.OPENERS:
+                stack.append(self.OPENERS[char])
+            elif stack and stack[-1] == char:
+                stack.pop()
+            else:
+                positions.append(pos)
+        return positions
+
+    def dump(self):
+        sparse_stacks = {str(i): stack for i, stack in enumerate(self.stacks) if stack}
+        return {"layout_key": np.array(self.key), "starts": self.starts, "newlines": self.newlines,
+                "first_rows": self.first_rows, "stacks": np.array(json.dumps(sparse_stacks, ensure_ascii=False))}
+
+    def load(self, text, auto_indent, markup, key, data):
+        #保存しておいた列の索引をそのまま使う(流し込みを省く)
+        self.set_key(key)
+        self.text = text
+        self.auto_indent = list(auto_indent)
+        self.markup = markup
+        self.starts = data["starts"]
+        self.newlines = data["newlines"]
+        self.first_rows = data["first_rows"]
+        sparse_stacks = json.loads(str(data["stacks"]))
+        self.stacks = [sparse_stacks.get(str(i), "") for i in range(len(self.starts))]
+        self.version += 1
+        self.changed = (0, len(self.starts), None, None)
+
+class SessionCache:
+    #内容のハッシュをキーに、開き直しに使う状態をnpzで保存しておく
+    MAX_FILES = 50
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, file_hash):
+        return os.path.join(self.directory, file_hash + ".npz")
+
+    def load(self, file_hash):
+        path = self.path(file_hash)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                return {name: data[name] for name in data.files}
+        except Exception:
+            return None
+
+    def save(self, file_hash, data):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            temp_path = self.path(file_hash) + ".tmp.npz"
+            np.savez_compressed(temp_path, **data)
+            os.replace(temp_path, self.path(file_hash))
+            self.prune()
+        except OSError:
+            pass
+
+    def prune(self):
+        #古いものから消して件数を抑える
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".npz")]
+        paths.sort(key=os.path.getmtime, reverse=True)
+        for path in paths[self.MAX_FILES:]:
+            os.remove(path)
+
+class FontCatalog:
+    #フォント一覧と縦書き用の寸法(行の高さ・全角の幅など)を一度だけ調べ、ディスクにキャッシュする
+    #tkのフォントAPIはメインスレッドでしか呼べないので、起動後の空き時間に少しずつ測る
+    REFERENCE_SIZE = 20
+    BATCH = 8
+    SAMPLE = "吾輩は猫である。名前はまだ無い。\n「どこで生れたか」とんと見当がつかぬ。"
+
+    def __init__(self, path):
+        self.path = path
+        self.families = []
+        self.metrics = {}
+        self.pending = []
+        self.root = None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.families = data["families"]
+            self.metrics = {family: tuple(values) for family, values in data["metrics"].items()}
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def start(self, root):
+        #一覧はキャッシュがあればそのまま使う。font.families()は重いので、調べ直すのはキャッシュがないときと
+        #フォント選択で「再読み込み」を押したときだけ(それまでに追加・削除されたフォントは一覧に反映されない)
+        self.root = root
+        if not self.families:
+            root.after(1000, self.refresh)
+            return
+        #前回測り終わらなかったフォントの寸法だけ続きを測る
+        self.pending = [family for family in self.families if family not in self.metrics]
+        if self.pending:
+            root.after(1000, self.measure_batch)
+
+    def get_families(self):
+        #キャッシュがまだなければ、このときだけその場で調べる
+        if not self.families:
+            self.refresh()
+        return self.families
+
+    def refresh(self):
+        families = sorted({f for f in font.families(self.root) if not f.startswith("@")})
+        changed = families != self.families
+        self.families = families
+        for family in set(self.metrics) - set(families):
+            del self.metrics[family]
+        self.pending = [family for family in families if family not in self.metrics]
+        if self.pending:
+            self.root.after_idle(self.measure_batch)
+        elif changed:
+            self.save()
+
+    def measure(self, family):
+        f = font.Font(root=self.root, family=family, size=self.REFERENCE_SIZE)
+        self.metrics[family] = (f.metrics("linespace"), f.metrics("ascent"), f.metrics("descent"), f.measure("あ"))
+        return self.metrics[family]
+
+    def measure_batch(self):
+        for family in self.pending[:self.BATCH]:
+            self.measure(family)
+        del self.pending[:self.BATCH]
+        if self.pending:
+            self.root.after(10, self.measure_batch)
+        else:
+            self.save()
+
+    def scaled_metrics(self, family, size):
+        #(行の高さ, 全角の幅) をsizeに合わせて返す
+        values = self.metrics.get(family) or self.measure(family)
+        scale = size / self.REFERENCE_SIZE
+        return values[0] * scale, values[3] * scale
+
+    def save(self):
+        data = {"families": list(self.families), "metrics": dict(self.metrics)}
+        threading.Thread(target=self.write, args=(data,), daemon=True).start()
+
+    def write(self, data):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(temp_path, self.path)
+        except OSError:
+            pass
+
+class PdfPageModel:
+    #PDF出力と印刷プレビューで共通のページ割り
+    #各ページ先頭の状態(文字位置, 改行数, x, y)だけを覚えておき、編集位置より後ろのページだけ割り直す
+    ROTATE_CHARS = "「『（【《」』）】》―ー"
+    #注記はこの文字数ずつ取り出して使う
+    MARKUP_WINDOW = 4096
+
+    def __init__(self, page_size, char_width, line_height, font_size):
+        self.width, self.height = page_size
+        self.char_width = char_width
+        self.line_height = line_height
+        self.font_size = font_size
+        self.ruby_size = max(4, font_size / 2)
+        self.text = ""
+        self.auto_indent = []
+        self.markup = EMPTY_MARKUP
+        self.page_starts = [(0, 0, self.width - char_width, self.height)]
+        self.complete = False
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def update(self, text, auto_indent, markup):
+        #変更があれば編集位置を含むページから後ろを無効にして、そのページ番号を返す
+        with self.lock:
+            if text is self.text and auto_indent == self.auto_indent and markup is self.markup:
+                return None
+            if text is self.text or text == self.text:
+                #注記の表示切り替えなどテキスト以外の変更は全ページ割り直し
+                edit_pos = 0 if markup is not self.markup else len(text)
+            else:
+                edit_pos = common_prefix_length(self.text, text)
+            indent_diff = common_prefix_length(self.auto_indent, auto_indent)
+            if indent_diff < text.count("\n", 0, edit_pos):
+                edit_pos = -1
+                for _ in range(indent_diff + 1):
+                    edit_pos = text.find("\n", edit_pos + 1)
+            #注記は段落単位で変わるので、段落の先頭から割り直す
+            edit_pos = text.rfind("\n", 0, edit_pos) + 1
+            keep = max(1, bisect.bisect_left([state[0] for state in self.page_starts], edit_pos))
+            del self.page_starts[keep:]
+            self.text = text
+            self.auto_indent = list(auto_indent)
+            self.markup = markup
+            self.complete = False
+            self.generation += 1
+            return keep - 1
+
+    def layout_page(self, state, text, auto_indent, markup):
+        #1ページ分の描画命令と次のページの先頭状態(最終ページならNone)を返す
+        width, height = self.width, self.height
+        char_width, line_height = self.char_width, self.line_height
+        char_index, count_return, x, y = state
+        page_ops = []
+        ruby_start = None
+        window = markup.window(char_index, char_index + self.MARKUP_WINDOW)
+        while char_index < len(text):
+            if char_index >= window.end:
+                window = markup.window(char_index, char_index + self.MARKUP_WINDOW)
+            char = text[char_index]
+            if char_index == 0:
+                y = height - line_height
+            #注記の記号は出力せず、改ページ注記でページを送る
+            if char_index in window.hidden:
+                if char_index in window.page_breaks and char_index > 0:
+                    return page_ops, (char_index + 1, count_return, width - char_width, height - line_height)
+                char_index += 1
+                continue
+            if char == "\n":
+                if count_return < len(auto_indent) and auto_indent[count_return]: #機能がONかOFFか
+                    y = height - line_height*2
+                else:
+                    y = height - line_height
+                x -= char_width * 1.5
+                count_return += 1
+                char_index += 1
+                continue
+
+            offset_x = 0
+            offset_y = 0
+            angle = 0
+            if char in self.ROTATE_CHARS:
+                angle=-90
+                offset_x = char_width//4
+                offset_y = line_height//4
+            elif char in "、。":
+                offset_x = char_width // 2
+                offset_y = -line_height // 4
+            elif char in "「『（［｛":
+                offset_y = -line_height // 4
+            elif char in "」』）］｝":
+                offset_y = line_height // 4
+
+            offset_x *= mm
+            offset_y *= mm
+
+            y -= line_height
+            if y < 0 :
+                y = height-line_height * 2
+                x -= char_width * 1.5
+            if x - char_width < 0:
+                #この文字から次のページ
+                return page_ops, (char_index, count_return, width - char_width, height - line_height)
+            page_ops.append(("char", char, x + offset_x, y + offset_y, angle))
+
+            #傍点
+            if char_index in window.bouten:
+                page_ops.append(("dot", x + char_width + 2, y + self.font_size / 2))
+
+            #ルビは親文字の右側の行間に小さい文字で描く
+            if char_index in window.ruby:
+                ruby_end, ruby_text = window.ruby[char_index]
+                ruby_start = (x, y + self.font_size, ruby_end, ruby_text)
+            if ruby_start is not None and char_index == ruby_start[2] - 1:
+                ruby_x, ruby_top, ruby_end, ruby_text = ruby_start
+                ruby_bottom = y if x == ruby_x else line_height
+                step = max(self.ruby_size, (ruby_top - ruby_bottom) / len(ruby_text))
+                ruby_y = ruby_top - ((ruby_top - ruby_bottom) - step * len(ruby_text)) / 2
+                for ruby_char in ruby_text:
+                    ruby_y -= step
+                    page_ops.append(("ruby", ruby_x + char_width + 1, ruby_y + (step - self.ruby_size) / 2, ruby_char))
+                ruby_start = None
+            char_index += 1
+        return page_ops, None
+
+    def iter_pages(self):
+        #先頭から順に全ページの描画命令を返す(PDF出力用)
+        with self.lock:
+            text, auto_indent, markup = self.text, self.auto_indent, self.markup
+        state = self.page_starts[0]
+        while state is not None:
+            page_ops, state = self.layout_page(state, text, auto_indent, markup)
+            yield page_ops
+
+    def get_pages(self, page_number):
+        #指定ページまでページ割りを進め、途中で割ったページも含めて描画命令を返す(ワーカースレッドから呼ばれる)
+        with self.lock:
+            generation = self.generation
+            text, auto_indent, markup = self.text, self.auto_indent, self.markup
+            starts = list(self.page_starts)
+            complete = self.complete
+        if complete:
+            page_number = min(page_number, len(starts) - 1)
+        page = min(page_number, len(starts) - 1)
+        pages = {}
+        while True:
+            page_ops, next_state = self.layout_page(starts[page], text, auto_indent, markup)
+            pages[page] = page_ops
+            if next_state is None:
+                complete = True
+                break
+            if page + 1 == len(starts):
+                starts.append(next_state)
+            if page >= page_number:
+                break
+            page += 1
+        with self.lock:
+            if generation != self.generation:
+                return generation, None, False
+            if len(starts) > len(self.page_starts):
+                self.page_starts = starts
+            self.complete = self.complete or complete
+            return generation, pages, self.complete
+
+    def known_page_count(self):
+        with self.lock:
+            return len(self.page_starts), self.complete
+
+class PageCache:
+    #ページの描画命令を、推定メモリ量を上限にLRUで保持する
+    BYTES_PER_OP = 200
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.pages = OrderedDict()
+        self.size = 0
+
+    def get(self, page_number):
+        page_ops = self.pages.get(page_number)
+        if page_ops is not None:
+            self.pages.move_to_end(page_number)
+        return page_ops
+
+    def put(self, page_number, page_ops):
+        if page_number in self.pages:
+            self.size -= len(self.pages.pop(page_number)) * self.BYTES_PER_OP
+        self.pages[page_number] = page_ops
+        self.size += len(page_ops) * self.BYTES_PER_OP
+        while self.size > self.max_bytes and len(self.pages) > 1:
+            _, old_ops = self.pages.popitem(last=False)
+            self.size -= len(old_ops) * self.BYTES_PER_OP
+
+    def invalidate_from(self, page_number):
+        for key in [key for key in self.pages if key >= page_number]:
+            self.size -= len(self.pages.pop(key)) * self.BYTES_PER_OP
+
+    def clear(self):
+        self.pages.clear()
+        self.size = 0
+
+class TkPdfCanvas:
+    #reportlabのCanvasと同じ呼び出しでtkのキャンバスへ縮小して描く(印刷プレビュー用)
+    def __init__(self, tk_canvas, scale, page_height, font_family):
+        self.canvas = tk_canvas
+        self.scale = scale
+        self.page_height = page_height
+        self.font_family = font_family
+        self.fonts = {}
+        self.font = None
+        self.fill_color = "black"
+        self.stroke_color = "black"
+        self.dash = None
+        self.state = (0, 0, 0)
+        self.saved = []
+
+    def to_screen(self, x, y):
+        offset_x, offset_y, angle = self.state
+        if angle:
+            rad = math.radians(angle)
+            x, y = x * math.cos(rad) - y * math.sin(rad), x * math.sin(rad) + y * math.cos(rad)
+        return (offset_x + x) * self.scale, (self.page_height - offset_y - y) * self.scale
+
+    def color(self, value):
+        if isinstance(value, str):
+            return value
+        return "#" + value.hexval()[2:]
+
+    def setFillColor(self, value):
+        self.fill_color = self.color(value)
+
+    def setStrokeColor(self, value):
+        self.stroke_color = self.color(value)
+
+    def setDash(self, on, off):
+        self.dash = (on, off)
+
+    def setFont(self, name, size):
+        pixel_size = max(1, round(size * self.scale))
+        if pixel_size not in self.fonts:
+            self.fonts[pixel_size] = font.Font(family=self.font_family, size=-pixel_size)
+        self.font = self.fonts[pixel_size]
+
+    def saveState(self):
+        self.saved.append((self.state, self.fill_color, self.stroke_color, self.font))
+
+    def restoreState(self):
+        self.state, self.fill_color, self.stroke_color, self.font = self.saved.pop()
+
+    def translate(self, x, y):
+        offset_x, offset_y, angle = self.state
+        self.state = (offset_x + x, offset_y + y, angle)
+
+    def rotate(self, angle):
+        offset_x, offset_y, current = self.state
+        self.state = (offset_x, offset_y, current + angle)
+
+    def rect(self, x, y, width, height, fill=0):
+        x1, y1 = self.to_screen(x, y)
+        x2, y2 = self.to_screen(x + width, y + height)
+        self.canvas.create_rectangle(x1, y1, x2, y2, fill=self.fill_color if fill else "", outline=self.stroke_color)
+
+    def line(self, x1, y1, x2, y2):
+        sx1, sy1 = self.to_screen(x1, y1)
+        sx2, sy2 = self.to_screen(x2, y2)
+        self.canvas.create_line(sx1, sy1, sx2, sy2, fill=self.stroke_color, dash=self.dash or "")
+
+    def circle(self, x, y, radius, stroke=1, fill=0):
+        cx, cy = self.to_screen(x, y)
+        r = max(1, radius * self.scale)
+        self.canvas.create_oval(cx - r, cy - r, cx + r, cy + r, fill=self.fill_color if fill else "", outline=self.stroke_color if stroke else "")
+
+    def drawString(self, x, y, text):
+        sx, sy = self.to_screen(x, y)
+        self.canvas.create_text(sx, sy, text=text, font=self.font, anchor="sw", angle=self.state[2], fill=self.fill_color)
+
+class TextView:
+    #文書を表示するキャンバス1枚分。テキストと列の索引はVerticalNotepadのものを共有し、キャレット・選択範囲・スクロール位置だけをビューごとに持つ
+    #見えている列(と前後に少し)だけを描き、各項目には列番号のタグ("c列番号")を付けて列単位で描き直す
+    MARGIN_COLUMNS = 2
+
+    def __init__(self, app, parent):
+        self.app = app
+        self.frame = tk.Frame(parent)
+        #横方向スクロール
+        self.scrollbar_x = ttk.Scrollbar(self.frame, orient="horizontal")
+        self.scrollbar_x.pack(side=tk.BOTTOM, fill=tk.X)
+        self.canvas = tk.Canvas(self.frame, bg="white")
+        self.canvas.pack(fill="both", expand=True)
+        self.scrollbar_x.configure(command=self.canvas.xview)
+        self.canvas.configure(xscrollcommand=self.on_xscroll)
+
+        self.text = app.text
+        self.caret_pos = 0
+        self.selected_text_start = None
+        self.selected_text_end = None
+        self.drag_start_pos = None  # ドラッグ開始位置を保持
+        self.drawn = None
+        self.version = None
+        self.key = None
+        self.highlights = None
+        self.decor = None
+
+        self.canvas.bind("<Configure>", self.on_configure)
+        self.canvas.bind("<FocusIn>", lambda e: app.activate_view(self))
+        self.canvas.bind("<Button-1>", lambda e: app.activate_view(self))
+        self.canvas.bind("<Button-1>", app.on_mouse_click, add="+")
+        self.canvas.bind("<B1-Motion>", app.on_mouse_drag)  # ドラッグイベントを追加
+        self.canvas.bind("<ButtonRelease-1>", app.on_mouse_release)  # リリースイベントを追加
+        self.canvas.bind("<Key>", app.on_key_press)
+        self.canvas.bind("<MouseWheel>", app.on_mousewheel)
+
+    def on_configure(self, event):
+        if self is self.app.view:
+            self.app.redraw()
+        else:
+            self.repaint()
+
+    def visible_columns(self, layout):
+        #画面に見えている列の範囲(前後に余分を足す)
+        char_width = self.app.current_font.measure("あ")
+        width = self.canvas.winfo_width()
+        step = char_width * 1.5
+        count = layout.column_count()
+        first = int((width - char_width - self.canvas.canvasx(width)) // step) - self.MARGIN_COLUMNS
+        last = int((width - char_width - self.canvas.canvasx(0)) // step) + 1 + self.MARGIN_COLUMNS
+        last = max(0, min(count, last))
+        return max(0, min(first, last)), last
+
+    def sync_text(self):
+        #ほかのビューでの編集に合わせて、キャレットと選択範囲の位置をずらす
+        text = self.app.text
+        if self.text is text:
+            return
+        old_text = self.text
+        prefix = common_prefix_length(old_text, text)
+        suffix = common_suffix_length(old_text, text, min(len(old_text), len(text)) - prefix)
+        delta = len(text) - len(old_text)
+
+        def shift(pos):
+            if pos is None:
+                return None
+            if pos >= len(old_text) - suffix:
+                return min(pos + delta, len(text))
+            return min(pos, prefix)
+
+        self.caret_pos = shift(self.caret_pos)
+        self.selected_text_start = shift(self.selected_text_start)
+        self.selected_text_end = shift(self.selected_text_end)
+        self.drag_start_pos = shift(self.drag_start_pos)
+        self.text = text
+
+    def repaint(self):
+        #見えている列をすべて描き直す
+        app = self.app
+        layout = app.get_layout()
+        if self is not app.view:
+            self.sync_text()
+        self.text = app.text
+        self.canvas.delete("all")
+        #原稿用紙風テーマに設定時のみ
+        app.draw_grid_layer(self.canvas)
+        self.drawn = self.visible_columns(layout)
+        app.draw_columns(self, *self.drawn)
+        self.version = layout.version
+        self.key = layout.key
+        self.highlights = app.highlighted_ranges
+        self.decor = self.get_decor()
+        self.draw_caret()
+        self.update_scrollregion(layout)
+
+    def refresh(self):
+        #ほかのビューで編集されたとき、変わった列とその後ろで位置のずれた列だけを描き直す
+        app = self.app
+        layout = app.get_layout()
+        self.sync_text()
+        decor = self.get_decor()
+        if (self.drawn is None or layout.key != self.key or self.highlights is not app.highlighted_ranges or decor != self.decor
+                or layout.version not in (self.version, self.version + 1)):
+            self.repaint()
+            return
+        if layout.version == self.version + 1:
+            first, last, old_tail, restack = layout.changed
+            if old_tail is None or last != old_tail or (restack is not None and decor[1]):
+                last = self.drawn[1]
+            first = max(first, self.drawn[0])
+            last = min(last, self.drawn[1])
+            for col in range(first, last):
+                self.canvas.delete(f"c{col}")
+            app.draw_columns(self, first, last)
+            self.version = layout.version
+            self.update_scrollregion(layout)
+        self.draw_caret()
+
+    def get_decor(self):
+        #列の索引のほかに描画に効く状態(検索結果の選択・括弧チェック・比較結果・校正結果)
+        app = self.app
+        diff = app.revision_diff
+        if diff is not None:
+            diff.update(app.text)
+        linter_version = None
+        if app.proofread.get():
+            app.linter.update(app.text)
+            linter_version = app.linter.version
+        return (app.search_index, app.check_kakko_mismatch.get(), diff, diff.version if diff is not None else 0, linter_version)
+
+    def extend_drawn(self):
+        #スクロールで新しく見えた列を描き足す。離れた位置へ飛んだときは描き直す
+        layout = self.app.get_layout()
+        if layout.version != self.version:
+            return
+        first, last = self.visible_columns(layout)
+        drawn_first, drawn_last = self.drawn
+        if first >= drawn_first and last <= drawn_last:
+            return
+        if first >= drawn_last or last <= drawn_first or drawn_last - drawn_first > 4 * (last - first):
+            self.canvas.delete("column")
+            self.app.draw_columns(self, first, last)
+            self.drawn = (first, last)
+            return
+        if first < drawn_first:
+            self.app.draw_columns(self, first, drawn_first)
+        if last > drawn_last:
+            self.app.draw_columns(self, drawn_last, last)
+        self.drawn = (min(first, drawn_first), max(last, drawn_last))
+        self.canvas.tag_raise("caret")
+
+    def draw_caret(self):
+        app = self.app
+        line_height = app.current_font.metrics("linespace")
+        char_width = app.current_font.measure("あ")
+        col, row = app.layout.row_of(self.caret_pos)
+        x = self.canvas.winfo_width() - char_width - char_width * 1.5 * col
+        y = line_height * row
+        self.canvas.delete("caret")
+        self.canvas.create_line(x - char_width // 2, y - line_height / 2 + 2, x + char_width // 2, y - line_height / 2 + 2, fill=app.caret_color, tags="caret")
+
+    def update_scrollregion(self, layout):
+        char_width = self.app.current_font.measure("あ")
+        width = self.canvas.winfo_width()
+        max_x = min(width, width - char_width - char_width * 1.5 * (layout.column_count() - 1))
+        self.canvas.configure(scrollregion=(max_x - width * 2, 0, width, self.canvas.winfo_height()))
+
+    def on_xscroll(self, first, last):
+        self.scrollbar_x.set(first, last)
+        if self.drawn is not None:
+            self.extend_drawn()
+        if self is self.app.view and self.app.show_minimap.get():
+            self.app.minimap.show_view()
+
+class Minimap:
+    #文書全体を列ごとの文字の詰まり具合に縮めて表示する帯。検索結果と括弧の不一致に印を付け、クリックでその位置へ移動する
+    #列ごとの値はLayoutIndexが流し直した列の範囲だけ計算し直し、描画も値の変わった区画だけ書き換える
+    HEIGHT = 40
+    MARK_HEIGHT = 6
+    MAX_BAR_WIDTH = 4
+
+    def __init__(self, parent, app):
+        self.app = app
+        self.canvas = tk.Canvas(parent, height=self.HEIGHT, highlightthickness=0, bg="white")
+        self.canvas.bind("<Button-1>", self.on_click)
+        self.canvas.bind("<B1-Motion>", self.on_click)
+        self.canvas.bind("<Configure>", lambda e: self.schedule())
+        self.version = None
+        self.density = np.zeros(0)
+        self.mismatch = np.zeros(0, dtype=bool)
+        self.bars = []
+        self.marks = []
+        self.geometry = None
+        self.heights = np.zeros(0, dtype=np.int64)
+        self.codes = np.zeros(0, dtype=np.int8)
+        self.bar_color = "gray50"
+        self.pending = False
+        self.view_rect = self.canvas.create_rectangle(0, 0, 0, 0, outline="#3399ff", width=2)
+
+    def set_colors(self, background, foreground):
+        self.canvas.config(bg=background)
+        self.bar_color = foreground
+        self.canvas.itemconfig("bar", fill=foreground)
+
+    def column_density(self, layout, first, last):
+        #各列に置かれる段数 / 1列の段数
+        starts = layout.starts[first:last]
+        ends = layout.starts[first + 1:last + 1]
+        ends_newline = layout.newlines[first + 1:last + 1] > layout.newlines[first:len(ends) + first]
+        if len(ends) < len(starts):
+            ends = np.append(ends, len(layout.text))
+            ends_newline = np.append(ends_newline, False)
+        filled = ends - starts - ends_newline + layout.first_rows[first:last] - 1
+        if len(layout.markup.starts):
+            filled = filled - (layout.markup.hidden_before(ends) - layout.markup.hidden_before(starts))
+        return np.clip(filled / max(1, layout.rows), 0, 1)
+
+    def sync(self, layout):
+        #直前の版からの更新なら変わった列だけ、そうでなければ全体を計算する
+        if layout.version == self.version:
+            return
+        count = layout.column_count()
+        first, last, old_tail, restack = layout.changed
+        if self.version is not None and layout.version == self.version + 1 and old_tail is not None:
+            self.density = np.concatenate([self.density[:first], self.column_density(layout, first, last), self.density[old_tail:]])
+            mismatch = np.zeros(count, dtype=bool)
+            mismatch[:first] = self.mismatch[:first]
+            if restack is None:
+                mismatch[last:] = self.mismatch[old_tail:]
+            else:
+                last = count
+            mismatch[layout.mismatch_columns(first, last)] = True
+            self.mismatch = mismatch
+        elif self.version is not None and layout.version == self.version + 1:
+            self.density = np.concatenate([self.density[:first], self.column_density(layout, first, count)])
+            self.mismatch = np.concatenate([self.mismatch[:first], np.zeros(count - first, dtype=bool)])
+            self.mismatch[layout.mismatch_columns(first, count)] = True
+        else:
+            self.density = self.column_density(layout, 0, count)
+            self.mismatch = np.zeros(count, dtype=bool)
+            self.mismatch[layout.mismatch_columns(0, count)] = True
+        self.version = layout.version
+        self.schedule()
+
+    def schedule(self):
+        if not self.pending:
+            self.pending = True
+            self.canvas.after_idle(self.paint)
+
+    def bucket_geometry(self):
+        #(1区画あたりの列数, 区画数, 区画の幅)
+        width = max(1, self.canvas.winfo_width())
+        count = max(1, len(self.density))
+        per_bucket = math.ceil(count / width)
+        buckets = math.ceil(count / per_bucket)
+        return per_bucket, buckets, min(self.MAX_BAR_WIDTH, width / buckets)
+
+    def paint(self):
+        app = self.app
+        self.sync(app.get_layout())
+        self.pending = False
+        width = self.canvas.winfo_width()
+        per_bucket, buckets, bar_width = self.bucket_geometry()
+        bar_area = self.HEIGHT - self.MARK_HEIGHT - 2
+        offsets = np.arange(0, len(self.density), per_bucket)
+        if len(self.density):
+            counts = np.diff(np.append(offsets, len(self.density)))
+            heights = np.rint(np.add.reduceat(self.density, offsets) / counts * bar_area).astype(np.int64)
+            codes = np.where(np.logical_or.reduceat(self.mismatch, offsets) & app.check_kakko_mismatch.get(), 2, 0).astype(np.int8)
+        else:
+            heights = np.zeros(0, dtype=np.int64)
+            codes = np.zeros(0, dtype=np.int8)
+        if app.highlighted_ranges:
+            hits = np.searchsorted(app.layout.starts, [start for start, end in app.highlighted_ranges], side="right") - 1
+            hit_buckets = np.unique(hits // per_bucket)
+            codes[hit_buckets] = np.maximum(codes[hit_buckets], 1)
+
+        geometry = (width, per_bucket, buckets, bar_width)
+        if geometry != self.geometry:
+            #区画の数や幅が変わったときだけ作り直す
+            self.canvas.delete("bar", "mark")
+            self.bars = []
+            self.marks = []
+            for b in range(len(heights)):
+                right = width - b * bar_width
+                self.bars.append(self.canvas.create_rectangle(right - bar_width, 1, right, 1, fill=self.bar_color, outline="", tags="bar"))
+                self.marks.append(self.canvas.create_rectangle(right - bar_width, self.HEIGHT - self.MARK_HEIGHT, right, self.HEIGHT, outline="", state="hidden", tags="mark"))
+            self.geometry = geometry
+            self.heights = np.full(len(heights), -1, dtype=np.int64)
+            self.codes = np.full(len(codes), -1, dtype=np.int8)
+        for b in np.flatnonzero(heights != self.heights):
+            right = width - b * bar_width
+            self.canvas.coords(self.bars[b], right - bar_width, 1, right, 1 + heights[b])
+        for b in np.flatnonzero(codes != self.codes):
+            if codes[b]:
+                self.canvas.itemconfig(self.marks[b], fill="red" if codes[b] == 2 else "gold", state="normal")
+            else:
+                self.canvas.itemconfig(self.marks[b], state="hidden")
+        self.heights = heights
+        self.codes = codes
+        self.show_view()
+
+    def column_to_x(self, col):
+        per_bucket, buckets, bar_width = self.bucket_geometry()
+        return self.canvas.winfo_width() - col / per_bucket * bar_width
+
+    def show_view(self):
+        #本文のキャンバスで見えている列の範囲を枠で示す
+        app = self.app
+        char_width = app.current_font.measure("あ")
+        width = app.canvas.winfo_width()
+        left = app.canvas.canvasx(0)
+        right = app.canvas.canvasx(width)
+        first_col = max(0.0, (width - char_width - right) / (char_width * 1.5))
+        last_col = max(first_col, (width - char_width - left) / (char_width * 1.5))
+        self.canvas.coords(self.view_rect, self.column_to_x(last_col + 0.5), 1, self.column_to_x(first_col - 0.5), self.HEIGHT - 1)
+        self.canvas.tag_raise(self.view_rect)
+
+    def on_click(self, event):
+        #クリックした区画の列が本文の中央に来るようにスクロールする
+        per_bucket, buckets, bar_width = self.bucket_geometry()
+        col = max(0, min(len(self.density) - 1, int((self.canvas.winfo_width() - event.x) / bar_width * per_bucket)))
+        self.app.scroll_to_column(col)
+
+class InputRecorder:
+    #入力を時刻つきで記録し、gzipしたJSON Linesへ書き足していく(メモリには溜めない)
+    #1行目は記録を始めたときの状態、2行目からは[開始からのミリ秒, 種類, 引数...]
+    VERSION = 1
+    FLUSH_MS = 1000
+
+    def __init__(self, app, path):
+        self.path = path
+        self.started = time.perf_counter()
+        self.header = {"version": self.VERSION, "geometry": app.root.winfo_geometry(),
+                       "font": [app.current_font.actual("family"), app.current_font.actual("size")],
+                       "theme": app.theme.get(), "indent_on_newline": app.indent_on_newline.get(),
+                       "check_kakko_mismatch": app.check_kakko_mismatch.get(), "show_ruby": app.show_ruby.get(),
+                       "proofread": app.proofread.get(), "show_minimap": app.show_minimap.get(),
+                       "use_search_index": app.use_search_index.get(),
+                       "text": app.text, "auto_indent": list(app.auto_indent), "caret_pos": app.caret_pos}
+        self.file = gzip.open(path, "wt", encoding="utf-8")
+        self.file.write(json.dumps(self.header, ensure_ascii=False) + "\n")
+        self.flush()
+
+    def record(self, kind, *args):
+        event = [round((time.perf_counter() - self.started) * 1000), kind, *args]
+        self.file.write(json.dumps(event, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+    def flush(self):
+        #gzipのブロックを区切って書き出すので、閉じずに終わってもここまでは読める
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    @staticmethod
+    def load(path):
+        #異常終了して閉じられていない記録は、最後に書き出したところまで読む
+        events = []
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            header = json.loads(f.readline())
+            if header.get("version") != InputRecorder.VERSION:
+                raise ValueError(f"対応していない記録の形式です: {header.get('version')}")
+            try:
+                for line in f:
+                    if line.strip():
+                        events.append(json.loads(line))
+            except (EOFError, ValueError):
+                pass
+        return header, events
+
+class InputReplayer:
+    #記録した入力をVerticalNotepadのハンドラにそのまま渡し、
+    #イベントを渡してから描画が終わるまでの時間と、再生中のメモリのピークを測る
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, app, path, speed=0.0):
+        #speed: 記録したときの間隔の何倍速で流すか。0なら待たずに次を流す
+        self.app = app
+        self.header, self.events = InputRecorder.load(path)
+        self.speed = speed
+        self.latencies = []
+
+    def prepare(self):
+        #記録を始めたときの設定と本文を復元する
+        app, header = self.app, self.header
+        app.root.geometry(header["geometry"])
+        family, size = header["font"]
+        app.current_font = font.Font(family=family, size=size)
+        app.theme.set(header["theme"])
+        app.indent_on_newline.set(header["indent_on_newline"])
+        app.check_kakko_mismatch.set(header["check_kakko_mismatch"])
+        app.show_ruby.set(header["show_ruby"])
+        app.use_search_index.set(header["use_search_index"])
+        app.show_minimap.set(header["show_minimap"])
+        app.on_minimap_change()
+        app.proofread.set(header["proofread"])
+        app.on_proofread_change()
+        app.text = header["text"]
+        app.auto_indent = list(header["auto_indent"])
+        app.caret_pos = header["caret_pos"]
+        app.apply_theme()
+        app.root.update()
+        app.redraw()
+        app.root.update()
+
+    def dispatch(self, kind, args):
+        app = self.app
+        if kind == "key":
+            app.on_key_press(SimpleNamespace(widget=app.canvas, keysym=args[0], char=args[1]))
+        elif kind == "click":
+            app.on_mouse_click(SimpleNamespace(widget=app.canvas, x=args[0], y=args[1]))
+        elif kind == "drag":
+            app.on_mouse_drag(SimpleNamespace(widget=app.canvas, x=args[0], y=args[1]))
+        elif kind == "release":
+            app.on_mouse_release(SimpleNamespace(widget=app.canvas))
+        elif kind == "wheel":
+            app.on_mousewheel(SimpleNamespace(widget=app.canvas, delta=args[0]))
+        elif kind == "view":
+            if args[0] < len(app.views):
+                app.activate_view(app.views[args[0]])
+        elif kind == "split":
+            app.split_view()
+        elif kind == "close_view":
+            app.close_view()
+        elif kind == "search_window":
+            app.set_search_window_open(args[0])
+        elif kind == "search":
+            app.search_term = args[0]
+            app.perform_search()
+        elif kind == "search_step":
+            app.step_search_result(args[0])
+        elif kind == "replace":
+            app.replace_term = args[0]
+            app.replace_current_match()
+        elif kind == "replace_all":
+            app.replace_term = args[0]
+            app.replace_all_matches()
+        elif kind == "copy":
+            app.copy_text()
+        elif kind == "cut":
+            app.cut_text()
+        elif kind == "paste":
+            app.root.clipboard_clear()
+            app.root.clipboard_append(args[0])
+            app.paste_text()
+
+    def run(self):
+        self.prepare()
+        root = self.app.root
+        tracemalloc.start()
+        started = time.perf_counter()
+        for stamp, kind, *args in self.events:
+            if self.speed > 0:
+                delay = started + stamp / 1000 / self.speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            #前のイベントの後に予約された処理は、計測の外で済ませておく
+            root.update()
+            begin = time.perf_counter()
+            self.dispatch(kind, args)
+            root.update_idletasks()
+            self.latencies.append((kind, (time.perf_counter() - begin) * 1000))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return self.report(peak)
+
+    @staticmethod
+    def percentile(values, p):
+        #最近傍順位法
+        ordered = sorted(values)
+        return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+    def summarize(self, values):
+        summary = {"count": len(values)}
+        for p in self.PERCENTILES:
+            summary[f"p{p}_ms"] = round(self.percentile(values, p), 3) if values else None
+        return summary
+
+    def report(self, peak):
+        by_kind = {}
+        for kind, latency in self.latencies:
+            by_kind.setdefault(kind, []).append(latency)
+        result = self.summarize([latency for kind, latency in self.latencies])
+        result["peak_memory_mb"] = round(peak / 1024 / 1024, 3)
+        result["by_kind"] = {kind: self.summarize(values) for kind, values in sorted(by_kind.items())}
+        return result
+
+class PrintPreview(tk.Toplevel):
+    #PDF出力と同じページ割りで表示する印刷プレビュー
+    #ページ割りはワーカースレッドで遅延して行い、結果をPageCacheに溜める
+    POLL_MS = 50
+    SYNC_MS = 500
+    PREFETCH = 2
+
+    def __init__(self, parent, app):
+        super().__init__(parent)
+        self.title("印刷プレビュー")
+        self.geometry("500x700")
+        self.app = app
+        self.model = None
+        self.model_key = None
+        self.cache = PageCache()
+        self.page = 0
+        self.pending = set()
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+        self.closed = False
+        self.sync_countdown = self.SYNC_MS
+
+        button_frame = tk.Frame(self)
+        button_frame.pack(side=tk.TOP, fill=tk.X)
+        #縦書きなので左が次のページ
+        tk.Button(button_frame, text="< 次", command=lambda: self.show_page(self.page + 1)).pack(side=tk.LEFT)
+        tk.Button(button_frame, text="前 >", command=lambda: self.show_page(self.page - 1)).pack(side=tk.RIGHT)
+        self.status_label = tk.Label(button_frame, text="")
+        self.status_label.pack(side=tk.TOP)
+
+        self.canvas = tk.Canvas(self, bg="gray60")
+        self.canvas.pack(fill="both", expand=True)
+        self.canvas.bind("<Configure>", lambda e: self.render())
+        self.bind("<Left>", lambda e: self.show_page(self.page + 1))
+        self.bind("<Right>", lambda e: self.show_page(self.page - 1))
+        self.bind("<Prior>", lambda e: self.show_page(self.page - 1))
+        self.bind("<Next>", lambda e: self.show_page(self.page + 1))
+        self.bind("<Destroy>", self.on_destroy)
+
+        self.worker = threading.Thread(target=self.work, daemon=True)
+        self.worker.start()
+        self.sync_model()
+        self.show_page(0)
+        self.after(self.POLL_MS, self.poll)
+
+    def work(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            model, page_number = request
+            try:
+                generation, pages, complete = model.get_pages(page_number)
+            except Exception:
+                generation, pages = None, None
+            self.results.put((model, generation, page_number, pages))
+
+    def sync_model(self):
+        #フォントが変わればページ割りを作り直し、本文の編集は編集位置以降のページだけ捨てる
+        app = self.app
+        key = (app.current_font.measure("あ"), app.current_font.metrics("linespace"), app.current_font.actual()["size"])
+        if key != self.model_key:
+            self.model = PdfPageModel(A4, *key)
+            self.model_key = key
+            self.cache.clear()
+            self.pending.clear()
+        invalid_page = self.model.update(app.text, app.auto_indent, app.get_markup())
+        if invalid_page is not None:
+            self.cache.invalidate_from(invalid_page)
+            if self.page >= invalid_page:
+                self.render()
+
+    def request(self, page_number):
+        if page_number < 0 or page_number in self.pending or self.cache.get(page_number) is not None:
+            return
+        count, complete = self.model.known_page_count()
+        if complete and page_number >= count:
+            return
+        self.pending.add(page_number)
+        self.requests.put((self.model, page_number))
+
+    def show_page(self, page_number):
+        count, complete = self.model.known_page_count()
+        if page_number < 0 or (complete and page_number >= count):
+            return
+        self.page = page_number
+        self.render()
+
+    def poll(self):
+        if self.closed:
+            return
+        while True:
+            try:
+                model, generation, page_number, pages = self.results.get_nowait()
+            except queue.Empty:
+                break
+            self.pending.discard(page_number)
+            if model is not self.model or pages is None or generation != model.generation:
+                continue
+            for number, page_ops in pages.items():
+                self.cache.put(number, page_ops)
+            if self.page in pages:
+                self.render()
+        self.sync_countdown -= self.POLL_MS
+        if self.sync_countdown <= 0:
+            self.sync_countdown = self.SYNC_MS
+            self.sync_model()
+        self.after(self.POLL_MS, self.poll)
+
+    def render(self):
+        if self.model is None:
+            return
+        count, complete = self.model.known_page_count()
+        if complete and self.page >= count:
+            self.page = count - 1
+        page_ops = self.cache.get(self.page)
+        for offset in range(1, self.PREFETCH + 1):
+            self.request(self.page + offset)
+        self.request(self.page - 1)
+        if page_ops is None:
+            #まだページ割りが終わっていないページは、ワーカーの結果を待つ
+            self.request(self.page)
+            self.status_label.config(text=f"{self.page + 1}ページ (準備中…)")
+            return
+        self.status_label.config(text=f"{self.page + 1} / {count}{'' if complete else '+'}ページ")
+        self.canvas.delete("all")
+        width = self.canvas.winfo_width()
+        height = self.canvas.winfo_height()
+        scale = min((width - 20) / self.model.width, (height - 20) / self.model.height)
+        if scale <= 0:
+            return
+        left = (width - self.model.width * scale) / 2
+        top = (height - self.model.height * scale) / 2
+        background_color, text_color = self.app.get_pdf_theme_colors()
+        tk_canvas = TkPdfCanvas(self.canvas, scale, self.model.height, self.app.current_font.actual()["family"])
+        self.app.render_pdf_page(tk_canvas, page_ops, self.model, background_color, text_color)
+        self.canvas.move("all", left, top)
+
+    def on_destroy(self, event):
+        if event.widget is self and not self.closed:
+            self.closed = True
+            self.requests.put(None)
+
+class OutlineDialog(tk.Toplevel):
+    #見出しの一覧と、ページ番号・章番号での移動
+    SYNC_MS = 500
+
+    def __init__(self, parent, app):
+        super().__init__(parent)
+        self.title("見出し・ページ移動")
+        self.app = app
+        self.entries = []
+        self.shown = None
+        self.closed = False
+
+        self.pattern_var = tk.StringVar(value=app.heading_index.pattern)
+        self.page_var = tk.StringVar()
+        self.chapter_var = tk.StringVar()
+
+        tk.Label(self, text="見出し(正規表現):").grid(row=0, column=0, padx=5, pady=5, sticky="e")
+        tk.Entry(self, textvariable=self.pattern_var, width=40).grid(row=0, column=1, padx=5, pady=5, sticky="we")
+        tk.Button(self, text="適用", command=self.apply_pattern).grid(row=0, column=2, padx=5, pady=5)
+
+        list_frame = tk.Frame(self)
+        list_frame.grid(row=1, column=0, columnspan=3, padx=5, pady=5, sticky="nsew")
+        self.heading_list = tk.Listbox(list_frame, width=50, height=20)
+        scrollbar = ttk.Scrollbar(list_frame, orient="vertical", command=self.heading_list.yview)
+        self.heading_list.configure(yscrollcommand=scrollbar.set)
+        self.heading_list.pack(side=tk.LEFT, fill="both", expand=True)
+        scrollbar.pack(side=tk.RIGHT, fill="y")
+        self.heading_list.bind("<Double-Button-1>", self.on_heading_open)
+        self.heading_list.bind("<Return>", self.on_heading_open)
+
+        jump_frame = tk.Frame(self)
+        jump_frame.grid(row=2, column=0, columnspan=3, pady=5)
+        tk.Label(jump_frame, text="ページ:").pack(side=tk.LEFT)
+        page_entry = tk.Entry(jump_frame, textvariable=self.page_var, width=6)
+        page_entry.pack(side=tk.LEFT)
+        page_entry.bind("<Return>", lambda e: self.go_to_page())
+        tk.Button(jump_frame, text="移動", command=self.go_to_page).pack(side=tk.LEFT, padx=(0, 10))
+        tk.Label(jump_frame, text="章:").pack(side=tk.LEFT)
+        chapter_entry = tk.Entry(jump_frame, textvariable=self.chapter_var, width=6)
+        chapter_entry.pack(side=tk.LEFT)
+        chapter_entry.bind("<Return>", lambda e: self.go_to_chapter())
+        tk.Button(jump_frame, text="移動", command=self.go_to_chapter).pack(side=tk.LEFT)
+
+        self.status_label = tk.Label(self, text="", anchor=tk.W)
+        self.status_label.grid(row=3, column=0, columnspan=3, padx=5, sticky="we")
+        self.columnconfigure(1, weight=1)
+        self.rowconfigure(1, weight=1)
+        self.bind("<Destroy>", self.on_destroy)
+        page_entry.focus_set()
+        self.sync()
+
+    def apply_pattern(self):
+        try:
+            self.app.heading_index.set_pattern(self.pattern_var.get())
+        except re.error as e:
+            messagebox.showerror("正規表現エラー", f"無効な正規表現です: {e}", parent=self)
+            return
+        self.refresh()
+
+    def sync(self):
+        #本文の編集を一定間隔で見出しの一覧に反映する
+        if self.closed:
+            return
+        self.refresh()
+        self.after(self.SYNC_MS, self.sync)
+
+    def refresh(self):
+        app = self.app
+        app.heading_index.update(app.text)
+        manuscript = app.get_manuscript_pages()
+        positions = app.heading_index.positions
+        pages = manuscript.pages_of(positions)
+        lines = [f"{title}  (p.{page})" for title, page in zip(app.heading_index.titles, pages.tolist())]
+        self.status_label.config(text=f"見出し {len(lines)}件 / 全{manuscript.page_count()}ページ(20字×20行)")
+        if lines == self.shown:
+            return
+        self.shown = lines
+        self.entries = list(positions)
+        self.heading_list.delete(0, tk.END)
+        for line in lines:
+            self.heading_list.insert(tk.END, line)
+
+    def on_heading_open(self, event):
+        selection = self.heading_list.curselection()
+        if selection:
+            self.app.jump_to(self.entries[selection[0]])
+
+    def go_to_page(self):
+        try:
+            page = int(self.page_var.get())
+        except ValueError:
+            return
+        if not self.app.go_to_page(page):
+            self.status_label.config(text=f"{page}ページはありません")
+
+    def go_to_chapter(self):
+        try:
+            number = int(self.chapter_var.get())
+        except ValueError:
+            return
+        if not self.app.go_to_chapter(number):
+            self.status_label.config(text=f"{number}番目の見出しはありません")
+
+    def on_destroy(self, event):
+        if event.widget is self:
+            self.closed = True
+
+class CompareDialog(tk.Toplevel):
+    #別のファイルと今のテキストを比べ、違いを本文に色で示す
+    POLL_MS = 100
+    KIND_LABELS = {"insert": "追加", "change": "変更", "delete": "削除"}
+
+    def __init__(self, parent, app):
+        super().__init__(parent)
+        self.title("ファイルと比較")
+        self.app = app
+        self.diff = None
+        self.results = queue.Queue()
+        self.closed = False
+
+        self.path_var = tk.StringVar(value=app.file_path or "")
+        tk.Label(self, text="比較元:").grid(row=0, column=0, padx=5, pady=5, sticky="e")
+        tk.Entry(self, textvariable=self.path_var, width=40).grid(row=0, column=1, padx=5, pady=5, sticky="we")
+        tk.Button(self, text="参照", command=self.choose_file).grid(row=0, column=2, padx=5, pady=5)
+
+        button_frame = tk.Frame(self)
+        button_frame.grid(row=1, column=0, columnspan=3, pady=5)
+        tk.Button(button_frame, text="比較", command=self.start).pack(side=tk.LEFT)
+        tk.Button(button_frame, text="中止", command=self.stop).pack(side=tk.LEFT)
+
+        self.progress = ttk.Progressbar(self, orient="horizontal", mode="determinate", maximum=1.0)
+        self.progress.grid(row=2, column=0, columnspan=3, padx=5, pady=5, sticky="we")
+
+        list_frame = tk.Frame(self)
+        list_frame.grid(row=3, column=0, columnspan=3, padx=5, pady=5, sticky="nsew")
+        self.change_list = tk.Listbox(list_frame, width=60, height=20)
+        scrollbar = ttk.Scrollbar(list_frame, orient="vertical", command=self.change_list.yview)
+        self.change_list.configure(yscrollcommand=scrollbar.set)
+        self.change_list.pack(side=tk.LEFT, fill="both", expand=True)
+        scrollbar.pack(side=tk.RIGHT, fill="y")
+        self.change_list.bind("<Double-Button-1>", self.on_change_open)
+
+        self.status_label = tk.Label(self, text="", anchor=tk.W)
+        self.status_label.grid(row=4, column=0, columnspan=3, padx=5, sticky="we")
+        self.columnconfigure(1, weight=1)
+        self.rowconfigure(3, weight=1)
+        self.bind("<Destroy>", self.on_destroy)
+
+    def choose_file(self):
+        file_path = filedialog.askopenfilename(parent=self, filetypes=[("Text files", "*.txt"), ("All files", "*.*")])
+        if file_path:
+            self.path_var.set(file_path)
+
+    def start(self):
+        file_path = self.path_var.get()
+        if not os.path.isfile(file_path):
+            messagebox.showerror("エラー", f"ファイルが見つかりません: {file_path}", parent=self)
+            return
+        self.stop()
+        self.diff = RevisionDiff(file_path)
+        self.progress["value"] = 0
+        self.status_label.config(text="読み込み中…")
+        threading.Thread(target=self.diff.run, args=(self.app.text, self.results), daemon=True).start()
+        self.after(self.POLL_MS, self.poll)
+
+    def stop(self):
+        if self.diff is not None:
+            self.diff.cancelled = True
+
+    def poll(self):
+        if self.closed or self.diff is None:
+            return
+        diff = self.diff
+        while True:
+            try:
+                message = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if message[0] == "progress":
+                self.progress["value"] = message[1]
+                self.status_label.config(text=message[2])
+            elif message[0] == "error":
+                self.status_label.config(text=f"エラー: {message[1]}")
+                return
+            elif message[0] == "done":
+                diff.text, diff.changes = message[1], message[2]
+                self.show(diff)
+                return
+        if not diff.cancelled:
+            self.after(self.POLL_MS, self.poll)
+        else:
+            self.status_label.config(text="中止しました")
+
+    def show(self, diff):
+        self.progress["value"] = 1.0
+        self.app.revision_diff = diff
+        self.app.redraw()
+        self.change_list.delete(0, tk.END)
+        for start, end, kind, old in diff.changes:
+            if kind == "insert":
+                line = f"{self.KIND_LABELS[kind]}: {self.app.text[start:end][:40]}"
+            else:
+                line = f"{self.KIND_LABELS[kind]}: {old[:40]}"
+            self.change_list.insert(tk.END, line.replace("\n", "⏎"))
+        self.status_label.config(text=f"{len(diff.changes)}か所の違い")
+
+    def on_change_open(self, event):
+        selection = self.change_list.curselection()
+        if selection and self.app.revision_diff is not None:
+            self.app.revision_diff.update(self.app.text)
+            changes = self.app.revision_diff.changes
+            if selection[0] < len(changes):
+                self.app.jump_to(changes[selection[0]][0])
+
+    def on_destroy(self, event):
+        #閉じたら検索窓と同じく色分けも消す
+        if event.widget is self and not self.closed:
+            self.closed = True
+            self.stop()
+            if self.app.revision_diff is self.diff and self.diff is not None:
+                self.app.revision_diff = None
+                self.app.redraw()
+
+class ProjectSearchDialog(tk.Toplevel):
+    #フォルダ内のファイルをプロセスプールで並列に検索・置換する
+    POLL_MS = 100
+
+    def __init__(self, parent, app):
+        super().__init__(parent)
+        self.title("フォルダ内検索・置換")
+        self.app = app
+        self.executor = None
+        self.futures = []
+        self.entries = []
+        self.total_count = 0
+        self.file_count = 0
+        self.mode = None
+
+        self.folder_var = tk.StringVar(value=os.path.dirname(app.file_path) if app.file_path else os.getcwd())
+        self.pattern_var = tk.StringVar(value=app.search_term)
+        self.replace_var = tk.StringVar(value=app.replace_term)
+        self.glob_var = tk.StringVar(value="*.txt")
+        self.regex_var = tk.BooleanVar(value=False)
+
+        tk.Label(self, text="フォルダ:").grid(row=0, column=0, padx=5, pady=5, sticky="e")
+        tk.Entry(self, textvariable=self.folder_var, width=40).grid(row=0, column=1, padx=5, pady=5, sticky="we")
+        tk.Button(self, text="参照", command=self.choose_folder).grid(row=0, column=2, padx=5, pady=5)
+        tk.Label(self, text="ファイル:").grid(row=1, column=0, padx=5, pady=5, sticky="e")
+        tk.Entry(self, textvariable=self.glob_var, width=40).grid(row=1, column=1, padx=5, pady=5, sticky="we")
+        tk.Label(self, text="検索:").grid(row=2, column=0, padx=5, pady=5, sticky="e")
+        tk.Entry(self, textvariable=self.pattern_var, width=40).grid(row=2, column=1, padx=5, pady=5, sticky="we")
+        tk.Checkbutton(self, text="正規表現(行単位)", variable=self.regex_var).grid(row=2, column=2, padx=5, pady=5)
+        tk.Label(self, text="置換:").grid(row=3, column=0, padx=5, pady=5, sticky="e")
+        tk.Entry(self, textvariable=self.replace_var, width=40).grid(row=3, column=1, padx=5, pady=5, sticky="we")
+
+        button_frame = tk.Frame(self)
+        button_frame.grid(row=4, column=0, columnspan=3, pady=5)
+        tk.Button(button_frame, text="検索", command=lambda: self.start("search")).pack(side=tk.LEFT)
+        tk.Button(button_frame, text="置換プレビュー", command=lambda: self.start("preview")).pack(side=tk.LEFT)
+        tk.Button(button_frame, text="置換実行", command=lambda: self.start("apply")).pack(side=tk.LEFT)
+        tk.Button(button_frame, text="中止", command=self.stop).pack(side=tk.LEFT)
+
+        list_frame = tk.Frame(self)
+        list_frame.grid(row=5, column=0, columnspan=3, padx=5, pady=5, sticky="nsew")
+        self.result_list = tk.Listbox(list_frame, width=80, height=20)
+        scrollbar = ttk.Scrollbar(list_frame, orient="vertical", command=self.result_list.yview)
+        self.result_list.configure(yscrollcommand=scrollbar.set)
+        self.result_list.pack(side=tk.LEFT, fill="both", expand=True)
+        scrollbar.pack(side=tk.RIGHT, fill="y")
+        self.result_list.bind("<Double-Button-1>", self.on_result_open)
+
+        self.status_label = tk.Label(self, text="", anchor=tk.W)
+        self.status_label.grid(row=6, column=0, columnspan=3, padx=5, sticky="we")
+        self.columnconfigure(1, weight=1)
+        self.rowconfigure(5, weight=1)
+        self.bind("<Destroy>", self.on_destroy)
+
+    def choose_folder(self):
+        folder = filedialog.askdirectory(initialdir=self.folder_var.get(), parent=self)
+        if folder:
+            self.folder_var.set(folder)
+
+    def list_files(self):
+        patterns = self.glob_var.get().split() or ["*"]
+        for dir_path, dir_names, file_names in os.walk(self.folder_var.get()):
+            dir_names[:] = [d for d in dir_names if not d.startswith(".")]
+            for file_name in sorted(file_names):
+                if any(fnmatch.fnmatch(file_name, p) for p in patterns):
+                    yield os.path.join(dir_path, file_name)
+
+    def start(self, mode):
+        pattern = self.pattern_var.get()
+        if not pattern:
+            return
+        use_regex = self.regex_var.get()
+        if use_regex:
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                messagebox.showerror("正規表現エラー", f"無効な正規表現です: {e}", parent=self)
+                return
+        replacement = None
+        if mode != "search":
+            replacement = self.replace_var.get()
+            if not use_regex:
+                replacement = replacement.replace("\\", "\\\\")
+        if mode == "apply" and not messagebox.askyesno("置換実行", "フォルダ内のファイルを書き換えます。よろしいですか?", parent=self):
+            return
+        self.stop()
+        self.result_list.delete(0, tk.END)
+        self.entries = []
+        self.total_count = 0
+        self.file_count = 0
+        self.mode = mode
+        self.executor = ProcessPoolExecutor()
+        self.futures = [self.executor.submit(search_file, path, pattern, use_regex, replacement, mode == "apply")
+                        for path in self.list_files()]
+        self.after(self.POLL_MS, self.poll)
+
+    def poll(self):
+        if not self.futures:
+            return
+        #終わったファイルから順に結果へ追加する
+        pending = []
+        for future in self.futures:
+            if not future.done():
+                pending.append(future)
+            elif not future.cancelled():
+                self.add_result(*future.result())
+        self.futures = pending
+        if pending:
+            self.status_label.config(text=f"検索中… {self.total_count}件 / {self.file_count}ファイル")
+            self.after(self.POLL_MS, self.poll)
+        else:
+            self.finish()
+
+    def add_result(self, file_path, count, previews, error):
+        if error:
+            self.result_list.insert(tk.END, f"{file_path}: エラー {error}")
+            self.entries.append(None)
+            return
+        if not count:
+            return
+        self.total_count += count
+        self.file_count += 1
+        self.result_list.insert(tk.END, f"{file_path} ({count}件)")
+        self.entries.append((file_path, 1))
+        for line_number, column, snippet in previews:
+            self.result_list.insert(tk.END, f"    {line_number}:{column + 1}  {snippet}")
+            self.entries.append((file_path, line_number))
+
+    def finish(self):
+        label = {"search": "検索", "preview": "置換プレビュー", "apply": "置換"}[self.mode]
+        self.status_label.config(text=f"{label}完了: {self.total_count}件 / {self.file_count}ファイル")
+        self.executor.shutdown(wait=False)
+        self.executor = None
+        if self.mode == "apply" and self.app.file_path:
+            rewritten = {os.path.abspath(entry[0]) for entry in self.entries if entry}
+            if os.path.abspath(self.app.file_path) in rewritten and messagebox.askyesno(
+                    "置換", "開いているファイルも書き換えました。読み込み直しますか?", parent=self):
+                self.app.load_file(self.app.file_path)
+
+    def stop(self):
+        for future in self.futures:
+            future.cancel()
+        self.futures = []
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def on_result_open(self, event):
+        selection = self.result_list.curselection()
+        if not selection or self.entries[selection[0]] is None:
+            return
+        file_path, line_number = self.entries[selection[0]]
+        if self.app.file_path is None or os.path.abspath(self.app.file_path) != os.path.abspath(file_path):
+            if not self.app.load_file(file_path):
+                return
+        #行番号の行頭へキャレットを移す
+        pos = 0
+        for _ in range(line_number - 1):
+            pos = self.app.text.find("\n", pos) + 1
+            if pos == 0:
+                pos = len(self.app.text)
+                break
+        self.app.jump_to(pos)
+
+    def on_destroy(self, event):
+        if event.widget is self:
+            self.stop()
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="TateX 縦書きエディタ")
+    parser.add_argument("--record", metavar="TRACE", help="入力を記録し、TRACEへ1秒ごとに書き足していく")
+    parser.add_argument("--replay", metavar="TRACE", help="記録した入力を再生して、描画までの時間とメモリのピークを表示する")
+    parser.add_argument("--speed", type=float, default=0.0, help="再生速度の倍率(0なら間隔を空けずに流す)")
+    parser.add_argument("--report", metavar="JSON", help="再生結果をJSONで保存する")
+    parser.add_argument("--max-p95", type=float, metavar="MS", help="p95がこれを超えたら終了コード1で終わる")
+    args = parser.parse_args()
     root = tk.Tk()
-    app = VerticalNotepad(root)
-    root.mainloop()
\ No newline at end of file
+    if args.replay:
+        #画面のない環境ではXvfbなどの仮想ディスプレイの上で動かす
+        app = VerticalNotepad(root, interactive=False)
+        result = InputReplayer(app, args.replay, args.speed).run()
+        app.linter.stop()
+        root.destroy()
+        print(f"イベント数: {result['count']}")
+        print(f"p50: {result['p50_ms']} ms  p95: {result['p95_ms']} ms  p99: {result['p99_ms']} ms")
+        print(f"メモリのピーク: {result['peak_memory_mb']} MB")
+        for kind, summary in result["by_kind"].items():
+            print(f"  {kind}: {summary['count']}件  p50: {summary['p50_ms']} ms  p95: {summary['p95_ms']} ms  p99: {summary['p99_ms']} ms")
+        if args.report:
+            with open(args.report, "w", encoding="utf-8") as f:
+                json.dump(result, f, ensure_ascii=False, indent=2)
+        if args.max_p95 is not None and result["p95_ms"] is not None and result["p95_ms"] > args.max_p95:
+            raise SystemExit(1)
+    else:
+        app = VerticalNotepad(root)
+        if args.record:
+            app.start_recording(args.record)
+        root.mainloop()
\ No newline at end of file
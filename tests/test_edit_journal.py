@@ -0,0 +1,52 @@
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from VerticalNotepad import EditJournal
+
+
+def recover(root):
+    journal = EditJournal(str(root))
+    result = journal.recover(lambda path: "")
+    for directory, lock in journal.recovered:
+        lock.close()
+    return result
+
+
+def test_removed_blank_line_keeps_flag_of_following_line(tmp_path):
+    journal = EditJournal(str(tmp_path))
+    journal.start("a\n\nb", [True, False], None, False)
+    journal.record("a\nb", [False], None)
+    journal.close(False)
+    assert recover(tmp_path) == ("a\nb", [False], None)
+
+
+def test_flag_only_change_is_recorded(tmp_path):
+    journal = EditJournal(str(tmp_path))
+    journal.start("a\nb\nc", [False, False], None, False)
+    journal.record("a\nb\nc", [False, True], None)
+    journal.close(False)
+    assert recover(tmp_path) == ("a\nb\nc", [False, True], None)
+
+
+def test_random_edits_replay_to_last_state(tmp_path):
+    rng = random.Random(0)
+    text = "あいう\nえお\n\nか"
+    flags = [False, True, False]
+    journal = EditJournal(str(tmp_path))
+    journal.start(text, flags, None, False)
+    for _ in range(200):
+        pos = rng.randint(0, len(text))
+        end = rng.randint(pos, min(len(text), pos + 3))
+        inserted = "".join(rng.choice("ab\n") for _ in range(rng.randint(0, 3)))
+        first_newline = text.count("\n", 0, pos)
+        new_flags = [rng.random() < 0.5 for _ in range(inserted.count("\n"))]
+        flags = flags[:first_newline] + new_flags + flags[first_newline + text.count("\n", pos, end):]
+        text = text[:pos] + inserted + text[end:]
+        if rng.random() < 0.2 and flags:
+            flags[rng.randrange(len(flags))] ^= True
+        journal.record(text, flags, None)
+    journal.close(False)
+    assert recover(tmp_path) == (text, flags, None)